@@ -9,6 +9,7 @@ from languages.views import *
 from progress.views import * 
 from vocabulary.views import * 
 from learning.views import *
+from languages import async_views as languages_async_views
 
 
 router = DefaultRouter()
@@ -58,7 +59,11 @@ router.register(r'notifications', NotificationViewSet, basename='notification')
 
 
 
-urlpatterns = router.urls + [
+# view async (ASGI) -> khai báo trước router để được match trước
+urlpatterns = [
+    path('roleplay-session/submit-practice-stream/', languages_async_views.submit_practice_stream,
+         name='roleplay-session-submit-practice-stream'),
+] + router.urls + [
     path("export/chat_training.jsonl", export_chat_training, name="export_chat_training"),
     path('leaderboard', LeaderboardAllView.as_view()),
     path('practice/overview', practice_overview, name="practice-overview"),
@@ -0,0 +1,424 @@
+import asyncio
+import contextlib
+import json
+from typing import Optional, List, Dict, Any
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse, Http404
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from .models import Conversation, Turn
+from languages.models import Skill
+from .serializers import MessageRequestSerializer, ConversationSerializer
+from .utils import simple_reply
+from .rag.retriever import get_index
+from .services.llm import Delta, call_llm, aiter_llm, OLLAMA_MODEL, _fallback_suggestions
+from .services.llm_context import KV_REUSE, call_llm_ctx, aiter_llm_ctx
+from .services.history import abuild_history, amaybe_schedule_summary, summary_block
+from .services import rag_refs, response_cache, ring
+from utils.aio import ClosingStream, run_blocking
+from utils.llm_gateway import GatewayBusy, Priority, acquire_async
+
+# View async thuần (ASGI): không asyncio.run mỗi request, không giữ thread trong lúc chờ Ollama.
+# ORM dùng API async (aget/acreate/async for); phần CPU/sync (RAG search, serializer) chạy qua sync_to_async.
+
+SSE_HEARTBEAT_S = float(getattr(settings, "CHAT_SSE_HEARTBEAT_SECONDS", 10))
+
+
+# ---- helpers ----
+async def _prior_turns(conv) -> int:
+    return await Turn.objects.filter(conversation=conv).exclude(role='system').acount()
+
+
+def _format_rag_snippet(hits: List[Dict], max_items: int = 3, max_len: int = 350) -> str:
+    """
+    hits: [{"text": "...", "score": float, "meta": {...}}, ...]
+    Trả về chuỗi context gọn cho system prompt.
+    """
+    out = []
+    for i, h in enumerate(hits[:max_items], start=1):
+        txt = (h.get("text") or "").strip()
+        if len(txt) > max_len:
+            txt = txt[:max_len].rsplit(" ", 1)[0] + "…"
+        meta = h.get("meta") or {}
+        tag = f"{meta.get('topic_slug','?')} / L{meta.get('lesson_order','?')} / {meta.get('skill_title','?')}"
+        out.append(f"[{i}] ({h.get('score',0):.3f}) {tag}: {txt}")
+    return "\n".join(out)
+
+
+def _rag_hits_payload(conv, rag_hits: List[Dict]) -> List[Dict]:
+    return [
+        {"id": h.get("id"), "score": float(h.get("score", 0.0)), "meta": h.get("meta"), "doc": h.get("text")}
+        for h in rag_hits[: int(getattr(conv, "knowledge_limit", 3) or 3)]
+    ]
+
+
+async def _parse(request):
+    try:
+        body = json.loads(request.body or b"{}")
+    except ValueError:
+        return None, JsonResponse({"detail": "Invalid JSON body."}, status=400)
+    s = MessageRequestSerializer(data=body)
+    if not s.is_valid():
+        return None, JsonResponse(s.errors, status=400)
+    return s.validated_data, None
+
+
+async def _get_conversation(conv_id) -> Conversation:
+    try:
+        return await Conversation.objects.select_related("topic__language").aget(id=conv_id)
+    except Conversation.DoesNotExist:
+        raise Http404("No Conversation matches the given query.")
+
+
+async def _system_prompt(conv) -> str:
+    system_turn = await (Turn.objects.filter(conversation=conv, role='system')
+                         .order_by('created_at').only('content').afirst())
+    return system_turn.content if system_turn else ""
+
+
+async def _context(conv, request):
+    """system prompt (+ rolling summary) và history đuôi vừa CHAT_HISTORY_TOKEN_BUDGET; ?return_turns=N chặn thêm số turn."""
+    base = await _system_prompt(conv)
+    history, summary = await abuild_history(conv, max_turns=_last_n(request, 0) or None)
+    return base, base + summary_block(summary), history
+
+
+def _cache_scope(conv, base_system: str, v) -> Optional[str]:
+    """Scope cache câu trả lời (None = tắt). Dùng system prompt gốc, không gồm summary riêng của hội thoại."""
+    if not response_cache.cacheable(v.get("user_text")):
+        return None
+    return response_cache.make_scope(
+        language=getattr(conv.topic.language, "abbreviation", None),
+        topic=getattr(conv.topic, "slug", None),
+        skill=v.get("skill_id") or (v.get("skill") or "").strip().lower() or None,
+        system_prompt=base_system,
+        model=OLLAMA_MODEL,
+        generation=get_index().generation if conv.use_rag else "",
+    )
+
+
+def _scoped_lookup(conv, base_system: str, v, user_text: str):
+    scope = _cache_scope(conv, base_system, v)
+    if not scope:
+        return None, None
+    try:
+        return scope, response_cache.lookup(scope, user_text)
+    except Exception:
+        return scope, None
+
+
+async def _cache_lookup(conv, base_system: str, v, user_text: str):
+    """-> (scope, hit). Scope (đọc version từ Redis + manifest index) và lookup cùng chạy trong 1 thread."""
+    return await sync_to_async(_scoped_lookup, thread_sensitive=False)(conv, base_system, v, user_text)
+
+
+async def _cache_store(scope: Optional[str], user_text: str, reply_text: str, turn_id) -> None:
+    if scope:
+        await sync_to_async(response_cache.store, thread_sensitive=False)(scope, user_text, reply_text, turn_id)
+
+
+def _busy(e: GatewayBusy) -> JsonResponse:
+    resp = JsonResponse({"detail": str(e.detail), "code": "llm_busy", "provider": e.provider},
+                        status=429, json_dumps_params={"ensure_ascii": False})
+    resp["Retry-After"] = str(int(e.retry_after + 0.999))
+    return resp
+
+
+def _chunks(text: str, words: int = 4):
+    ws = text.split(" ")
+    for i in range(0, len(ws), words):
+        yield " ".join(ws[i:i + words]) + (" " if i + words < len(ws) else "")
+
+
+async def _replay(hit):
+    """Phát lại câu trả lời cache dưới dạng token như LLM thật -> client không cần nhánh riêng."""
+    for piece in _chunks(hit["answer"]):
+        yield Delta("token", piece)
+    yield Delta("meta", meta={"suggestions": _fallback_suggestions(hit["answer"]), "confidence": 0.7})
+
+
+def _sse(event: str, data) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n".encode("utf-8")
+
+
+async def _retrieve(conv, user_text: str, skill_id=None, skill_title=None) -> List[Dict]:
+    if not bool(getattr(conv, "use_rag", False)):
+        return []
+    try:
+        k = int(getattr(conv, "knowledge_limit", 3) or 3)
+        lang_abbr = getattr(conv.topic.language, "abbreviation", None)
+        topic_slug = getattr(conv.topic, "slug", None)
+
+        # Ưu tiên skill_id, fallback skill (title)
+        skill_ids = None
+        if isinstance(skill_id, int):
+            skill_ids = [skill_id]
+        elif isinstance(skill_title, str) and skill_title.strip():
+            qs = Skill.objects.filter(title__iexact=skill_title.strip())
+            if lang_abbr:
+                qs = qs.filter(language_code=lang_abbr)
+            first = await qs.values_list("id", flat=True).afirst()
+            skill_ids = [first] if first is not None else None
+
+        # search = numpy + (có thể) embed query qua HTTP sync -> thread pool, không chặn event loop
+        idx = await sync_to_async(get_index, thread_sensitive=False)()
+        return await sync_to_async(idx.search, thread_sensitive=False)(
+            query=(user_text or "").strip() or getattr(conv.topic, "title", ""),
+            top_k=k,
+            language=lang_abbr,
+            topics=[topic_slug] if topic_slug else None,
+            skills=skill_ids,
+        ) or []
+    except Exception:
+        return []
+
+
+async def _generation() -> str:
+    """generation của RAG index; get_index có thể đọc manifest trên đĩa / nạp index -> chạy ngoài event loop."""
+    return (await run_blocking(get_index)).generation
+
+
+def _last_n(request, default: int) -> int:
+    try:
+        return int(request.GET.get('return_turns') or default)
+    except ValueError:
+        return default
+
+
+@csrf_exempt
+@require_POST
+async def message(request):
+    """POST /api/chat/chat/message/ — Gửi tin nhắn theo conv_id, server gọi LLM (Ollama) với system+history."""
+    v, err = await _parse(request)
+    if err:
+        return err
+
+    conv = await _get_conversation(v['conv_id'])
+    user_text = v.get('user_text') or ""
+
+    # history = các lượt TRƯỚC tin nhắn này (tin nhắn mới được LLM nhận riêng, không lặp 2 lần)
+    base_system, system_prompt, history = await _context(conv, request)
+    last_n = _last_n(request, 0)
+    n_prev = await _prior_turns(conv)
+
+    user_turn = None
+    if user_text.strip():
+        user_turn = await Turn.objects.acreate(conversation=conv, role='user', content=user_text, meta={})
+        await ring.aappend(conv.id, user_turn)
+
+    # ---- RAG
+    rag_hits = await _retrieve(conv, user_text, v.get("skill_id"), v.get("skill"))
+    ctx = _format_rag_snippet(rag_hits, max_items=int(getattr(conv, "knowledge_limit", 3) or 3)) if rag_hits else ""
+
+    # ---- Semantic response cache (opt-in): câu hỏi gần như trùng trong cùng scope -> bỏ qua LLM
+    scope, cache_hit = await _cache_lookup(conv, base_system, v, user_text)
+
+    # ---- LLM (await trên AsyncClient dùng chung của process)
+    options = {
+        "temperature": float(getattr(conv, "temperature", 0.4) or 0.4),
+        "num_predict": int(getattr(conv, "max_tokens", 300) or 300),
+        "num_ctx": 1536,
+    }
+    llm_stats = None
+    llm_ok = False
+    try:
+        if cache_hit:
+            llm_res = {"text": cache_hit["answer"], "meta": {"suggestions": _fallback_suggestions(cache_hit["answer"])}}
+        elif KV_REUSE and user_text.strip():
+            # KV-context của conversation: system prompt giữ nguyên làm prefix, RAG đi kèm tin nhắn
+            llm_res = await call_llm_ctx(conv.id, system_prompt, history, user_text,
+                                         n_prev=n_prev, refs=ctx, options=options)
+        else:
+            if ctx:
+                system_prompt = (system_prompt or "") + (
+                    "\n\n[REFERENCE MATERIALS]\n" + ctx +
+                    "\n(Hãy ưu tiên dựa trên tài liệu trên khi phản hồi.)"
+                )
+            llm_res = await call_llm(system_prompt, history, user_text or "", options=options)
+        reply_text = (llm_res.get("text") or "").strip()
+        suggestions = (llm_res.get("meta") or {}).get("suggestions") or []
+        llm_stats = (llm_res.get("meta") or {}).get("llm")
+        llm_ok = not cache_hit and bool(reply_text) and (llm_res.get("meta") or {}).get("confidence", 0) >= 0.7
+        if not reply_text:
+            reply_text, suggestions = simple_reply(conv.topic.title, user_text)
+            reply_text += "\n\n(Lưu ý: LLM trả rỗng)"
+    except GatewayBusy as e:
+        # gateway quá tải: bỏ lượt user vừa lưu để client gửi lại không bị trùng
+        if user_turn is not None:
+            await user_turn.adelete()
+            await ring.ainvalidate(conv.id)
+        return _busy(e)
+    except Exception as e:
+        reply_text, suggestions = simple_reply(conv.topic.title, user_text)
+        reply_text += f"\n\n(Lưu ý: fallback LLM: {e})"
+
+    # ---- Pron meta: ưu tiên expect_text client cung cấp khi force_pron=True
+    expect_for_pron = (v.get("expect_text") or "").strip()
+    if v.get("force_pron", False):
+        expect_for_pron = expect_for_pron or reply_text
+
+    assistant_meta = {
+        "suggestions": suggestions,
+        "confidence": 0.7,
+        "rag": {"used": bool(rag_hits), "hits": _rag_hits_payload(conv, rag_hits)},
+        "pron": {
+            "expect_text": expect_for_pron or reply_text,
+            "force": bool(v.get("force_pron", False)),
+            "score_endpoint": "/api/speech/pron/score/",
+            "tts_endpoint": "/api/speech/tts/",
+        },
+    }
+    if llm_stats:
+        assistant_meta["llm"] = llm_stats
+    if cache_hit:
+        assistant_meta["cache"] = response_cache.provenance(cache_hit)
+    stored_meta = await rag_refs.acompact_meta(assistant_meta, await _generation() if rag_hits else "")
+    turn = await Turn.objects.acreate(conversation=conv, role='assistant', content=reply_text, meta=stored_meta)
+    await ring.aappend(conv.id, turn)
+    if llm_ok:
+        await _cache_store(scope, user_text, reply_text, turn.id)
+    await amaybe_schedule_summary(conv)
+
+    conv_ser = await sync_to_async(lambda: dict(ConversationSerializer(conv).data))()
+    if last_n and last_n > 0:
+        recent_turns = [t async for t in Turn.objects.filter(conversation=conv).order_by('-created_at')[:last_n]]
+        recent_turns.reverse()
+        metas = await rag_refs.aexpand([t.meta for t in recent_turns])
+        conv_ser["recent_turns"] = [
+            {"role": t.role, "content": t.content, "meta": m, "created_at": t.created_at}
+            for t, m in zip(recent_turns, metas)
+        ]
+
+    return JsonResponse(
+        {"reply": reply_text, "meta": assistant_meta, "conversation": conv_ser},
+        status=200, json_dumps_params={"ensure_ascii": False},
+    )
+
+
+@csrf_exempt
+@require_POST
+async def stream(request):
+    """
+    POST /api/chat/chat/stream/ — text/event-stream: rag?, token*, error?, meta, done (+ ": ping" heartbeat).
+    Mỗi chunk Ollama chỉ parse 1 lần thành Delta; Turn assistant lưu 1 lần khi stream xong (done có turn_id). History theo ngân sách token (+ summary); ?return_turns=N chặn số turn.
+    """
+    v, err = await _parse(request)
+    if err:
+        return err
+
+    conv = await _get_conversation(v["conv_id"])
+    user_text = v.get("user_text") or ""
+
+    base_system, system_prompt, history = await _context(conv, request)
+    n_prev = await _prior_turns(conv)
+
+    rag_hits = await _retrieve(conv, user_text, v.get("skill_id"), v.get("skill"))
+    ctx = _format_rag_snippet(rag_hits, max_items=int(getattr(conv, "knowledge_limit", 3) or 3)) if rag_hits else ""
+    final_system_prompt = (system_prompt + "\n\n[REFERENCE MATERIALS]\n" + ctx) if ctx else system_prompt
+    scope, cache_hit = await _cache_lookup(conv, base_system, v, user_text)
+
+    # Giành slot LLM trước khi trả 200: quá tải -> 429 thay vì stream lỗi giữa chừng
+    lease = None
+    if not cache_hit:
+        try:
+            lease = await acquire_async("ollama", Priority.STREAM)
+        except GatewayBusy as e:
+            return _busy(e)
+
+    try:
+        if user_text:
+            await ring.aappend(conv.id, await Turn.objects.acreate(conversation=conv, role="user", content=user_text, meta={}))
+
+        if cache_hit:
+            upstream = _replay(cache_hit)
+        else:
+            options = {
+                "temperature": float(getattr(conv, "temperature", 0.4) or 0.4),
+                "num_ctx": 1536,
+                "num_predict": int(getattr(conv, "max_tokens", 300) or 300),
+                "keep_alive": "15m",
+            }
+            if KV_REUSE and user_text.strip():
+                upstream = aiter_llm_ctx(conv.id, system_prompt, history, user_text,
+                                         n_prev=n_prev, refs=ctx, options=options, lease=lease)
+            else:
+                upstream = aiter_llm(final_system_prompt, history, user_text, options=options, lease=lease)
+
+        async def gen():
+            parts: List[str] = []
+            meta_payload: Dict[str, Any] | None = None
+            error = None
+            nxt = None
+            try:
+                # 1) đẩy RAG hits sớm để client render nguồn
+                if rag_hits:
+                    yield _sse("rag", {"hits": _rag_hits_payload(conv, rag_hits)})
+                while True:
+                    if nxt is None:
+                        nxt = asyncio.ensure_future(upstream.__anext__())
+                    done, _ = await asyncio.wait({nxt}, timeout=SSE_HEARTBEAT_S)
+                    if not done:
+                        yield b": ping\n\n"  # comment SSE: giữ kết nối qua proxy, phát hiện client đã ngắt
+                        continue
+                    task, nxt = nxt, None
+                    try:
+                        d = task.result()
+                    except StopAsyncIteration:
+                        break
+                    if d.kind == "token":
+                        parts.append(d.text)
+                        yield _sse("token", {"text": d.text})
+                    elif d.kind == "error":
+                        error = d.text
+                        yield _sse("error", {"detail": d.text})
+                    else:
+                        meta_payload = d.meta
+            finally:
+                # client ngắt -> Django huỷ task response -> huỷ lượt đọc đang chờ + đóng stream HTTP tới Ollama
+                if nxt is not None and not nxt.done():
+                    nxt.cancel()
+                    with contextlib.suppress(BaseException):
+                        await nxt
+                await upstream.aclose()
+                if lease is not None:
+                    lease.release()
+
+            reply_text = "".join(parts).strip()
+            assistant_meta = {
+                **(meta_payload or {"suggestions": ["Bạn muốn đi sâu phần nào tiếp?"], "confidence": 0.7}),
+                "rag": {"used": bool(rag_hits), "hits": _rag_hits_payload(conv, rag_hits)},
+                "pron": {
+                    "expect_text": reply_text,
+                    "score_endpoint": "/api/speech/pron/score/",
+                    "tts_endpoint": "/api/speech/tts/",
+                },
+            }
+            if cache_hit:
+                assistant_meta["cache"] = response_cache.provenance(cache_hit)
+            yield _sse("meta", assistant_meta)
+
+            # lưu Turn assistant đúng 1 lần, sau khi đã có đủ reply
+            turn = None
+            if reply_text:
+                stored_meta = await rag_refs.acompact_meta(assistant_meta, await _generation() if rag_hits else "")
+                turn = await Turn.objects.acreate(conversation=conv, role="assistant", content=reply_text, meta=stored_meta)
+                await ring.aappend(conv.id, turn)
+                if not cache_hit and not error and assistant_meta.get("confidence", 0) >= 0.7:
+                    await _cache_store(scope, user_text, reply_text, turn.id)
+                await amaybe_schedule_summary(conv)
+            yield _sse("done", {"turn_id": turn.id if turn else None})
+
+        # trả slot khi response đóng (kể cả client ngắt trước khi generator kịp chạy)
+        content = ClosingStream(gen(), lease.release) if lease is not None else gen()
+        resp = StreamingHttpResponse(content, content_type="text/event-stream; charset=utf-8")
+        resp["Cache-Control"] = "no-cache"
+        resp["X-Accel-Buffering"] = "no"
+        return resp
+    except BaseException:
+        # lỗi trước khi response kịp nhận lease (tạo Turn, dựng upstream, ...) -> không giữ slot tới hết TTL
+        if lease is not None:
+            lease.release()
+        raise
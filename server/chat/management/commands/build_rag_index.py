@@ -1,29 +1,30 @@
 from django.core.management.base import BaseCommand
 from django.conf import settings
 from pathlib import Path
-import json, numpy as np
 
-from chat.rag.indexer import harvest_docs
-from chat.rag.embedders import make_embedder
+from chat.rag.indexer import build_index
 
 class Command(BaseCommand):
     help = "Build RAG index from lessons into RAG_INDEX_DIR"
 
     def add_arguments(self, parser):
         parser.add_argument('--topics', nargs='*', default=None, help='Topic slugs filter')
+        parser.add_argument('--langs', nargs='*', default=None, help='Language abbreviations filter')
+        parser.add_argument('--batch-size', type=int, default=None, help='Docs per embed() call')
+        parser.add_argument('--chunk-size', type=int, default=None, help='LessonSkill rows per DB fetch')
+        parser.add_argument('--workers', type=int, default=None, help='Processes for block -> text (default: all cores)')
 
     def handle(self, *args, **opts):
         out = Path(getattr(settings, 'RAG_INDEX_DIR', 'rag_index'))
-        out.mkdir(parents=True, exist_ok=True)
 
-        docs, metas = harvest_docs(opts.get('topics'))
-        self.stdout.write(self.style.NOTICE(f"Docs: {len(docs)}"))
-
-        emb = make_embedder()
-        X = emb.encode(docs)  # (N, d)
-
-        (out / "docs.json").write_text(json.dumps(docs, ensure_ascii=False, indent=0), encoding="utf-8")
-        (out / "metas.json").write_text(json.dumps(metas, ensure_ascii=False, indent=0), encoding="utf-8")
-        np.save(out / "embeddings.npy", X.astype("float32"))
+        def progress(p):
+            self.stdout.write(f"  {p['docs']} docs · {p['batches']} batches · {p['docs_per_s']} docs/s "
+                              f"(embed {p['embed_s']}s / {p['elapsed_s']}s)")
 
+        res = build_index(
+            topic_slugs=opts.get('topics'), langs=opts.get('langs'), out_dir=str(out),
+            batch_size=opts.get('batch_size'), chunk_size=opts.get('chunk_size'),
+            workers=opts.get('workers'), progress=progress,
+        )
+        self.stdout.write(self.style.NOTICE(f"Docs: {res['docs']}"))
         self.stdout.write(self.style.SUCCESS(f"Saved to {out}"))
@@ -0,0 +1,52 @@
+import json
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chat.models import Turn
+from chat.services.rag_refs import compact_meta, store
+
+
+def _size(meta) -> int:
+    return len(json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+
+
+class Command(BaseCommand):
+    help = "Chuyển Turn.meta['rag'] cũ (chép nguyên văn tài liệu) sang dạng tham chiếu + bảng RagDocText, theo batch."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--dry-run", action="store_true", help="Chỉ đếm số row / byte tiết kiệm, không ghi")
+
+    def handle(self, *args, **o):
+        last_id, seen, changed, before, after, t0 = 0, 0, 0, 0, 0, time.perf_counter()
+        while True:
+            rows = list(Turn.objects
+                        .filter(id__gt=last_id, role="assistant", meta__has_key="rag")
+                        .order_by("id").only("id", "meta")[:o["batch_size"]])
+            if not rows:
+                break
+            last_id = rows[-1].id
+            seen += len(rows)
+            docs, dirty = [], []
+            for t in rows:
+                meta, new_docs = compact_meta(t.meta)
+                if not new_docs:
+                    continue  # đã là tham chiếu / không có hit
+                before += _size(t.meta)
+                after += _size(meta)
+                t.meta = meta
+                docs += new_docs
+                dirty.append(t)
+            changed += len(dirty)
+            if dirty and not o["dry_run"]:
+                # text lưu trước, meta ghi sau trong cùng transaction: dừng giữa chừng chạy lại được
+                with transaction.atomic():
+                    store(docs)
+                    Turn.objects.bulk_update(dirty, ["meta"])
+            self.stdout.write(f"  {seen} turns scanned, {changed} compacted")
+        self.stdout.write(self.style.SUCCESS(
+            f"{'[dry-run] ' if o['dry_run'] else ''}Compacted {changed}/{seen} turns: "
+            f"meta {before / 1024:.1f} KB -> {after / 1024:.1f} KB in {time.perf_counter() - t0:.1f}s"
+            + ("" if o["dry_run"] else " (VACUUM chat_turn để trả lại dung lượng)")
+        ))
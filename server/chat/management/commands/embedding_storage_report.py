@@ -0,0 +1,113 @@
+import os, random
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.rag.quant import Int8Index, fit_scale, quantize, exact_sims
+
+
+def _mb(n: float) -> str:
+    return f"{n / 1024 / 1024:8.2f} MB"
+
+
+class Command(BaseCommand):
+    help = "Báo cáo kích thước + recall@k: index RAG float32 vs int8 (+rescore) và cột pgvector vector vs halfvec"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queries', type=int, default=200, help='Số vector (lấy từ chính index/DB) dùng làm query')
+        parser.add_argument('--k', type=int, default=6)
+        parser.add_argument('--mult', type=int, nargs='*', default=[1, 2, 4, 8], help='Hệ số shortlist để rescore')
+        parser.add_argument('--skip-local', action='store_true')
+        parser.add_argument('--skip-db', action='store_true')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **o):
+        if not o['skip_local']:
+            self._local(o)
+        if not o['skip_db']:
+            self._db(o)
+
+    def _local(self, o):
+        d = str(getattr(settings, 'RAG_INDEX_DIR', 'rag_index'))
+        path = os.path.join(d, 'embeddings.npy')
+        if not os.path.exists(path):
+            raise CommandError(f'No index at {d}. Run build_rag_index first.')
+        X = np.load(path, mmap_mode='r')
+        n, dim = X.shape
+        q8 = Int8Index.load(d)
+        if q8 is None:  # index cũ: lượng tử hoá tạm trong RAM
+            scale = fit_scale(X)
+            q8 = Int8Index(quantize(np.asarray(X, dtype='float32'), scale), scale)
+        Xf = np.asarray(X, dtype='float32')
+        Xn = Xf / (np.linalg.norm(Xf, axis=1, keepdims=True) + 1e-9)
+        k = min(o['k'], max(1, n - 1))
+        qids = random.Random(o['seed']).sample(range(n), min(o['queries'], n))
+
+        self.stdout.write(f'Local RAG index: {n} docs × {dim}d ({d})')
+        self.stdout.write(f'  float32 matrix  {_mb(Xf.nbytes)}')
+        self.stdout.write(f'  int8 + scale    {_mb(q8.nbytes)}')
+        for mult in o['mult']:
+            rec = []
+            for i in qids:
+                qv = Xf[i]
+                # leave-one-out: bỏ chính doc làm query khỏi cả ground truth lẫn kết quả
+                sims = Xn @ (qv / (np.linalg.norm(qv) + 1e-9))
+                sims[i] = -np.inf
+                truth = set(np.argpartition(-sims, k - 1)[:k].tolist())
+                short = q8.shortlist(qv, k * mult + 1)
+                short = short[short != i]
+                if mult == 1:  # mult=1 ~ không rescore: xếp hạng theo điểm int8
+                    approx = q8.approx_sims(qv, short)
+                    got = short[np.argsort(-approx)][:k]
+                else:
+                    got, _ = exact_sims(Xf, short, qv)
+                    got = got[:k]
+                rec.append(len(truth & set(got.tolist())) / k)
+            label = 'int8 only      ' if mult == 1 else f'int8 rescore ×{mult:<2}'
+            self.stdout.write(f'  {label} recall@{k}={np.mean(rec):.4f}')
+
+    def _db(self, o):
+        from django.db import connection
+        from pgvector import HalfVector
+        from pgvector.django import CosineDistance
+        from languages.models import RoleplayBlock, RoleplayScenario
+        from languages.services.vector_search import exact_scan
+
+        k = o['k']
+        for Model in (RoleplayScenario, RoleplayBlock):
+            table = Model._meta.db_table
+            with connection.cursor() as cur:
+                cur.execute(
+                    f'SELECT count(*), count(embedding_half), '
+                    f'coalesce(sum(pg_column_size(embedding)), 0), coalesce(sum(pg_column_size(embedding_half)), 0) '
+                    f'FROM {table} WHERE embedding IS NOT NULL'
+                )
+                rows, halves, full_b, half_b = cur.fetchone()
+                idx = {}
+                for ix in Model._meta.indexes:
+                    if ix.name.endswith('_hnsw'):
+                        cur.execute('SELECT coalesce(pg_relation_size(to_regclass(%s)), 0)', [ix.name])
+                        idx[ix.name] = cur.fetchone()[0]
+            self.stdout.write(f'{Model.__name__}: {rows} embedded rows, {halves} with halfvec')
+            self.stdout.write(f'  vector  column {_mb(full_b)}   halfvec column {_mb(half_b)}')
+            for name, size in idx.items():
+                self.stdout.write(f'  index {name:<22} {_mb(size)}')
+            if not halves:
+                self.stdout.write('  (run backfill_halfvec to measure halfvec recall)')
+                continue
+
+            base = Model.objects.exclude(embedding__isnull=True).exclude(embedding_half__isnull=True)
+            ids = list(base.values_list('pk', flat=True))
+            random.Random(o['seed']).shuffle(ids)
+            vecs = [list(v) for v in base.filter(pk__in=ids[:o['queries']]).values_list('embedding', flat=True)]
+            for mult in o['mult']:
+                rec = []
+                for v in vecs:
+                    with exact_scan():
+                        truth = set(base.order_by(CosineDistance('embedding', v)).values_list('pk', flat=True)[:k])
+                        short = list(base.order_by(CosineDistance('embedding_half', HalfVector(v)))
+                                     .values_list('pk', flat=True)[:k * mult])
+                    got = (base.filter(pk__in=short).order_by(CosineDistance('embedding', v))
+                           .values_list('pk', flat=True)[:k])
+                    rec.append(len(truth & set(got)) / max(1, len(truth)))
+                self.stdout.write(f'  halfvec rescore ×{mult:<2} recall@{k}={np.mean(rec):.4f}')
@@ -18,6 +18,10 @@ class Conversation(models.Model):
     # mission = models.TextField(blank=True, default="")          
     # specified_task = models.TextField(blank=True, default="")    
     # context = models.JSONField(blank=True, default=list) 
+    # rolling summary của các turn cũ (chat.update_summary); turn id <= summary_upto đã nằm trong summary
+    summary = models.TextField(blank=True, default="")
+    summary_upto = models.BigIntegerField(default=0)
+    summary_updated_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
 
@@ -30,9 +34,21 @@ class Turn(models.Model):
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='turns')
     role = models.CharField(max_length=10, choices=ROLE_CHOICES)
     content = models.TextField()
+    # meta["rag"] chỉ giữ tham chiếu {generation, hits: [{id, score, sha}]}; nội dung tài liệu nằm ở RagDocText
     meta = models.JSONField(default=dict, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
 
     class Meta:
         ordering = ['id']
+        indexes = [
+            models.Index(fields=['conversation', 'id'], name='turn_conv_id_idx'),  # đuôi hội thoại / ring miss
+        ]
+
+
+class RagDocText(models.Model):
+    """Nội dung tài liệu RAG đã trích cho câu trả lời, địa chỉ theo nội dung (sha256 của text + meta) -> lưu 1 lần."""
+    sha = models.CharField(max_length=64, primary_key=True)
+    text = models.TextField()
+    meta = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
@@ -0,0 +1,113 @@
+from __future__ import annotations
+from typing import Dict, List, Optional, Iterable
+import hashlib, json, logging, re, unicodedata
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+
+log = logging.getLogger(__name__)
+
+# Cache kết quả truy hồi RAG (top-k doc id + score), dùng chung giữa các worker.
+# Key gồm generation của index -> build lại index là key cũ tự "hết hạn", không cần xoá.
+CACHE_ALIAS = getattr(settings, "RAG_CACHE_ALIAS", "shared")
+CACHE_TTL = int(getattr(settings, "RAG_CACHE_TTL", 60 * 60 * 6))
+ENABLED = bool(getattr(settings, "RAG_CACHE_ENABLED", True))
+
+_PREFIX = "rag:ret:"
+_STATS = ("hits", "misses", "saved_ms", "miss_ms")
+
+
+def _backend():
+    try:
+        return caches[CACHE_ALIAS]
+    except InvalidCacheBackendError:
+        return caches["default"]
+
+
+def normalize_query(q: str | None) -> str:
+    s = unicodedata.normalize("NFKC", q or "").lower()
+    s = re.sub(r"[\"'“”‘’?!.,;:()\[\]]+", " ", s)
+    return re.sub(r"\s+", " ", s).strip()
+
+
+def _ids(xs: Optional[Iterable]) -> Optional[List[str]]:
+    return sorted({str(x) for x in xs}) if xs else None
+
+
+def make_key(query: str, top_k: int, mode: str, generation: str, **filters) -> str:
+    # chỉ các filter RagIndex._build_mask thực sự áp dụng; filter khác không đổi kết quả -> không tách key
+    raw = json.dumps({
+        "q": normalize_query(query),
+        "k": int(top_k),
+        "mode": mode,
+        "gen": generation,
+        "language": filters.get("language") or None,
+        "topics": _ids(filters.get("topics")),
+        "lessons": _ids(filters.get("lessons")),
+        "skills": _ids(filters.get("skills")),
+    }, sort_keys=True, ensure_ascii=False)
+    return _PREFIX + hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def lookup(key: str) -> Optional[List[Dict]]:
+    if not ENABLED:
+        return None
+    try:
+        return _backend().get(key)
+    except Exception as e:  # Redis down -> coi như miss
+        log.warning("RAG cache get failed: %s", e)
+        return None
+
+
+def store(key: str, hits: List[Dict]) -> None:
+    if not ENABLED:
+        return
+    try:
+        _backend().set(key, hits, CACHE_TTL)
+    except Exception as e:
+        log.warning("RAG cache set failed: %s", e)
+
+
+def _incr(name: str, n: int = 1) -> None:
+    c = _backend()
+    key = f"{_PREFIX}stats:{name}"
+    try:
+        c.incr(key, n)
+    except ValueError:  # chưa có key
+        c.add(key, 0, None)
+        c.incr(key, n)
+
+
+def record(hit: bool, elapsed_ms: float) -> None:
+    """
+    Cộng dồn thống kê. saved_ms của 1 hit = thời gian trung bình 1 lần miss - thời gian hit.
+    """
+    if not ENABLED:
+        return
+    try:
+        if hit:
+            st = stats()
+            avg_miss = st["avg_miss_ms"]
+            _incr("hits")
+            if avg_miss > elapsed_ms:
+                _incr("saved_ms", int(round(avg_miss - elapsed_ms)))
+        else:
+            _incr("misses")
+            _incr("miss_ms", int(round(elapsed_ms)))
+    except Exception as e:
+        log.debug("RAG cache stats failed: %s", e)
+
+
+def stats() -> Dict:
+    vals = _backend().get_many([f"{_PREFIX}stats:{n}" for n in _STATS])
+    hits, misses, saved_ms, miss_ms = (int(vals.get(f"{_PREFIX}stats:{n}") or 0) for n in _STATS)
+    total = hits + misses
+    return {
+        "enabled": ENABLED,
+        "backend": CACHE_ALIAS,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / total, 4) if total else 0.0,
+        "saved_ms": saved_ms,
+        "avg_miss_ms": round(miss_ms / misses, 2) if misses else 0.0,
+    }
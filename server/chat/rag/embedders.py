@@ -1,5 +1,5 @@
-from typing import List
-import numpy as np, httpx
+from typing import List, Optional
+import numpy as np
 from django.conf import settings
 
 class SentenceTransformersEmbedder:
@@ -9,6 +9,10 @@ class SentenceTransformersEmbedder:
     def encode(self, texts: List[str]) -> np.ndarray:
         X = self.m.encode(texts, normalize_embeddings=True)
         return np.asarray(X, dtype="float32")
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        return self.encode(list(texts))
+    def embed_query(self, text: str) -> np.ndarray:
+        return self.encode([text])[0]
 
 class OllamaEmbedder:
     def __init__(self, base_url=None, model=None, timeout=60.0):
@@ -16,16 +20,38 @@ class OllamaEmbedder:
         self.model = model or settings.RAG_OLLAMA_EMBED_MODEL
         self.timeout = timeout
     def encode(self, texts: List[str]) -> np.ndarray:
-        vs = []
-        with httpx.Client(timeout=self.timeout) as client:
-            for t in texts:
-                r = client.post(f"{self.base}/api/embeddings", json={"model": self.model, "prompt": t})
-                r.raise_for_status()
-                v = r.json().get("embedding", [])
-                vs.append(v)
-        X = np.asarray(vs, dtype="float32")
+        # client dùng chung (pool + batch /api/embed) với languages.services.ollama_client
+        from languages.services.ollama_client import get_client
+        X = get_client(self.base, self.model).embed_matrix(texts, dim=None)
         X /= (np.linalg.norm(X, axis=1, keepdims=True) + 1e-9)
         return X
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        return self.encode(list(texts))
+    def embed_query(self, text: str) -> np.ndarray:
+        return self.encode([text])[0]
+
+class OnnxEmbedder:
+    """onnxruntime CPU trong process (languages.services.onnx_embedder), dùng chung session + micro-batching."""
+    def encode(self, texts: List[str]) -> np.ndarray:
+        from languages.services.onnx_embedder import get_onnx_embedder
+        return get_onnx_embedder().embed_matrix(texts, dim=None)
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        return self.encode(list(texts))
+    def embed_query(self, text: str) -> np.ndarray:
+        return self.encode([text])[0]
 
 def make_embedder():
-    return SentenceTransformersEmbedder() if settings.RAG_EMBED_BACKEND == "st" else OllamaEmbedder()
+    backend = settings.RAG_EMBED_BACKEND
+    if backend == "st":
+        return SentenceTransformersEmbedder()
+    if backend == "onnx":
+        return OnnxEmbedder()
+    return OllamaEmbedder()
+
+# Dùng chung 1 embedder / process (load model ST tốn vài giây)
+_EMBEDDER: Optional[object] = None
+def get_embedder():
+    global _EMBEDDER
+    if _EMBEDDER is None:
+        _EMBEDDER = make_embedder()
+    return _EMBEDDER
@@ -1,16 +1,28 @@
 from __future__ import annotations
-from typing import List, Dict, Tuple, Iterable
-import os, json, re
+from typing import List, Dict, Tuple, Iterable, Iterator, Callable, Optional
+from collections import deque
+import os, json, re, time, uuid, logging
 import numpy as np
 from django.conf import settings
+from .lexical import BM25Builder, BM25_FILE
+from .quant import write_q8, Q8_FILE, SCALE_FILE
+
+log = logging.getLogger(__name__)
 
 # ---- Embedding backend hook ----
 #   get_embedder() -> object có .embed_texts(list[str]) -> np.ndarray, .embed_query(str) -> np.ndarray
 try:
-    from .embedders import get_embedder  
+    from .embedders import get_embedder
 except Exception:  # fallback: sẽ raise rõ ràng khi gọi build_index
     get_embedder = None
 
+# ---- Tham số build (override qua settings) ----
+HARVEST_CHUNK_SIZE = int(getattr(settings, "RAG_HARVEST_CHUNK_SIZE", 500))   # số LessonSkill / 1 lần fetch DB
+HARVEST_WORKERS = int(getattr(settings, "RAG_HARVEST_WORKERS", 0) or (os.cpu_count() or 1))
+EMBED_BATCH_SIZE = int(getattr(settings, "RAG_EMBED_BATCH_SIZE", 256))      # số doc / 1 lần encode()
+BM25_SPILL_POSTINGS = int(getattr(settings, "RAG_BM25_SPILL_POSTINGS", 2_000_000))  # posting BM25 giữ trong RAM khi build
+_SKILLS_PER_TASK = 32  # gom nhiều skill vào 1 task để giảm chi phí IPC
+
 
 # ---- Utils ----
 def _norm(s: str | None) -> str:
@@ -35,12 +47,192 @@ def block_to_text(b: Dict) -> str:
     if t == "speaking":
         return f"[speak] {b.get('prompt','')}"
     if t == "reading":
-        return f"[read] {b.get('prompt','')}"
+        ans = b.get("answer")
+        return f"[read] {b.get('prompt','')}" + (f" ans={ans}" if ans else "")
+    if t == "writing":
+        return f"[write] {b.get('prompt','')} => {b.get('answer','')}"
     # generic / quiz:
     return json.dumps(b, ensure_ascii=False)
 
 
-# ---- Harvest docs theo schema mới: Topic -> Lesson -> LessonSkill(order) -> Skill(content.blocks) ----
+def _skill_blocks(skill) -> List[Dict]:
+    """
+    Dựng lại list block (shape cũ của Skill.content["blocks"]) từ các bảng nội dung của Skill.
+    Các quan hệ đã được prefetch theo từng chunk nên không phát sinh query.
+    """
+    legacy = getattr(skill, "content", None)
+    if isinstance(legacy, dict) and legacy.get("blocks"):
+        return list(legacy["blocks"])
+
+    blocks: List[Dict] = []
+    for q in skill.quiz_questions.all():
+        choices = list(q.choices.all())
+        blocks.append({
+            "type": "multiple_choice",
+            "prompt": q.question_text,
+            "choices": [c.text for c in choices],
+            "answer": next((c.text for c in choices if c.is_correct), ""),
+        })
+    for g in skill.fillgaps.all():
+        blocks.append({"type": "fillgap", "prompt": g.text, "answer": g.answer})
+    items = list(skill.ordering_items.all())
+    if items:
+        blocks.append({
+            "type": "ordering",
+            "tokens": [it.text for it in items],
+            "answer": [it.text for it in sorted(items, key=lambda it: it.order_index)],
+        })
+    pairs = list(skill.matching_pairs.all())
+    if pairs:
+        blocks.append({"type": "matching", "pairs": [[p.left_text, p.right_text] for p in pairs]})
+    for p in skill.pronunciation_prompts.all():
+        blocks.append({"type": "pron", "prompt": p.word})
+    for p in skill.listening_prompts.all():
+        blocks.append({"type": "listening", "prompt": p.question_text, "answer": p.answer})
+    for p in skill.speaking_prompts.all():
+        blocks.append({"type": "speaking", "prompt": p.target or p.text})
+    rc = getattr(skill, "reading_content", None)
+    if rc is not None and rc.passage:
+        blocks.append({"type": "reading", "prompt": rc.passage})
+    for q in skill.reading_questions.all():
+        blocks.append({"type": "reading", "prompt": q.question_text, "answer": q.answer})
+    for w in skill.writing_questions.all():
+        blocks.append({"type": "writing", "prompt": w.prompt, "answer": w.answer})
+    return blocks
+
+
+def _skill_to_docs(payload: Dict) -> List[Tuple[str, Dict]]:
+    """Chạy trong worker: payload thuần (dict) -> [(doc, meta), ...]."""
+    out: List[Tuple[str, Dict]] = []
+    for idx, b in enumerate(payload["blocks"], start=1):
+        text_parts = [
+            f"[{payload['language']}]",
+            f"Topic: {payload['topic_title']}",
+            f"Lesson {payload['lesson_order']}: {payload['lesson_title']}",
+            f"Skill {payload['skill_type']}: {payload['skill_title']}",
+            block_to_text(b),
+        ]
+        txt = _norm(" | ".join(map(_norm, text_parts)))
+        out.append((txt, {
+            "language": payload["language"],
+            "topic_slug": payload["topic_slug"],
+            "topic_title": payload["topic_title"],
+            "lesson_id": payload["lesson_id"],
+            "lesson_order": payload["lesson_order"],
+            "lesson_title": payload["lesson_title"],
+            "skill_id": payload["skill_id"],
+            "skill_type": payload["skill_type"],
+            "skill_title": payload["skill_title"],
+            "block_index": idx,
+            "block_type": (b or {}).get("type"),
+        }))
+    return out
+
+def _chunk_to_docs(payloads: List[Dict]) -> List[Tuple[str, Dict]]:
+    out: List[Tuple[str, Dict]] = []
+    for p in payloads:
+        out.extend(_skill_to_docs(p))
+    return out
+
+
+def _ordered_pool_map(fn: Callable, items: Iterable, workers: int, window: int) -> Iterator:
+    """
+    Như Executor.map nhưng chỉ giữ tối đa `window` task đang chờ (map() gốc submit hết iterable
+    ngay từ đầu -> mất tính streaming). Giữ nguyên thứ tự đầu vào.
+    """
+    import multiprocessing
+    if workers <= 1 or multiprocessing.current_process().daemon:
+        # daemon process (vd: celery prefork worker) không được tạo process con
+        for it in items:
+            yield fn(it)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        pending: deque = deque()
+        for it in items:
+            pending.append(ex.submit(fn, it))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _batched(it: Iterable, size: int) -> Iterator[List]:
+    buf: List = []
+    for x in it:
+        buf.append(x)
+        if len(buf) >= size:
+            yield buf
+            buf = []
+    if buf:
+        yield buf
+
+
+# ---- Harvest docs theo schema mới: Topic -> Lesson -> LessonSkill(order) -> Skill(nội dung) ----
+def _skill_payloads(topic_slugs: Iterable[str] | None,
+                    langs: Iterable[str] | None,
+                    only_active_skills: bool,
+                    chunk_size: int) -> Iterator[Dict]:
+    """
+    1 query duy nhất cho mọi topic (LessonSkill join Lesson/Topic/Language/Skill), đọc theo
+    iterator(chunk_size) -> bộ nhớ chỉ phụ thuộc chunk_size. Quan hệ nội dung skill được
+    prefetch theo từng chunk.
+    """
+    from languages.models import LessonSkill  # import bên trong để tránh vòng lặp import
+
+    qs = LessonSkill.objects.select_related(
+        "lesson__topic__language", "skill", "skill__reading_content",
+    ).prefetch_related(
+        "skill__quiz_questions__choices", "skill__fillgaps", "skill__ordering_items",
+        "skill__matching_pairs", "skill__pronunciation_prompts", "skill__listening_prompts",
+        "skill__speaking_prompts", "skill__reading_questions", "skill__writing_questions",
+    )
+    if topic_slugs:
+        qs = qs.filter(lesson__topic__slug__in=list(topic_slugs))
+    if langs:
+        qs = qs.filter(lesson__topic__language__abbreviation__in=list(langs))
+    if only_active_skills:
+        qs = qs.filter(skill__is_active=True)
+    qs = qs.order_by("lesson__topic__order", "lesson__topic_id",
+                     "lesson__order", "lesson_id", "order", "id")
+
+    for ls in qs.iterator(chunk_size=chunk_size):
+        blocks = _skill_blocks(ls.skill)
+        if not blocks:
+            continue
+        t, s, lesson = ls.lesson.topic, ls.skill, ls.lesson
+        yield {
+            "language": t.language.abbreviation,  # ví dụ "en" / "vi"
+            "topic_slug": t.slug,
+            "topic_title": t.title,
+            "lesson_id": lesson.id,
+            "lesson_order": lesson.order,
+            "lesson_title": lesson.title,
+            "skill_id": s.id,
+            "skill_type": s.type,
+            "skill_title": s.title,
+            "blocks": blocks,
+        }
+
+
+def iter_docs(topic_slugs: Iterable[str] | None = None,
+              langs: Iterable[str] | None = None,
+              only_active_skills: bool = True,
+              *,
+              chunk_size: int | None = None,
+              workers: int | None = None) -> Iterator[Tuple[str, Dict]]:
+    """
+    Streaming harvest: yield (doc, meta) theo đúng thứ tự Topic -> Lesson -> Skill -> block.
+    Chuyển block -> text chạy trong process pool (`workers`, mặc định = số core).
+    """
+    chunk_size = chunk_size or HARVEST_CHUNK_SIZE
+    workers = HARVEST_WORKERS if workers is None else workers
+    payloads = _skill_payloads(topic_slugs, langs, only_active_skills, chunk_size)
+    tasks = _batched(payloads, _SKILLS_PER_TASK)
+    for pairs in _ordered_pool_map(_chunk_to_docs, tasks, workers, window=max(2, workers * 2)):
+        yield from pairs
+
+
 def harvest_docs(topic_slugs: Iterable[str] | None = None,
                  langs: Iterable[str] | None = None,
                  only_active_skills: bool = True) -> Tuple[List[str], List[Dict]]:
@@ -48,76 +240,13 @@ def harvest_docs(topic_slugs: Iterable[str] | None = None,
     Trả về: (docs: List[str], metas: List[dict])
     - docs: text để embed
     - metas: metadata để filter lúc truy hồi
+    Giữ cho code cũ; build index nên dùng iter_docs() để không gom hết vào RAM.
     """
-    from languages.models import Topic, Lesson, LessonSkill, Skill  # import bên trong để tránh vòng lặp import
-
-    qs_topic = Topic.objects.select_related("language")
-    if topic_slugs:
-        qs_topic = qs_topic.filter(slug__in=list(topic_slugs))
-    if langs:
-        qs_topic = qs_topic.filter(language__abbreviation__in=list(langs))
-
-    # Prefetch lessons trước
-    lessons_by_topic = {}
-    for t in qs_topic:
-        lessons_by_topic[t.id] = list(
-            Lesson.objects.filter(topic=t).order_by("order", "id").only(
-                "id", "title", "order", "topic_id"
-            )
-        )
-
-    # Prefetch through + skills (giữ thứ tự theo LessonSkill.order)
-    # NOTE: với nhiều topic, ta gom lesson_ids để query 1 lần
-    all_lesson_ids: List[int] = [ls.id for L in lessons_by_topic.values() for ls in L]
-    through_qs = []
-    if all_lesson_ids:
-        base = (LessonSkill.objects
-                .filter(lesson_id__in=all_lesson_ids)
-                .select_related("lesson", "skill")
-                .order_by("lesson__order", "lesson__id", "order", "id"))
-        if only_active_skills:
-            base = base.filter(skill__is_active=True)
-        through_qs = list(base.only("lesson_id", "skill_id", "order",
-                                    "skill__id", "skill__title", "skill__type",
-                                    "skill__content", "skill__language_code"))
-
-    # Gom theo lesson_id
-    skills_by_lesson: Dict[int, List] = {}
-    for ls in through_qs:
-        skills_by_lesson.setdefault(ls.lesson_id, []).append(ls.skill)
-
     docs: List[str] = []
     metas: List[Dict] = []
-
-    # Duyệt Topic -> Lesson -> Skill -> blocks
-    for t in qs_topic:
-        lang_abbr = t.language.abbreviation  # ví dụ "en" / "vi"
-        for ls in lessons_by_topic.get(t.id, []):
-            for s in skills_by_lesson.get(ls.id, []):
-                blocks = (s.content or {}).get("blocks", [])
-                for idx, b in enumerate(blocks, start=1):
-                    text_parts = [
-                        f"[{lang_abbr}]",
-                        f"Topic: {t.title}",
-                        f"Lesson {ls.order}: {ls.title}",
-                        f"Skill {s.type}: {s.title}",
-                        block_to_text(b),
-                    ]
-                    txt = _norm(" | ".join(map(_norm, text_parts)))
-                    docs.append(txt)
-                    metas.append({
-                        "language": lang_abbr,
-                        "topic_slug": t.slug,
-                        "topic_title": t.title,
-                        "lesson_id": ls.id,
-                        "lesson_order": ls.order,
-                        "lesson_title": ls.title,
-                        "skill_id": s.id,
-                        "skill_type": s.type,
-                        "skill_title": s.title,
-                        "block_index": idx,
-                        "block_type": (b or {}).get("type"),
-                    })
+    for doc, meta in iter_docs(topic_slugs, langs, only_active_skills):
+        docs.append(doc)
+        metas.append(meta)
     return docs, metas
 
 
@@ -126,13 +255,13 @@ def _index_dir() -> str:
     return getattr(settings, "RAG_INDEX_DIR", os.path.join(settings.BASE_DIR, "rag_index"))
 
 def save_index(docs: List[str], metas: List[Dict], embs: np.ndarray, out_dir: str | None = None) -> None:
-    out = out_dir or _index_dir()
-    os.makedirs(out, exist_ok=True)
-    with open(os.path.join(out, "docs.json"), "w", encoding="utf-8") as f:
-        json.dump(docs, f, ensure_ascii=False)
-    with open(os.path.join(out, "metas.json"), "w", encoding="utf-8") as f:
-        json.dump(metas, f, ensure_ascii=False)
-    np.save(os.path.join(out, "embeddings.npy"), embs)
+    w = IndexWriter(out_dir)
+    try:
+        w.add(docs, metas, embs)
+        w.close()
+    except Exception:
+        w.abort()
+        raise
 
 def load_index(in_dir: str | None = None) -> Tuple[List[str], List[Dict], np.ndarray]:
     src = in_dir or _index_dir()
@@ -144,20 +273,157 @@ def load_index(in_dir: str | None = None) -> Tuple[List[str], List[Dict], np.nda
     return docs, metas, embs
 
 
+class IndexWriter:
+    """
+    Ghi index ra đĩa theo từng batch (không giữ toàn bộ docs/vectors trong RAM):
+      - docs.json / metas.json: ghi dần thành JSON array
+      - embeddings: append float32 thô, cuối cùng chuyển sang .npy bằng memmap
+      - bm25.npz: inverted index BM25 dựng song song từ cùng docs (posting spill ra bm25_runs.tmp/ rồi gộp)
+      - embeddings_q8.npy + q8_scale.npy: bản int8 (scale theo chiều) cho RAG_QUANTIZE=int8
+      - manifest.json: generation mới (ghi cuối cùng) -> retriever/cache biết index đã đổi
+    Ghi vào file *.tmp rồi os.replace -> index đang phục vụ không bị đọc dở.
+    """
+    def __init__(self, out_dir: str | None = None):
+        self.out = str(out_dir or _index_dir())
+        os.makedirs(self.out, exist_ok=True)
+        self.count = 0
+        self.dim = 0
+        self.generation = ""
+        self._docs = open(self._tmp("docs.json"), "w", encoding="utf-8")
+        self._metas = open(self._tmp("metas.json"), "w", encoding="utf-8")
+        self._raw = open(self._tmp("embeddings.f32"), "wb")
+        self._bm25 = BM25Builder(spill_dir=self._tmp("bm25_runs"), spill_postings=BM25_SPILL_POSTINGS)
+        self._docs.write("[")
+        self._metas.write("[")
+
+    def _tmp(self, name: str) -> str:
+        return os.path.join(self.out, name + ".tmp")
+
+    def add(self, docs: List[str], metas: List[Dict], embs: np.ndarray) -> None:
+        X = np.asarray(embs, dtype="float32")
+        if X.ndim != 2 or X.shape[0] != len(docs) or len(docs) != len(metas):
+            raise ValueError(f"Batch mismatch: docs={len(docs)} metas={len(metas)} embs={X.shape}")
+        if self.dim and X.shape[1] != self.dim:
+            raise ValueError(f"Embedding dim changed mid-build: {self.dim} -> {X.shape[1]}")
+        self.dim = int(X.shape[1])
+        for d, m in zip(docs, metas):
+            sep = "," if self.count else ""
+            self._docs.write(sep + json.dumps(d, ensure_ascii=False))
+            self._metas.write(sep + json.dumps(m, ensure_ascii=False))
+            self.count += 1
+        self._raw.write(np.ascontiguousarray(X).tobytes())
+        self._bm25.add(docs)
+
+    def close(self) -> None:
+        self._docs.write("]"); self._docs.close()
+        self._metas.write("]"); self._metas.close()
+        self._raw.close()
+
+        raw_path = self._tmp("embeddings.f32")
+        npy_tmp = self._tmp("embeddings.npy")
+        src = (np.memmap(raw_path, dtype="float32", mode="r", shape=(self.count, self.dim))
+               if self.count else np.zeros((0, self.dim), dtype="float32"))
+        dst = np.lib.format.open_memmap(npy_tmp, mode="w+", dtype="float32", shape=(self.count, self.dim))
+        step = max(1, EMBED_BATCH_SIZE * 16)
+        for i in range(0, self.count, step):
+            dst[i:i + step] = src[i:i + step]
+        dst.flush()
+        # bản int8 (RAG_QUANTIZE=int8) ghi luôn cùng lượt -> đổi chế độ không cần build lại
+        write_q8(dst, self._tmp(Q8_FILE), self._tmp(SCALE_FILE))
+        del src, dst
+        os.remove(raw_path)
+        self._bm25.save(self._tmp(BM25_FILE))
+
+        os.replace(self._tmp(BM25_FILE), os.path.join(self.out, BM25_FILE))
+        os.replace(self._tmp(Q8_FILE), os.path.join(self.out, Q8_FILE))
+        os.replace(self._tmp(SCALE_FILE), os.path.join(self.out, SCALE_FILE))
+        os.replace(npy_tmp, os.path.join(self.out, "embeddings.npy"))
+        os.replace(self._tmp("metas.json"), os.path.join(self.out, "metas.json"))
+        os.replace(self._tmp("docs.json"), os.path.join(self.out, "docs.json"))
+
+        self.generation = f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+        with open(self._tmp("manifest.json"), "w", encoding="utf-8") as f:
+            json.dump({"generation": self.generation, "docs": self.count, "dim": self.dim}, f)
+        os.replace(self._tmp("manifest.json"), os.path.join(self.out, "manifest.json"))
+
+    def abort(self) -> None:
+        for f in (self._docs, self._metas, self._raw):
+            try:
+                f.close()
+            except Exception:
+                pass
+        self._bm25.cleanup()
+        for name in ("docs.json", "metas.json", "embeddings.f32", "embeddings.npy", BM25_FILE,
+                     Q8_FILE, SCALE_FILE, "manifest.json"):
+            try:
+                os.remove(self._tmp(name))
+            except OSError:
+                pass
+
+
+class BuildProgress:
+    """Đếm doc/batch + throughput; gọi callback (nếu có) sau mỗi batch."""
+    def __init__(self, callback: Optional[Callable[[Dict], None]] = None):
+        self.callback = callback
+        self.t0 = time.perf_counter()
+        self.docs = 0
+        self.batches = 0
+        self.embed_s = 0.0
+
+    def snapshot(self) -> Dict:
+        elapsed = time.perf_counter() - self.t0
+        return {
+            "docs": self.docs,
+            "batches": self.batches,
+            "elapsed_s": round(elapsed, 2),
+            "embed_s": round(self.embed_s, 2),
+            "docs_per_s": round(self.docs / elapsed, 1) if elapsed > 0 else 0.0,
+        }
+
+    def step(self, n_docs: int, embed_s: float) -> None:
+        self.docs += n_docs
+        self.batches += 1
+        self.embed_s += embed_s
+        snap = self.snapshot()
+        log.info("rag build: %(docs)d docs, %(batches)d batches, %(docs_per_s).1f docs/s", snap)
+        if self.callback:
+            self.callback(snap)
+
+
 def build_index(topic_slugs: Iterable[str] | None = None,
                 langs: Iterable[str] | None = None,
-                out_dir: str | None = None) -> Dict:
+                out_dir: str | None = None,
+                *,
+                batch_size: int | None = None,
+                chunk_size: int | None = None,
+                workers: int | None = None,
+                progress: Optional[Callable[[Dict], None]] = None) -> Dict:
     """
-    Thu hoạch -> embed -> lưu index.
+    Thu hoạch (streaming) -> embed theo batch cố định -> ghi thẳng xuống đĩa.
+    Bộ nhớ ~ O(batch_size), không phụ thuộc kích thước catalog.
     """
-    docs, metas = harvest_docs(topic_slugs=topic_slugs, langs=langs)
-    if not docs:
-        return {"docs": 0, "dim": 0, "note": "no docs"}
-
     if get_embedder is None:
         raise RuntimeError("No embedding backend. Please provide embedders.get_embedder().")
 
     embedder = get_embedder()
-    vectors = embedder.embed_texts(docs)  # (N, D) np.ndarray
-    save_index(docs, metas, vectors, out_dir=out_dir)
-    return {"docs": len(docs), "dim": int(vectors.shape[1])}
+    batch_size = batch_size or EMBED_BATCH_SIZE
+    prog = BuildProgress(progress)
+    writer = IndexWriter(out_dir)
+    try:
+        pairs = iter_docs(topic_slugs, langs, chunk_size=chunk_size, workers=workers)
+        for batch in _batched(pairs, batch_size):
+            docs = [d for d, _ in batch]
+            metas = [m for _, m in batch]
+            t = time.perf_counter()
+            vectors = embedder.embed_texts(docs)  # (B, D) np.ndarray
+            dt = time.perf_counter() - t
+            writer.add(docs, metas, vectors)
+            prog.step(len(docs), dt)
+        if not writer.count:
+            writer.abort()
+            return {"docs": 0, "dim": 0, "note": "no docs"}
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    return {"docs": writer.count, "dim": writer.dim, "generation": writer.generation, **prog.snapshot()}
@@ -0,0 +1,188 @@
+from __future__ import annotations
+from typing import List, Dict, Optional, Iterable, Tuple
+from array import array
+import os, re, shutil
+import numpy as np
+
+# BM25 (Okapi) in-process: inverted index dạng CSR, lưu cùng thư mục với index vector.
+#   terms   : (V,)  từ vựng đã sort
+#   indptr  : (V+1,) posting của term i nằm ở [indptr[i], indptr[i+1])
+#   doc_ids : (P,)  doc chứa term
+#   tfs     : (P,)  tần suất term trong doc
+#   doc_len : (N,)  số token mỗi doc
+
+BM25_FILE = "bm25.npz"
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str | None) -> List[str]:
+    return _TOKEN_RE.findall((text or "").lower())
+
+
+class BM25Builder:
+    """
+    Nạp doc theo từng batch (cùng nhịp với IndexWriter), không cần giữ text.
+    spill_dir: posting trong RAM vượt spill_postings -> ghi thành 1 run (.npy, cùng dạng CSR) vào spill_dir rồi xả
+    RAM; arrays() gộp các run (đọc mmap) thẳng vào mảng kết quả. Đỉnh RAM ~ 1 run + mảng CSR cuối (8 byte/posting)
+    thay vì mảng Python theo từng term cho cả corpus. spill_dir=None -> giữ hết trong RAM (index nhỏ, from_docs).
+    """
+    def __init__(self, spill_dir: Optional[str] = None, spill_postings: int = 2_000_000):
+        self._vocab: Dict[str, int] = {}
+        self._postings: List[Tuple[array, array]] = []
+        self._doc_len = array("I")
+        self._buffered = 0
+        self._spill_dir, self._spill_postings = spill_dir, max(1, int(spill_postings))
+        self._runs: List[str] = []
+
+    def add(self, docs: Iterable[str]) -> None:
+        for doc in docs:
+            did = len(self._doc_len)
+            toks = tokenize(doc)
+            self._doc_len.append(len(toks))
+            tf: Dict[str, int] = {}
+            for t in toks:
+                tf[t] = tf.get(t, 0) + 1
+            for t, c in tf.items():
+                tid = self._vocab.get(t)
+                if tid is None:
+                    tid = self._vocab[t] = len(self._postings)
+                    self._postings.append((array("I"), array("I")))
+                ids, cnts = self._postings[tid]
+                ids.append(did)
+                cnts.append(c)
+            self._buffered += len(tf)
+        if self._spill_dir and self._buffered >= self._spill_postings:
+            self._spill()
+
+    def _buffer_arrays(self) -> Dict[str, np.ndarray]:
+        terms = sorted(self._vocab)
+        indptr = np.zeros(len(terms) + 1, dtype="int64")
+        for i, t in enumerate(terms):
+            indptr[i + 1] = indptr[i] + len(self._postings[self._vocab[t]][0])
+        doc_ids = np.empty(int(indptr[-1]), dtype="int32")
+        tfs = np.empty(int(indptr[-1]), dtype="int32")
+        for i, t in enumerate(terms):
+            ids, cnts = self._postings[self._vocab[t]]
+            doc_ids[indptr[i]:indptr[i + 1]] = np.frombuffer(ids, dtype="uint32")
+            tfs[indptr[i]:indptr[i + 1]] = np.frombuffer(cnts, dtype="uint32")
+        return {"terms": np.array(terms, dtype=str), "indptr": indptr, "doc_ids": doc_ids, "tfs": tfs}
+
+    def _spill(self) -> None:
+        os.makedirs(self._spill_dir, exist_ok=True)
+        run = os.path.join(self._spill_dir, f"run{len(self._runs):05d}")
+        for k, v in self._buffer_arrays().items():
+            np.save(f"{run}.{k}.npy", v)
+        self._runs.append(run)
+        self._vocab, self._postings, self._buffered = {}, [], 0
+
+    def _merge(self) -> Dict[str, np.ndarray]:
+        """Gộp các run: doc id tăng dần theo run -> nối posting từng term theo thứ tự run vẫn đúng thứ tự doc."""
+        runs = [{k: np.load(f"{r}.{k}.npy", mmap_mode="r") for k in ("terms", "indptr", "doc_ids", "tfs")}
+                for r in self._runs]
+        terms = np.unique(np.concatenate([r["terms"] for r in runs]))
+        gids = [np.searchsorted(terms, r["terms"]) for r in runs]
+        counts = np.zeros(len(terms), dtype="int64")
+        for r, g in zip(runs, gids):
+            counts[g] += np.diff(r["indptr"])  # term không lặp trong 1 run
+        indptr = np.zeros(len(terms) + 1, dtype="int64")
+        np.cumsum(counts, out=indptr[1:])
+        doc_ids = np.empty(int(indptr[-1]), dtype="int32")
+        tfs = np.empty(int(indptr[-1]), dtype="int32")
+        fill = indptr[:-1].copy()
+        for r, g in zip(runs, gids):
+            lens = np.diff(r["indptr"])
+            dest = np.repeat(fill[g] - r["indptr"][:-1], lens) + np.arange(int(r["indptr"][-1]))
+            doc_ids[dest] = r["doc_ids"]
+            tfs[dest] = r["tfs"]
+            fill[g] += lens
+        return {"terms": terms, "indptr": indptr, "doc_ids": doc_ids, "tfs": tfs}
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        if self._runs and self._buffered:
+            self._spill()
+        out = self._merge() if self._runs else self._buffer_arrays()
+        out["doc_len"] = np.frombuffer(self._doc_len, dtype="uint32").astype("int32")
+        return out
+
+    def save(self, path: str) -> None:
+        # np.savez tự thêm ".npz" nếu thiếu -> ghi qua file handle để giữ đúng tên (vd *.tmp)
+        with open(path, "wb") as f:
+            np.savez(f, **self.arrays())
+        self.cleanup()
+
+    def cleanup(self) -> None:
+        """Xoá các run đã spill (gọi sau save / khi huỷ build)."""
+        if self._spill_dir:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+        self._runs = []
+
+
+class BM25Index:
+    def __init__(self, terms: np.ndarray, indptr: np.ndarray, doc_ids: np.ndarray,
+                 tfs: np.ndarray, doc_len: np.ndarray, k1: float = 1.2, b: float = 0.75):
+        self.vocab = {str(t): i for i, t in enumerate(terms.tolist())}
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.tfs = tfs.astype("float32")
+        self.doc_len = doc_len.astype("float32")
+        self.n_docs = int(doc_len.shape[0])
+        self.k1, self.b = k1, b
+        avgdl = float(self.doc_len.mean()) if self.n_docs else 1.0
+        # phần mẫu số phụ thuộc độ dài doc, tính sẵn 1 lần
+        self._norm = k1 * (1 - b + b * self.doc_len / (avgdl or 1.0))
+
+    @classmethod
+    def load(cls, dirpath: str) -> Optional["BM25Index"]:
+        path = os.path.join(dirpath, BM25_FILE)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as z:
+            return cls(z["terms"], z["indptr"], z["doc_ids"], z["tfs"], z["doc_len"])
+
+    @classmethod
+    def from_docs(cls, docs: Iterable[str]) -> "BM25Index":
+        """Dựng tạm trong RAM (index build trước khi có bm25.npz)."""
+        bld = BM25Builder()
+        bld.add(docs)
+        return cls(**bld.arrays())
+
+    def scores(self, query: str, mask: Optional[np.ndarray] = None) -> np.ndarray:
+        out = np.zeros(self.n_docs, dtype="float32")
+        seen = set()
+        for t in tokenize(query):
+            tid = self.vocab.get(t)
+            if tid is None or tid in seen:
+                continue
+            seen.add(tid)
+            lo, hi = self.indptr[tid], self.indptr[tid + 1]
+            ids = self.doc_ids[lo:hi]
+            tf = self.tfs[lo:hi]
+            df = hi - lo
+            idf = np.log(1.0 + (self.n_docs - df + 0.5) / (df + 0.5))
+            out[ids] += idf * tf * (self.k1 + 1) / (tf + self._norm[ids])
+        if mask is not None:
+            out[~mask] = 0.0
+        return out
+
+    def topk(self, query: str, k: int, mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        s = self.scores(query, mask=mask)
+        hit = np.nonzero(s > 0)[0]
+        if hit.size == 0 or k <= 0:
+            return hit[:0], s[hit[:0]]
+        k = min(k, hit.size)
+        part = hit[np.argpartition(-s[hit], k - 1)[:k]]
+        order = part[np.argsort(-s[part])]
+        return order, s[order]
+
+
+def rrf_fuse(rankings: List[np.ndarray], k0: int = 60) -> Tuple[np.ndarray, np.ndarray]:
+    """Reciprocal-rank fusion: score(d) = Σ 1 / (k0 + rank_i(d)), rank tính từ 1."""
+    fused: Dict[int, float] = {}
+    for ranked in rankings:
+        for r, i in enumerate(ranked.tolist(), start=1):
+            fused[i] = fused.get(i, 0.0) + 1.0 / (k0 + r)
+    if not fused:
+        return np.zeros(0, dtype="int64"), np.zeros(0, dtype="float32")
+    items = sorted(fused.items(), key=lambda kv: -kv[1])
+    return (np.array([i for i, _ in items], dtype="int64"),
+            np.array([s for _, s in items], dtype="float32"))
@@ -0,0 +1,89 @@
+from __future__ import annotations
+from typing import Optional, Tuple
+import os
+import numpy as np
+
+# Scalar quantization int8 cho ma trận embedding của index RAG:
+#   x[:, d] ≈ q[:, d] * scale[d],  q ∈ [-127, 127],  scale[d] = max|x[:, d]| / 127
+# RAM giữ q (1 byte/chiều = 1/4 float32); float32 gốc chỉ đọc (memmap) cho shortlist khi rescore.
+
+Q8_FILE = "embeddings_q8.npy"
+SCALE_FILE = "q8_scale.npy"
+_CHUNK = 8192  # số dòng / lần nhân ma trận -> không upcast cả ma trận int8 sang float32
+
+
+def fit_scale(X: np.ndarray, chunk: int = _CHUNK) -> np.ndarray:
+    """scale theo từng chiều, duyệt X theo chunk (X có thể là memmap)."""
+    n, d = X.shape
+    amax = np.zeros(d, dtype="float32")
+    for i in range(0, n, chunk):
+        np.maximum(amax, np.abs(X[i:i + chunk]).max(axis=0), out=amax)
+    amax[amax == 0] = 1.0
+    return (amax / 127.0).astype("float32")
+
+
+def quantize(X: np.ndarray, scale: np.ndarray) -> np.ndarray:
+    return np.clip(np.rint(X / scale), -127, 127).astype("int8")
+
+
+def write_q8(src: np.ndarray, q8_path: str, scale_path: str, chunk: int = _CHUNK) -> None:
+    """Lượng tử hoá src (N, d) theo chunk, ghi thẳng ra .npy (memmap)."""
+    n, d = src.shape
+    scale = fit_scale(src, chunk) if n else np.ones(d, dtype="float32")
+    dst = np.lib.format.open_memmap(q8_path, mode="w+", dtype="int8", shape=(n, d))
+    for i in range(0, n, chunk):
+        dst[i:i + chunk] = quantize(np.asarray(src[i:i + chunk], dtype="float32"), scale)
+    dst.flush()
+    del dst
+    with open(scale_path, "wb") as f:  # np.save tự thêm ".npy" nếu thiếu (vd *.tmp)
+        np.save(f, scale)
+
+
+class Int8Index:
+    def __init__(self, q: np.ndarray, scale: np.ndarray):
+        self.q = q
+        self.scale = scale.astype("float32")
+        # ||x̂|| của vector đã giải lượng tử, để tính cosine xấp xỉ
+        self.norms = np.concatenate([
+            np.linalg.norm(q[i:i + _CHUNK].astype("float32") * self.scale, axis=1)
+            for i in range(0, q.shape[0], _CHUNK)
+        ]) if q.shape[0] else np.zeros(0, dtype="float32")
+
+    @classmethod
+    def load(cls, dirpath: str) -> Optional["Int8Index"]:
+        qp, sp = os.path.join(dirpath, Q8_FILE), os.path.join(dirpath, SCALE_FILE)
+        if not (os.path.exists(qp) and os.path.exists(sp)):
+            return None
+        return cls(np.load(qp), np.load(sp))
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.q.nbytes + self.scale.nbytes + self.norms.nbytes)
+
+    def approx_sims(self, qvec: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """cosine xấp xỉ: (q · (scale ⊙ v)) / (||x̂|| ||v||), nhân theo chunk."""
+        w = (qvec * self.scale).astype("float32")
+        Q = self.q if rows is None else self.q[rows]
+        norms = self.norms if rows is None else self.norms[rows]
+        dots = np.empty(Q.shape[0], dtype="float32")
+        for i in range(0, Q.shape[0], _CHUNK):
+            dots[i:i + _CHUNK] = Q[i:i + _CHUNK].astype("float32") @ w
+        return dots / (norms * (np.linalg.norm(qvec) + 1e-9) + 1e-9)
+
+    def shortlist(self, qvec: np.ndarray, k: int, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """top-k theo điểm xấp xỉ -> chỉ số global (chưa sort)."""
+        sims = self.approx_sims(qvec, rows)
+        if sims.size == 0 or k <= 0:
+            return np.zeros(0, dtype="int64")
+        k = min(k, sims.size)
+        part = np.argpartition(-sims, k - 1)[:k]
+        return part if rows is None else rows[part]
+
+
+def exact_sims(X: np.ndarray, idx: np.ndarray, qvec: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Rescore full precision cho shortlist (X thường là memmap float32) -> (idx đã sort, sims)."""
+    idx = np.sort(idx)  # đọc memmap theo thứ tự tăng dần
+    R = np.asarray(X[idx], dtype="float32")
+    sims = (R @ qvec) / (np.linalg.norm(R, axis=1) * (np.linalg.norm(qvec) + 1e-9) + 1e-9)
+    order = np.argsort(-sims)
+    return idx[order], sims[order]
@@ -1,9 +1,14 @@
 from __future__ import annotations
 from typing import List, Dict, Iterable, Optional
-import os, json
+import os, json, logging, time
 import numpy as np
 from numpy.linalg import norm
 from django.conf import settings
+from .lexical import BM25Index, rrf_fuse
+from .quant import Int8Index, exact_sims
+from . import cache as rcache
+
+log = logging.getLogger(__name__)
 
 try:
     from .embedders import get_embedder
@@ -13,30 +18,91 @@ except Exception:
 def _index_dir() -> str:
     return getattr(settings, "RAG_INDEX_DIR", os.path.join(settings.BASE_DIR, "rag_index"))
 
+# 'hybrid' (cosine + BM25, RRF) | 'vector' | 'lexical'
+RETRIEVAL_MODE = getattr(settings, "RAG_RETRIEVAL_MODE", "hybrid")
+# embedder lỗi/không có -> tự chuyển sang BM25 thay vì trả rỗng
+LEXICAL_FALLBACK = bool(getattr(settings, "RAG_LEXICAL_FALLBACK", True))
+RRF_K = int(getattr(settings, "RAG_RRF_K", 60))
+CANDIDATE_MULT = int(getattr(settings, "RAG_HYBRID_CANDIDATES", 4))  # mỗi nhánh lấy top_k * N ứng viên
+# chu kỳ kiểm tra manifest trên đĩa để nạp lại index khi worker khác vừa build xong
+CHECK_EVERY_S = float(getattr(settings, "RAG_INDEX_CHECK_SECONDS", 30))
+# 'none' | 'int8': giữ ma trận int8 trong RAM, float32 để memmap và chỉ đọc shortlist khi rescore
+QUANTIZE = getattr(settings, "RAG_QUANTIZE", "none")
+RESCORE_MULT = int(getattr(settings, "RAG_Q8_RESCORE_MULT", 4))  # shortlist = k * N
+
+
+def read_generation(dirpath: str) -> str:
+    """Generation của index trên đĩa (manifest.json do IndexWriter ghi; index cũ -> mtime)."""
+    try:
+        with open(os.path.join(dirpath, "manifest.json"), "r", encoding="utf-8") as f:
+            return str(json.load(f)["generation"])
+    except (OSError, ValueError, KeyError):
+        try:
+            return f"mtime-{int(os.stat(os.path.join(dirpath, 'embeddings.npy')).st_mtime)}"
+        except OSError:
+            return "none"
+
 class RagIndex:
     def __init__(self, dirpath: Optional[str] = None):
         self.dir = dirpath or _index_dir()
         self.docs: List[str] = []
         self.metas: List[Dict] = []
         self.embs: Optional[np.ndarray] = None
+        self.bm25: Optional[BM25Index] = None
+        self.q8: Optional[Int8Index] = None
+        self.generation: str = ""
         self._loaded = False
         self._embedder = None
 
     def ensure(self):
         if self._loaded:
             return
+        self.generation = read_generation(self.dir)
         with open(os.path.join(self.dir, "docs.json"), "r", encoding="utf-8") as f:
             self.docs = json.load(f)
         with open(os.path.join(self.dir, "metas.json"), "r", encoding="utf-8") as f:
             self.metas = json.load(f)
-        self.embs = np.load(os.path.join(self.dir, "embeddings.npy"))
-        if get_embedder is None:
-            raise RuntimeError("No embedding backend for query.")
-        self._embedder = get_embedder()
+        emb_path = os.path.join(self.dir, "embeddings.npy")
+        self.q8 = Int8Index.load(self.dir) if QUANTIZE == "int8" else None
+        if QUANTIZE == "int8" and self.q8 is None:
+            log.warning("RAG_QUANTIZE=int8 but %s has no int8 matrix; rebuild the index. Using float32.", self.dir)
+        self.embs = np.load(emb_path, mmap_mode="r") if self.q8 is not None else np.load(emb_path)
+        # index build trước khi có bm25.npz -> dựng tạm trong RAM
+        self.bm25 = BM25Index.load(self.dir) or BM25Index.from_docs(self.docs)
+        try:
+            if get_embedder is None:
+                raise RuntimeError("No embedding backend for query.")
+            self._embedder = get_embedder()
+        except Exception as e:
+            if not LEXICAL_FALLBACK:
+                raise
+            log.warning("RAG embedder unavailable, using lexical-only retrieval: %s", e)
+            self._embedder = None
         self._loaded = True
 
+    def _embed_query(self, query: str) -> Optional[np.ndarray]:
+        if self._embedder is None:
+            if LEXICAL_FALLBACK:
+                return None
+            raise RuntimeError("No embedding backend for query.")
+        try:
+            return np.asarray(self._embedder.embed_query(query), dtype="float32").reshape(-1)
+        except Exception as e:
+            if not LEXICAL_FALLBACK:
+                raise
+            log.warning("RAG query embedding failed, falling back to BM25: %s", e)
+            return None
+
     def _cosine_topk(self, qvec: np.ndarray, k: int, mask: Optional[np.ndarray] = None):
+        if self.q8 is not None:
+            rows = None if mask is None else np.nonzero(mask)[0]
+            short = self.q8.shortlist(qvec, k * max(1, RESCORE_MULT), rows)
+            idx, sims = exact_sims(self.embs, short, qvec)
+            return idx[:k], sims[:k]
         X = self.embs if mask is None else self.embs[mask]
+        if X.shape[0] == 0 or k <= 0:
+            empty = np.zeros(0, dtype="int64")
+            return empty, np.zeros(0, dtype="float32")
         dots = X @ qvec
         sims = dots / (norm(X, axis=1) * (norm(qvec) + 1e-9) + 1e-9)
         idx = np.argpartition(-sims, min(k, len(sims)-1))[:k]
@@ -69,29 +135,89 @@ class RagIndex:
             mask &= np.array([int(m.get("skill_id", -1)) in S for m in self.metas])
         return mask
 
-    def search(self, query: str, top_k: int = 6, **filters) -> List[Dict]:
+    def search(self, query: str, top_k: int = 6, mode: Optional[str] = None, **filters) -> List[Dict]:
+        """
+        mode: 'hybrid' (mặc định, RRF của cosine + BM25) | 'vector' | 'lexical'.
+        'score' = cosine (vector), BM25 (lexical) hoặc điểm RRF (hybrid); điểm từng nhánh nằm trong 'retrieval'.
+        Kết quả (doc id + score) được cache theo query chuẩn hoá + filters + k + generation.
+        """
         self.ensure()
-        qvec = self._embedder.embed_query(query).reshape(-1)
+        mode = mode or RETRIEVAL_MODE
+        t0 = time.perf_counter()
+        key = rcache.make_key(query, top_k, mode, self.generation, **filters)
+        cached = rcache.lookup(key)
+        if cached is not None:
+            out = [self._hit(h["id"], h["score"], h.get("retrieval") or {}) for h in cached]
+            rcache.record(True, (time.perf_counter() - t0) * 1000)
+            return out
+
+        hits, used_mode = self._search(query, top_k, mode, **filters)
+        if used_mode == mode:  # không cache kết quả đã bị hạ cấp (embedder lỗi -> BM25)
+            rcache.store(key, [{"id": i, "score": sc, "retrieval": r} for i, sc, r in hits])
+        rcache.record(False, (time.perf_counter() - t0) * 1000)
+        return [self._hit(i, sc, r) for i, sc, r in hits]
+
+    def _hit(self, i: int, score: float, retrieval: Dict) -> Dict:
+        return {"id": i, "text": self.docs[i], "score": float(score), "meta": self.metas[i], "retrieval": retrieval}
+
+    def _search(self, query: str, top_k: int, mode: str, **filters) -> tuple:
+        """-> ([(doc_idx, score, retrieval_info), ...], mode thực sự đã dùng)"""
         mask = self._build_mask(
             language=filters.get("language"),
             topic_slugs=filters.get("topics"),
             lesson_ids=filters.get("lessons"),
             skill_ids=filters.get("skills"),
         )
-        idx, sims = self._cosine_topk(qvec, top_k, mask=mask)
+        pool = top_k * max(1, CANDIDATE_MULT) if mode == "hybrid" else top_k
+
+        cos: Dict[int, float] = {}
+        vec_idx = None
+        if mode in ("hybrid", "vector"):
+            qvec = self._embed_query(query)
+            if qvec is None:
+                mode = "lexical"
+            else:
+                vec_idx, sims = self._cosine_topk(qvec, pool, mask=mask)
+                cos = dict(zip(vec_idx.tolist(), sims.tolist()))
+
+        lex: Dict[int, float] = {}
+        lex_idx = None
+        if mode in ("hybrid", "lexical"):
+            lex_idx, bm = self.bm25.topk(query, pool, mask=mask)
+            lex = dict(zip(lex_idx.tolist(), bm.tolist()))
+
+        if mode == "hybrid":
+            idx, scores = rrf_fuse([vec_idx, lex_idx], k0=RRF_K)
+        elif mode == "vector":
+            idx, scores = vec_idx, np.array([cos[i] for i in vec_idx.tolist()], dtype="float32")
+        else:
+            idx, scores = lex_idx, np.array([lex[i] for i in lex_idx.tolist()], dtype="float32")
+
         out = []
-        for i, score in zip(idx, sims):
-            out.append({
-                "text": self.docs[i],
-                "score": float(score),
-                "meta": self.metas[i],
-            })
-        return out
+        for i, score in zip(idx[:top_k].tolist(), scores[:top_k].tolist()):
+            out.append((int(i), float(score), {
+                "mode": mode,
+                **({"cosine": round(cos[i], 4)} if i in cos else {}),
+                **({"bm25": round(lex[i], 4)} if i in lex else {}),
+            }))
+        return out, mode
 
 # Singleton tiện dụng
 _INDEX: Optional[RagIndex] = None
+_CHECKED_AT = 0.0
 def get_index() -> RagIndex:
-    global _INDEX
+    """Singleton; tự nạp lại khi generation trên đĩa đổi (kiểm tra tối đa mỗi CHECK_EVERY_S giây)."""
+    global _INDEX, _CHECKED_AT
+    now = time.monotonic()
+    if _INDEX is not None and _INDEX._loaded and now - _CHECKED_AT >= CHECK_EVERY_S:
+        _CHECKED_AT = now
+        if read_generation(_INDEX.dir) != _INDEX.generation:
+            _INDEX = None
     if _INDEX is None:
         _INDEX = RagIndex()
+        _CHECKED_AT = now
     return _INDEX
+
+def reset_index() -> None:
+    global _INDEX
+    _INDEX = None
@@ -8,6 +8,12 @@ class TurnSerializer(serializers.ModelSerializer):
         model = Turn
         fields = ['role','content','meta','created_at']
 
+class TurnListSerializer(serializers.ModelSerializer):
+    """Danh sách turn: không đọc meta (queryset .defer('meta'))."""
+    class Meta:
+        model = Turn
+        fields = ['id','role','content','created_at']
+
 class ConversationSerializer(serializers.ModelSerializer):
     topic = TopicSerializer()
     class Meta:
@@ -0,0 +1,144 @@
+from typing import List, Dict, Optional, Any, Tuple
+import re, logging
+from django.conf import settings
+
+from ..models import Conversation, Turn
+from . import ring
+from utils.aio import run_blocking
+from utils.llm_gateway import Priority, slot
+
+log = logging.getLogger(__name__)
+
+# History theo ngân sách token thay vì "N turn cuối":
+#   - chỉ đọc phần đuôi hội thoại (ring Redis chat.services.ring; miss -> ORDER BY id DESC LIMIT n), dừng khi hết budget
+#   - các turn cũ hơn được gộp vào Conversation.summary (task chat.update_summary chạy sau mỗi reply)
+#   -> kích thước prompt gần như cố định dù hội thoại dài bao nhiêu.
+TOKEN_BUDGET = int(getattr(settings, "CHAT_HISTORY_TOKEN_BUDGET", 768))
+MAX_FETCH = int(getattr(settings, "CHAT_HISTORY_MAX_FETCH", 40))          # trần số turn đọc từ DB / request
+SUMMARY_TRIGGER = float(getattr(settings, "CHAT_SUMMARY_TRIGGER", 1.0))    # phần chưa tóm tắt > budget * N -> tóm tắt
+SUMMARY_KEEP = float(getattr(settings, "CHAT_SUMMARY_KEEP", 0.5))          # giữ nguyên văn ~ budget * N token cuối
+SUMMARY_MAX_TOKENS = int(getattr(settings, "CHAT_SUMMARY_MAX_TOKENS", 200))
+
+MSG_OVERHEAD = 4  # role + phân cách của chat template
+
+# Ước lượng token kiểu BPE, không cần tải tokenizer: mỗi từ ~ 1 token / 4 ký tự, dấu câu = 1 token.
+# Lệch vài % so với tokenizer thật của llama, đủ để giữ prompt dưới num_ctx.
+_PIECE_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+
+def count_tokens(text: str) -> int:
+    n = 0
+    for m in _PIECE_RE.finditer(text or ""):
+        w = m.group(0)
+        n += 1 + (len(w) - 1) // 4 if w[0].isalnum() or w[0] == "_" else 1
+    return n
+
+
+def turn_tokens(content: str) -> int:
+    return count_tokens(content) + MSG_OVERHEAD
+
+
+def fit_budget(rows_desc: List[Dict[str, Any]], budget: int) -> List[Dict[str, Any]]:
+    """rows mới -> cũ; lấy dần tới khi hết budget (luôn giữ ít nhất 1 turn). Trả về theo thứ tự cũ -> mới."""
+    out, used = [], 0
+    for r in rows_desc:
+        t = turn_tokens(r.get("content") or "")
+        if out and used + t > budget:
+            break
+        out.append(r)
+        used += t
+    out.reverse()
+    return out
+
+
+def _tail_qs(conv_id, after_id: int, limit: int):
+    return (Turn.objects
+            .filter(conversation_id=conv_id, id__gt=after_id, role__in=("user", "assistant"))
+            .order_by("-id")
+            .values("id", "role", "content")[:limit])
+
+
+async def _atail(conv_id, after_id: int, limit: int) -> List[Dict[str, Any]]:
+    """Đuôi hội thoại mới -> cũ: ring Redis trước, miss -> Postgres (rồi nạp lại ring)."""
+    if not ring.available():
+        return [r async for r in _tail_qs(conv_id, after_id, limit)]
+    rows = await ring.aread(conv_id)
+    if rows is None:
+        # nạp ring bằng SIZE turn cuối (không lọc summary_upto) -> dùng được cho mọi lượt sau;
+        # version đọc trước query: turn ghi trong lúc query làm afill bỏ qua snapshot này
+        version = await ring.aversion(conv_id)
+        rows = [r async for r in _tail_qs(conv_id, 0, ring.SIZE)]
+        rows.reverse()
+        await ring.afill(conv_id, rows, version)
+    return [r for r in reversed(rows) if r["id"] > after_id][:limit]
+
+
+def summary_block(summary: str) -> str:
+    return f"\n\n[EARLIER IN THIS CONVERSATION]\n{summary.strip()}" if (summary or "").strip() else ""
+
+
+async def abuild_history(conv: Conversation, *, budget: Optional[int] = None,
+                         max_turns: Optional[int] = None) -> Tuple[List[Dict[str, str]], str]:
+    """
+    -> (history cũ -> mới [{role, content}], summary của phần trước đó).
+    Chỉ các turn sau summary_upto; summary chưa bắt kịp thì turn cũ nhất bị cắt theo budget.
+    """
+    budget = budget or TOKEN_BUDGET
+    limit = min(max_turns or MAX_FETCH, MAX_FETCH)
+    summary = conv.summary or ""
+    rows = await _atail(conv.id, conv.summary_upto or 0, limit)
+    tail = fit_budget(rows, max(1, budget - count_tokens(summary)))
+    return [{"role": r["role"], "content": r["content"]} for r in tail], summary
+
+
+async def amaybe_schedule_summary(conv: Conversation) -> bool:
+    """Sau khi lưu reply: phần chưa tóm tắt vượt ngưỡng -> đẩy task tóm tắt (không chờ)."""
+    limit = MAX_FETCH
+    rows = await _atail(conv.id, conv.summary_upto or 0, limit)
+    pending = sum(turn_tokens(r["content"]) for r in rows)
+    if pending <= TOKEN_BUDGET * SUMMARY_TRIGGER and len(rows) < limit:
+        return False
+    from ..tasks import update_summary
+    try:
+        await run_blocking(update_summary.delay, str(conv.id))  # publish tới broker là I/O chặn
+    except Exception as e:  # broker down -> lượt sau thử lại; history vẫn bị chặn bởi budget
+        log.warning("update_summary enqueue failed: %s", e)
+        return False
+    return True
+
+
+# ---------------- tóm tắt (sync, chạy trong Celery worker) ----------------
+_SUMMARY_SYSTEM = (
+    "You maintain a running summary of a language-learning chat between a learner (User) and a tutor "
+    "(Assistant). Merge the previous summary with the new messages. Keep names, goals, facts the learner "
+    "shared, mistakes already corrected and open questions. Write at most {n} words, plain prose, "
+    "same language as the conversation."
+)
+
+
+def split_for_summary(rows_asc: List[Dict[str, Any]], keep_tokens: int) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """-> (phần cũ cần gộp vào summary, phần đuôi giữ nguyên văn ~keep_tokens)."""
+    keep = fit_budget(list(reversed(rows_asc)), keep_tokens)
+    cut = len(rows_asc) - len(keep)
+    return rows_asc[:cut], rows_asc[cut:]
+
+
+def summarize_sync(prev_summary: str, rows: List[Dict[str, Any]]) -> str:
+    from .llm import OLLAMA_URL, OLLAMA_MODEL, _get_sync_client
+    lines = "\n".join(f"{'User' if r['role'] == 'user' else 'Assistant'}: {r['content'].strip()}" for r in rows)
+    prompt = (f"[PREVIOUS SUMMARY]\n{prev_summary.strip() or '(none)'}\n\n[NEW MESSAGES]\n{lines}\n\n"
+              "Updated summary:")
+    payload = {
+        "model": OLLAMA_MODEL,
+        "stream": False,
+        "messages": [
+            {"role": "system", "content": _SUMMARY_SYSTEM.format(n=int(SUMMARY_MAX_TOKENS * 0.75))},
+            {"role": "user", "content": prompt},
+        ],
+        "options": {"temperature": 0.1, "num_predict": SUMMARY_MAX_TOKENS, "num_ctx": 2048},
+        "keep_alive": "15m",
+    }
+    with slot("ollama", Priority.BATCH):  # job nền: không bao giờ chiếm slot cuối của chat tương tác
+        r = _get_sync_client().post(f"{OLLAMA_URL}/api/chat", json=payload, timeout=120.0)
+    r.raise_for_status()
+    return ((r.json().get("message") or {}).get("content") or "").strip()
@@ -1,7 +1,8 @@
-from typing import List, Dict, Optional, Iterator, Any, AsyncIterator
-import os, httpx, json, logging
+from typing import List, Dict, Optional, Any, AsyncIterator, NamedTuple
+import os, httpx, json, logging, asyncio
 from django.conf import settings
 from ..models import Turn
+from utils.llm_gateway import Priority, aslot
 
 log = logging.getLogger(__name__)
 
@@ -19,8 +20,13 @@ DEFAULT_OPTIONS = {
     "keep_alive": "15m",
 }
 
+# Pool HTTP tới Ollama (mỗi process 1 client sync + 1 client async)
+MAX_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", "20"))
+MAX_KEEPALIVE   = int(os.getenv("LLM_HTTP_MAX_KEEPALIVE", "10"))
+
 # ---------------- clients ----------------
 _async_client: httpx.AsyncClient | None = None
+_async_loop: asyncio.AbstractEventLoop | None = None
 _sync_client:  httpx.Client      | None = None
 
 def _get_sync_client() -> httpx.Client:
@@ -28,7 +34,7 @@ def _get_sync_client() -> httpx.Client:
     if _sync_client is None:
         _sync_client = httpx.Client(
             timeout=httpx.Timeout(connect=10.0, read=None, write=30.0, pool=None),
-            limits=httpx.Limits(max_keepalive_connections=10, max_connections=20),
+            limits=httpx.Limits(max_keepalive_connections=MAX_KEEPALIVE, max_connections=MAX_CONNECTIONS),
             headers={
                 "Connection": "keep-alive",
                 "Accept": "application/x-ndjson",  # để server biết trả về dòng
@@ -37,11 +43,18 @@ def _get_sync_client() -> httpx.Client:
     return _sync_client
 
 async def _get_async_client() -> httpx.AsyncClient:
-    global _async_client
-    if _async_client is None:
+    """
+    1 AsyncClient dùng chung cho cả process (ASGI chỉ có 1 event loop) -> giữ keep-alive pool.
+    Connection của httpx gắn với loop tạo ra nó: gọi từ loop khác (asyncio.run trong command/test)
+    thì tạo client mới cho loop đó thay vì dùng lại pool đã chết.
+    """
+    global _async_client, _async_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_loop is not loop or _async_client.is_closed:
+        _async_loop = loop
         _async_client = httpx.AsyncClient(
             timeout=httpx.Timeout(connect=10.0, read=None, write=30.0, pool=None),
-            limits=httpx.Limits(max_keepalive_connections=10, max_connections=20),
+            limits=httpx.Limits(max_keepalive_connections=MAX_KEEPALIVE, max_connections=MAX_CONNECTIONS),
             headers={
                 "Connection": "keep-alive",
                 "Accept": "application/x-ndjson",
@@ -72,12 +85,11 @@ def _split_top_level_fields(options: Dict[str, Any] | None):
     opts.setdefault("num_thread", max(2, (os.cpu_count() or 4) // 2))
     return opts, keep_alive, stop
 
-def _ndjson_line(obj: dict) -> bytes:
-    return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
 
 # ---------------- main calls ----------------
-async def call_llm(system, history, user_text, *, options=None, model=None, stream=False):
-    """Async non-stream call: dùng trong ChatViewSet.message."""
+async def call_llm(system, history, user_text, *, options=None, model=None, stream=False,
+                   priority=Priority.INTERACTIVE, lease=None):
+    """Async non-stream call: dùng trong chat.async_views.message. Qua LLM gateway (slot "ollama")."""
     merged_opts = {**DEFAULT_OPTIONS, **(options or {})}
     opts, keep_alive, stops = _split_top_level_fields(merged_opts)
 
@@ -93,10 +105,12 @@ async def call_llm(system, history, user_text, *, options=None, model=None, stre
         payload["stop"] = stops
 
     try:
-        client = await _get_async_client()
-        r = await client.post(f"{OLLAMA_URL}/api/chat", json=payload)
-        r.raise_for_status()
-        data = r.json()
+        # hết slot / quá deadline -> GatewayBusy bay lên view (429), không nuốt như lỗi HTTP
+        async with aslot("ollama", priority, lease=lease):
+            client = await _get_async_client()
+            r = await client.post(f"{OLLAMA_URL}/api/chat", json=payload)
+            r.raise_for_status()
+            data = r.json()
         reply = (data.get("message") or {}).get("content", "").strip()
         return {"text": reply, "meta": {"suggestions": _fallback_suggestions(reply), "confidence": 0.7}}
     except httpx.HTTPError as e:
@@ -104,77 +118,19 @@ async def call_llm(system, history, user_text, *, options=None, model=None, stre
         return {"text": "Xin lỗi, hiện không kết nối được mô hình. Mình sẽ trả lời ngắn gọn.",
                 "meta": {"suggestions": _fallback_suggestions(""), "confidence": 0.3}}
 
-def stream_llm_sync(system, history, user_text, *, options=None, model=None) -> Iterator[bytes]:
-    """
-    Stream NDJSON cho StreamingHttpResponse (sync):
-      {"type":"start"}
-      {"delta":"..."}*
-      {"meta":{"suggestions":[...],"confidence":0.7}}
-      {"type":"done"}
-    """
-    merged_opts = {**DEFAULT_OPTIONS, **(options or {})}
-    opts, keep_alive, stops = _split_top_level_fields(merged_opts)
-
-    payload = {
-        "model": model or OLLAMA_MODEL,
-        "messages": _pack_messages(system, history, user_text),
-        "stream": True,
-        "options": opts,
-    }
-    if keep_alive is not None:
-        payload["keep_alive"] = keep_alive
-    if stops:
-        payload["stop"] = stops
-
-    client = _get_sync_client()
-    parts: list[str] = []
-
-    yield _ndjson_line({"type": "start"})
-
-    try:
-        with client.stream("POST", f"{OLLAMA_URL}/api/chat", json=payload) as r:
-            r.raise_for_status()
-            for raw in r.iter_lines():
-                if not raw:
-                    continue
-                if isinstance(raw, (bytes, bytearray)):
-                    raw = raw.decode("utf-8", "ignore")
-                try:
-                    j = json.loads(raw)
-                except Exception:
-                    continue
-                if j.get("done"):
-                    break
-                piece = (j.get("message") or {}).get("content") or ""
-                if piece:
-                    parts.append(piece)
-                    yield _ndjson_line({"delta": piece})
-    except httpx.HTTPError as e:
-        # fallback non-stream để FE vẫn có kết quả
-        try:
-            p2 = dict(payload); p2["stream"] = False
-            r2 = client.post(f"{OLLAMA_URL}/api/chat", json=p2)
-            r2.raise_for_status()
-            data = r2.json()
-            text = (data.get("message") or {}).get("content") or ""
-            if text:
-                parts.append(text)
-                yield _ndjson_line({"delta": text})
-        except Exception as e2:
-            yield _ndjson_line({"delta": f"(Stream error: {e}; fallback error: {e2})"})
+# ---------------- async stream: delta có kiểu ----------------
+class Delta(NamedTuple):
+    """1 mẩu stream đã parse đúng 1 lần: kind = "token" | "meta" | "error" (hết generator = done)."""
+    kind: str
+    text: str = ""
+    meta: Optional[Dict[str, Any]] = None
 
-    reply = "".join(parts).strip()
-    yield _ndjson_line({"meta": {"suggestions": _fallback_suggestions(reply), "confidence": 0.7}})
-    yield _ndjson_line({"type": "done"})
 
-# ---------------- NEW: async generator stream ----------------
-async def astream_llm(system, history, user_text, *, options=None, model=None) -> AsyncIterator[bytes]:
+async def aiter_llm(system, history, user_text, *, options=None, model=None,
+                    priority=Priority.STREAM, lease=None) -> AsyncIterator[Delta]:
     """
-    Async NDJSON stream (dùng cho async view/WebSocket/ASGI):
-      {"type":"start"}
-      {"delta":"..."}*
-      {"meta":{...}}
-      {"type":"done"}
+    Stream /api/chat -> Delta: token* , meta (luôn có, cuối cùng). Lỗi HTTP -> thử non-stream, vẫn lỗi -> Delta error.
+    Đóng generator (aclose/huỷ task) -> đóng HTTP stream -> Ollama dừng sinh token.
     """
     merged_opts = {**DEFAULT_OPTIONS, **(options or {})}
     opts, keep_alive, stops = _split_top_level_fields(merged_opts)
@@ -193,44 +149,39 @@ async def astream_llm(system, history, user_text, *, options=None, model=None) -
     client = await _get_async_client()
     parts: list[str] = []
 
-    yield _ndjson_line({"type": "start"})
-
-    try:
-        async with client.stream("POST", f"{OLLAMA_URL}/api/chat", json=payload) as r:
-            r.raise_for_status()
-            async for raw in r.aiter_lines():
-                if not raw:
-                    continue
-                # raw ở đây là str, nhưng decode phòng hờ:
-                if isinstance(raw, (bytes, bytearray)):
-                    raw = raw.decode("utf-8", "ignore")
-                try:
-                    j = json.loads(raw)
-                except Exception:
-                    continue
-                if j.get("done"):
-                    break
-                piece = (j.get("message") or {}).get("content") or ""
-                if piece:
-                    parts.append(piece)
-                    yield _ndjson_line({"delta": piece})
-    except httpx.HTTPError as e:
-        # fallback non-stream (vẫn trong cùng response)
+    async with aslot("ollama", priority, lease=lease):
         try:
-            p2 = dict(payload); p2["stream"] = False
-            r2 = await client.post(f"{OLLAMA_URL}/api/chat", json=p2)
-            r2.raise_for_status()
-            data = r2.json()
-            text = (data.get("message") or {}).get("content") or ""
-            if text:
-                parts.append(text)
-                yield _ndjson_line({"delta": text})
-        except Exception as e2:
-            yield _ndjson_line({"delta": f"(Stream error: {e}; fallback error: {e2})"})
+            async with client.stream("POST", f"{OLLAMA_URL}/api/chat", json=payload) as r:
+                r.raise_for_status()
+                async for raw in r.aiter_lines():
+                    if not raw:
+                        continue
+                    try:
+                        j = json.loads(raw)
+                    except Exception:
+                        continue
+                    if j.get("done"):
+                        break
+                    piece = (j.get("message") or {}).get("content") or ""
+                    if piece:
+                        parts.append(piece)
+                        yield Delta("token", piece)
+        except httpx.HTTPError as e:
+            # fallback non-stream (vẫn trong cùng response)
+            try:
+                p2 = dict(payload); p2["stream"] = False
+                r2 = await client.post(f"{OLLAMA_URL}/api/chat", json=p2)
+                r2.raise_for_status()
+                data = r2.json()
+                text = (data.get("message") or {}).get("content") or ""
+                if text:
+                    parts.append(text)
+                    yield Delta("token", text)
+            except Exception as e2:
+                yield Delta("error", f"{e}; fallback error: {e2}")
 
     reply = "".join(parts).strip()
-    yield _ndjson_line({"meta": {"suggestions": _fallback_suggestions(reply), "confidence": 0.7}})
-    yield _ndjson_line({"type": "done"})
+    yield Delta("meta", meta={"suggestions": _fallback_suggestions(reply), "confidence": 0.7 if reply else 0.3})
 
 
 def build_system_prompt(
@@ -0,0 +1,199 @@
+from typing import List, Dict, Optional, Any, AsyncIterator
+import os, json, time, hashlib, logging
+import httpx
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+
+from .llm import (
+    OLLAMA_URL, OLLAMA_MODEL, DEFAULT_OPTIONS,
+    Delta, _get_async_client, _split_top_level_fields, _fallback_suggestions,
+)
+from utils.llm_gateway import Priority, aslot
+
+log = logging.getLogger(__name__)
+
+# Tái dùng KV-context của Ollama giữa các lượt trong cùng 1 Conversation:
+#   /api/generate trả "context" (token của toàn bộ hội thoại đã prefill). Lượt sau gửi lại context đó
+#   + CHỈ tin nhắn mới -> Ollama không phải prefill lại system prompt + history.
+# State lưu ở cache "shared" theo conversation; lệch model/system prompt/số lượt hoặc mất cache -> prompt đầy đủ.
+# Mặc định tắt cho tới khi đo được lợi ích trên môi trường thật (CHAT_KV_REUSE=1 để bật).
+KV_REUSE = os.getenv("CHAT_KV_REUSE", "0") == "1"
+KV_TTL = int(os.getenv("CHAT_KV_TTL", str(60 * 60)))
+KV_MAX_FILL = float(os.getenv("CHAT_KV_MAX_FILL", "0.75"))  # context > num_ctx * N -> dựng lại prompt gọn
+CACHE_ALIAS = os.getenv("CHAT_KV_CACHE_ALIAS", "shared")
+
+_PREFIX = "chat:kv:"
+
+
+def _cache():
+    try:
+        return caches[CACHE_ALIAS]
+    except InvalidCacheBackendError:
+        return caches["default"]
+
+
+def fingerprint(model: str, system: str) -> str:
+    return hashlib.sha1(f"{model}\n{system or ''}".encode("utf-8")).hexdigest()
+
+
+async def aload_state(conv_id, fp: str, n_prev: int, num_ctx: int) -> Optional[List[int]]:
+    """context đã lưu nếu còn khớp (model + system prompt + số lượt trước đó), ngược lại None."""
+    try:
+        st = await _cache().aget(f"{_PREFIX}{conv_id}")
+    except Exception as e:
+        log.warning("KV state get failed: %s", e)
+        return None
+    if not st or st.get("fp") != fp or st.get("n") != n_prev:
+        return None
+    ctx = st.get("context") or []
+    if not ctx or len(ctx) > num_ctx * KV_MAX_FILL:
+        return None
+    return ctx
+
+
+async def asave_state(conv_id, fp: str, n_turns: int, context: Optional[List[int]]) -> None:
+    key = f"{_PREFIX}{conv_id}"
+    try:
+        if context:
+            await _cache().aset(key, {"fp": fp, "n": n_turns, "context": context}, KV_TTL)
+        else:
+            await _cache().adelete(key)
+    except Exception as e:
+        log.warning("KV state set failed: %s", e)
+
+
+async def adrop_state(conv_id) -> None:
+    try:
+        await _cache().adelete(f"{_PREFIX}{conv_id}")
+    except Exception:
+        pass
+
+
+def _render_full(history: List[Dict[str, str]], user_text: str, refs: str) -> str:
+    lines = []
+    for t in history:
+        if t.get("role") in ("user", "assistant") and (t.get("content") or "").strip():
+            lines.append(f"{'User' if t['role'] == 'user' else 'Assistant'}: {t['content'].strip()}")
+    return _render_turn(user_text, refs, prior="\n".join(lines))
+
+
+def _render_turn(user_text: str, refs: str, prior: str = "") -> str:
+    parts = []
+    if prior:
+        parts.append("[CONVERSATION SO FAR]\n" + prior)
+    if refs:
+        # tài liệu RAG đổi theo từng lượt -> đi cùng tin nhắn, không nằm trong system (giữ prefix ổn định)
+        parts.append("[REFERENCE MATERIALS]\n" + refs + "\n(Hãy ưu tiên dựa trên tài liệu trên khi phản hồi.)")
+    parts.append(user_text)
+    return "\n\n".join(parts)
+
+
+def _payload(system: str, history, user_text: str, refs: str, context: Optional[List[int]],
+             options, model, stream: bool) -> Dict[str, Any]:
+    merged = {**DEFAULT_OPTIONS, **(options or {})}
+    opts, keep_alive, stops = _split_top_level_fields(merged)
+    payload: Dict[str, Any] = {"model": model, "stream": stream, "options": opts}
+    if context:
+        payload["context"] = context
+        payload["prompt"] = _render_turn(user_text, refs)
+    else:
+        payload["system"] = system
+        payload["prompt"] = _render_full(history, user_text, refs)
+    if keep_alive is not None:
+        payload["keep_alive"] = keep_alive
+    if stops:
+        opts["stop"] = stops  # /api/generate nhận stop trong options
+    return payload
+
+
+def _stats(data: Dict[str, Any], reused: bool, ctx_len: int, elapsed_ms: float) -> Dict[str, Any]:
+    return {
+        "kv_reuse": reused,
+        "context_tokens": ctx_len,
+        "prefill_tokens": int(data.get("prompt_eval_count") or 0),
+        "prefill_ms": round((data.get("prompt_eval_duration") or 0) / 1e6, 1),
+        "eval_tokens": int(data.get("eval_count") or 0),
+        "total_ms": round(elapsed_ms, 1),
+    }
+
+
+def _log(conv_id, st: Dict[str, Any]) -> None:
+    log.info("llm conv=%s kv_reuse=%s context=%s prefill_tokens=%s prefill_ms=%s eval_tokens=%s",
+             conv_id, st["kv_reuse"], st["context_tokens"], st["prefill_tokens"], st["prefill_ms"],
+             st["eval_tokens"])
+
+
+async def call_llm_ctx(conv_id, system: str, history, user_text: str, *, n_prev: int, refs: str = "",
+                       options=None, model=None, lease=None) -> Dict[str, Any]:
+    """
+    Như call_llm nhưng qua /api/generate + KV-context của conversation.
+    history: các lượt TRƯỚC tin nhắn hiện tại; n_prev: tổng số lượt user/assistant trước tin nhắn này.
+    -> {"text", "meta": {"suggestions", "confidence", "llm": {prefill_tokens, kv_reuse, ...}}}
+    """
+    model = model or OLLAMA_MODEL
+    fp = fingerprint(model, system)
+    num_ctx = int({**DEFAULT_OPTIONS, **(options or {})}.get("num_ctx") or 1536)
+    context = await aload_state(conv_id, fp, n_prev, num_ctx)
+    payload = _payload(system, history, user_text, refs, context, options, model, stream=False)
+    t0 = time.perf_counter()
+    try:
+        async with aslot("ollama", Priority.INTERACTIVE, lease=lease):
+            client = await _get_async_client()
+            r = await client.post(f"{OLLAMA_URL}/api/generate", json=payload)
+            r.raise_for_status()
+            data = r.json()
+    except httpx.HTTPError as e:
+        log.error("call_llm_ctx HTTPError: %s", e)
+        await adrop_state(conv_id)
+        return {"text": "Xin lỗi, hiện không kết nối được mô hình. Mình sẽ trả lời ngắn gọn.",
+                "meta": {"suggestions": _fallback_suggestions(""), "confidence": 0.3}}
+    reply = (data.get("response") or "").strip()
+    st = _stats(data, bool(context), len(context or []), (time.perf_counter() - t0) * 1000)
+    _log(conv_id, st)
+    await asave_state(conv_id, fp, n_prev + 2, data.get("context"))
+    return {"text": reply, "meta": {"suggestions": _fallback_suggestions(reply), "confidence": 0.7, "llm": st}}
+
+
+async def aiter_llm_ctx(conv_id, system: str, history, user_text: str, *, n_prev: int, refs: str = "",
+                        options=None, model=None, lease=None) -> AsyncIterator[Delta]:
+    """Như aiter_llm (Delta token*/error, meta cuối) nhưng qua /api/generate + KV-context; meta gồm "llm"."""
+    model = model or OLLAMA_MODEL
+    fp = fingerprint(model, system)
+    num_ctx = int({**DEFAULT_OPTIONS, **(options or {})}.get("num_ctx") or 1536)
+    context = await aload_state(conv_id, fp, n_prev, num_ctx)
+    payload = _payload(system, history, user_text, refs, context, options, model, stream=True)
+
+    client = await _get_async_client()
+    parts: list[str] = []
+    final: Dict[str, Any] = {}
+    t0 = time.perf_counter()
+    async with aslot("ollama", Priority.STREAM, lease=lease):
+        try:
+            async with client.stream("POST", f"{OLLAMA_URL}/api/generate", json=payload) as r:
+                r.raise_for_status()
+                async for raw in r.aiter_lines():
+                    if not raw:
+                        continue
+                    try:
+                        j = json.loads(raw)
+                    except Exception:
+                        continue
+                    piece = j.get("response") or ""
+                    if piece:
+                        parts.append(piece)
+                        yield Delta("token", piece)
+                    if j.get("done"):
+                        final = j
+                        break
+        except httpx.HTTPError as e:
+            await adrop_state(conv_id)
+            yield Delta("error", str(e))
+
+    reply = "".join(parts).strip()
+    meta: Dict[str, Any] = {"suggestions": _fallback_suggestions(reply), "confidence": 0.7 if reply else 0.3}
+    if final:
+        st = _stats(final, bool(context), len(context or []), (time.perf_counter() - t0) * 1000)
+        _log(conv_id, st)
+        await asave_state(conv_id, fp, n_prev + 2, final.get("context"))
+        meta["llm"] = st
+    yield Delta("meta", meta=meta)
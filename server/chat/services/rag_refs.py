@@ -0,0 +1,94 @@
+import hashlib, json
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from ..models import RagDocText
+
+# Turn.meta["rag"] lưu theo tham chiếu thay vì chép nguyên văn tài liệu mỗi câu trả lời:
+#   {"used": true, "generation": "<index generation>", "hits": [{"id": <doc idx>, "score": 0.81, "sha": "<sha256>"}]}
+# text + meta của tài liệu nằm 1 lần trong RagDocText (khoá = sha256) -> cùng 1 tài liệu trích 1000 lần vẫn 1 row.
+# expand() / aexpand() dựng lại shape cũ {"score", "meta", "doc"} cho API (1 query cho cả danh sách turn).
+
+
+def _sha(text: str, meta: Optional[Dict]) -> str:
+    raw = json.dumps({"text": text, "meta": meta or {}}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _text(h: Dict) -> Optional[str]:
+    # hit của retriever có "text", payload trả client / meta cũ có "doc"
+    return h.get("text") if h.get("text") is not None else h.get("doc")
+
+
+def compact(rag: Dict, generation: Optional[str] = None) -> Tuple[Dict, List[RagDocText]]:
+    """meta["rag"] đầy đủ -> (bản tham chiếu, các RagDocText cần lưu). Hit đã là tham chiếu thì giữ nguyên."""
+    docs: Dict[str, RagDocText] = {}
+    hits = []
+    for h in (rag or {}).get("hits") or []:
+        text = _text(h)
+        if text is None:
+            hits.append(h)
+            continue
+        sha = _sha(text, h.get("meta"))
+        docs.setdefault(sha, RagDocText(sha=sha, text=text, meta=h.get("meta") or {}))
+        hits.append({"id": h.get("id"), "score": float(h.get("score", 0.0)), "sha": sha})
+    out = {"used": bool((rag or {}).get("used", hits)), "hits": hits}
+    gen = generation if generation is not None else (rag or {}).get("generation")
+    if gen:
+        out["generation"] = gen
+    return out, list(docs.values())
+
+
+def compact_meta(meta: Dict, generation: Optional[str] = None) -> Tuple[Dict, List[RagDocText]]:
+    if not isinstance(meta, dict) or not isinstance(meta.get("rag"), dict):
+        return meta, []
+    rag, docs = compact(meta["rag"], generation)
+    return {**meta, "rag": rag}, docs
+
+
+def store(docs: List[RagDocText]) -> None:
+    if docs:
+        RagDocText.objects.bulk_create(docs, ignore_conflicts=True)
+
+
+async def acompact_meta(meta: Dict, generation: Optional[str] = None) -> Dict:
+    """Lưu text tài liệu (bỏ qua sha đã có) rồi trả meta dạng tham chiếu để ghi vào Turn."""
+    meta, docs = compact_meta(meta, generation)
+    if docs:
+        await RagDocText.objects.abulk_create(docs, ignore_conflicts=True)
+    return meta
+
+
+def _shas(metas: Iterable[Dict]) -> List[str]:
+    return list({h["sha"] for m in metas if isinstance(m, dict)
+                 for h in ((m.get("rag") or {}).get("hits") or []) if h.get("sha")})
+
+
+def _fill(metas: List[Dict], texts: Dict[str, Dict[str, Any]]) -> List[Dict]:
+    out = []
+    for m in metas:
+        hits = ((m or {}).get("rag") or {}).get("hits") if isinstance(m, dict) else None
+        if not hits:
+            out.append(m)
+            continue
+        full = []
+        for h in hits:
+            d = texts.get(h.get("sha")) if h.get("sha") else None
+            if d is None:
+                full.append(h)  # meta cũ chưa compact, hoặc text đã bị xoá
+                continue
+            full.append({"id": h.get("id"), "score": h.get("score"), "meta": d["meta"], "doc": d["text"]})
+        out.append({**m, "rag": {**m["rag"], "hits": full}})
+    return out
+
+
+def expand(metas: List[Dict]) -> List[Dict]:
+    shas = _shas(metas)
+    texts = {r["sha"]: r for r in RagDocText.objects.filter(sha__in=shas).values("sha", "text", "meta")} if shas else {}
+    return _fill(metas, texts)
+
+
+async def aexpand(metas: List[Dict]) -> List[Dict]:
+    shas = _shas(metas)
+    texts = ({r["sha"]: r async for r in RagDocText.objects.filter(sha__in=shas).values("sha", "text", "meta")}
+             if shas else {})
+    return _fill(metas, texts)
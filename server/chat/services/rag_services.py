@@ -13,10 +13,10 @@ from django.db.models import QuerySet
 from django.utils import timezone
 from sentence_transformers.util import normalize_embeddings
 
-from pgvector.django import CosineDistance
 
-from languages.models import Topic
-from models import RoleplayScenario, RoleplayBlock, Word
+from languages.models import Topic, RoleplayScenario, RoleplayBlock
+from languages.services.vector_search import nearest
+from vocabulary.models import Word
 from sentence_transformers import SentenceTransformer
 from openai import OpenAI
 
@@ -229,6 +229,7 @@ class RAGService:
     scenario_id: Optional[str] = None,
     section_in: Optional[Sequence[str]] = None,
     min_created_at: Optional[datetime] = None,
+    ef_search: Optional[int] = None,
     ) -> List[RoleplayBlock]:
         vec = self._embed_query(query)
         qs = RoleplayBlock.objects.exclude(embedding__isnull=True)
@@ -243,8 +244,8 @@ class RAGService:
         if min_created_at:
             qs = qs.filter(created_at__gte=min_created_at)
         qs = qs.select_related("scenario", "scenario__topic")
-        qs = qs.annotate(dist=CosineDistance("embedding", vec)).order_by("dist")
-        return list(qs[:top_k])
+        filtered = any([scenario_id, topic_id, language_id, section_in, min_created_at])
+        return nearest(qs, vec, top_k, ef_search=ef_search, filtered=filtered, alias="dist")
 
     def search_scenarios(
     self,
@@ -255,6 +256,7 @@ class RAGService:
     topic_id: Optional[int] = None,
     level_in: Optional[Sequence[str]] = None,
     is_active: Optional[bool] = True,
+    ef_search: Optional[int] = None,
     ) -> List[RoleplayScenario]:
         vec = self._embed_query(query)
         qs = RoleplayScenario.objects.exclude(embedding__isnull=True)
@@ -267,8 +269,7 @@ class RAGService:
         if level_in:
             qs = qs.filter(level__in=list(level_in))
         qs = qs.select_related("topic")
-        qs = qs.annotate(dist=CosineDistance("embedding", vec)).order_by("dist")
-        return list(qs[:top_k])
+        return nearest(qs, vec, top_k, ef_search=ef_search, filtered=True, alias="dist")
 
 
     def expand_neighbors(self, blocks: Sequence[RoleplayBlock], window: int = 1) -> List[RoleplayBlock]:
@@ -0,0 +1,155 @@
+from typing import Dict, List, Optional, Any
+import hashlib, json, logging, time
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+
+log = logging.getLogger(__name__)
+
+# Cache câu trả lời của tutor theo NGỮ NGHĨA câu hỏi (opt-in, CHAT_RESPONSE_CACHE=1):
+#   scope = ngôn ngữ + topic + skill + system prompt gốc + model + generation RAG index + version
+#   mỗi scope giữ tối đa MAX_ENTRIES cặp (vector câu hỏi float16, câu trả lời); cosine >= THRESHOLD -> hit.
+# Build lại RAG index (generation mới) hoặc invalidate() (bump version) -> mọi scope cũ tự mất hiệu lực.
+ENABLED = bool(getattr(settings, "CHAT_RESPONSE_CACHE", False))
+CACHE_ALIAS = getattr(settings, "CHAT_RESPONSE_CACHE_ALIAS", "shared")
+CACHE_TTL = int(getattr(settings, "CHAT_RESPONSE_CACHE_TTL", 60 * 60 * 24 * 3))
+THRESHOLD = float(getattr(settings, "CHAT_RESPONSE_CACHE_THRESHOLD", 0.95))
+MAX_ENTRIES = int(getattr(settings, "CHAT_RESPONSE_CACHE_MAX_ENTRIES", 256))  # / scope
+MIN_CHARS = 8  # câu quá ngắn ("ok", "yes") phụ thuộc ngữ cảnh hội thoại -> không cache
+
+_PREFIX = "chat:resp:"
+_STATS = ("hits", "misses", "stores")
+
+
+def _backend():
+    try:
+        return caches[CACHE_ALIAS]
+    except InvalidCacheBackendError:
+        return caches["default"]
+
+
+def _version() -> int:
+    try:
+        return int(_backend().get(f"{_PREFIX}ver") or 0)
+    except Exception:
+        return 0
+
+
+def invalidate() -> None:
+    """Bỏ toàn bộ câu trả lời đã cache (vd. sau khi sửa nội dung bài học / reindex)."""
+    c = _backend()
+    try:
+        c.incr(f"{_PREFIX}ver")
+    except ValueError:
+        c.add(f"{_PREFIX}ver", 1, None)
+    except Exception as e:
+        log.warning("Response cache invalidate failed: %s", e)
+
+
+def make_scope(*, language: Optional[str], topic: Optional[str], skill=None, system_prompt: str,
+               model: str, generation: str = "") -> str:
+    raw = json.dumps({
+        "lang": language or None,
+        "topic": topic or None,
+        "skill": str(skill) if skill else None,
+        "sys": hashlib.sha1((system_prompt or "").encode("utf-8")).hexdigest(),
+        "model": model,
+        "gen": generation or "",
+        "ver": _version(),
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def cacheable(text: str) -> bool:
+    return ENABLED and len((text or "").strip()) >= MIN_CHARS
+
+
+def _embed(text: str) -> np.ndarray:
+    from languages.services.embed_cache import embed_text  # L1/L2 cache: store() sau lookup() không embed lại
+    v = np.asarray(embed_text(text), dtype="float32")
+    n = float(np.linalg.norm(v))
+    return v / n if n > 0 else v
+
+
+def _entries(scope: str) -> List[Dict[str, Any]]:
+    try:
+        rows = _backend().get(_PREFIX + scope) or []
+    except Exception as e:  # Redis down -> coi như miss
+        log.warning("Response cache get failed: %s", e)
+        return []
+    now = time.time()
+    return [r for r in rows if now - r.get("t", 0) < CACHE_TTL]
+
+
+def lookup(scope: str, question: str) -> Optional[Dict[str, Any]]:
+    """-> {"answer", "score", "question", "turn_id", "cached_at"} hoặc None. Sync (embed + numpy): gọi qua thread."""
+    if not cacheable(question):
+        return None
+    rows = _entries(scope)
+    best = None
+    if rows:
+        q = _embed(question)
+        M = np.stack([np.frombuffer(r["v"], dtype="float16").astype("float32") for r in rows])
+        sims = M @ q
+        i = int(np.argmax(sims))
+        if float(sims[i]) >= THRESHOLD:
+            r = rows[i]
+            best = {"answer": r["a"], "score": round(float(sims[i]), 4), "question": r["q"],
+                    "turn_id": r.get("turn"), "cached_at": int(r["t"])}
+    record(best is not None)
+    return best
+
+
+def store(scope: str, question: str, answer: str, turn_id=None) -> None:
+    if not cacheable(question) or not (answer or "").strip():
+        return
+    try:
+        v = _embed(question)
+        rows = _entries(scope)
+        rows.append({"v": v.astype("float16").tobytes(), "q": question.strip(), "a": answer,
+                     "t": time.time(), "turn": turn_id})
+        # read-modify-write không khoá: 2 worker ghi cùng lúc có thể mất 1 entry, chấp nhận được cho cache
+        _backend().set(_PREFIX + scope, rows[-MAX_ENTRIES:], CACHE_TTL)
+        _incr("stores")
+    except Exception as e:
+        log.warning("Response cache set failed: %s", e)
+
+
+def provenance(hit: Dict[str, Any]) -> Dict[str, Any]:
+    """Ghi vào Turn.meta["cache"] của câu trả lời lấy từ cache."""
+    return {"hit": True, "score": hit["score"], "source_turn": hit.get("turn_id"),
+            "source_question": hit["question"], "cached_at": hit["cached_at"]}
+
+
+def _incr(name: str, n: int = 1) -> None:
+    c = _backend()
+    key = f"{_PREFIX}stats:{name}"
+    try:
+        c.incr(key, n)
+    except ValueError:  # chưa có key
+        c.add(key, 0, None)
+        c.incr(key, n)
+
+
+def record(hit: bool) -> None:
+    try:
+        _incr("hits" if hit else "misses")
+    except Exception as e:
+        log.debug("Response cache stats failed: %s", e)
+
+
+def stats() -> Dict:
+    vals = _backend().get_many([f"{_PREFIX}stats:{n}" for n in _STATS])
+    hits, misses, stores = (int(vals.get(f"{_PREFIX}stats:{n}") or 0) for n in _STATS)
+    total = hits + misses
+    return {
+        "enabled": ENABLED,
+        "backend": CACHE_ALIAS,
+        "threshold": THRESHOLD,
+        "hits": hits,
+        "misses": misses,
+        "stores": stores,
+        "hit_rate": round(hits / total, 4) if total else 0.0,
+        "version": _version(),
+    }
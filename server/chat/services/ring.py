@@ -0,0 +1,147 @@
+from typing import Any, Dict, List, Optional
+import asyncio, json, logging, time, weakref
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+# Ring buffer N turn cuối của mỗi hội thoại đang hoạt động trong Redis (list JSON {id, role, content}, không meta):
+#   - đọc history: LRANGE 1 lệnh thay cho query Turn; miss -> đọc Postgres rồi nạp lại ring
+#   - ghi: write-through sau mỗi Turn.acreate, chỉ khi ring đã "đầy đủ" (cờ :ok) -> không bao giờ có ring thiếu turn cũ
+#   - mỗi lần ghi / xoá tăng :v; nạp lại chỉ thành công nếu :v không đổi từ trước lúc đọc DB
+#     -> snapshot cũ không thể đè lên turn vừa ghi trong lúc đang nạp
+#   - xoá turn -> bỏ cả ring (lần đọc sau nạp lại từ DB)
+ENABLED = bool(getattr(settings, "CHAT_RING", True))
+RING_URL = getattr(settings, "CHAT_RING_URL", None) or getattr(settings, "REDIS_URL", "redis://localhost:6379/0")
+# luôn >= CHAT_HISTORY_MAX_FETCH: history đọc từ ring phải giống hệt history đọc từ DB
+SIZE = max(int(getattr(settings, "CHAT_RING_SIZE", 40)), int(getattr(settings, "CHAT_HISTORY_MAX_FETCH", 40)))
+TTL = int(getattr(settings, "CHAT_RING_TTL", 60 * 60 * 6))  # hội thoại im lặng quá TTL -> ra khỏi Redis
+BACKOFF_S = 30.0  # Redis lỗi -> bỏ qua ring một lúc, không để mỗi request chờ timeout kết nối
+
+_PREFIX = "chat:ring:"
+
+# tăng :v; RPUSH chỉ khi cờ :ok còn (ring đã nạp đủ), LTRIM về SIZE, gia hạn TTL — 1 round-trip, atomic
+_APPEND_LUA = """
+redis.call('INCR', KEYS[3])
+redis.call('EXPIRE', KEYS[3], ARGV[2])
+if redis.call('EXISTS', KEYS[2]) == 0 then return 0 end
+redis.call('RPUSH', KEYS[1], unpack(ARGV, 3))
+redis.call('LTRIM', KEYS[1], -tonumber(ARGV[1]), -1)
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+return 1
+"""
+
+# nạp ring + đặt :ok chỉ khi :v vẫn bằng giá trị đọc được trước khi query DB
+_FILL_LUA = """
+if (redis.call('GET', KEYS[3]) or '') ~= ARGV[1] then return 0 end
+redis.call('DEL', KEYS[1])
+if #ARGV > 2 then
+  redis.call('RPUSH', KEYS[1], unpack(ARGV, 3))
+  redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+redis.call('SET', KEYS[2], 1, 'EX', ARGV[2])
+return 1
+"""
+
+_INVALIDATE_LUA = """
+redis.call('DEL', KEYS[1], KEYS[2])
+redis.call('INCR', KEYS[3])
+redis.call('EXPIRE', KEYS[3], ARGV[1])
+return 1
+"""
+
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Any]" = weakref.WeakKeyDictionary()
+_down_until = 0.0
+
+
+def _keys(conv_id):
+    return f"{_PREFIX}{conv_id}", f"{_PREFIX}{conv_id}:ok", f"{_PREFIX}{conv_id}:v"
+
+
+def _client():
+    """1 client redis.asyncio / event loop (pool kết nối gắn với loop tạo ra nó)."""
+    loop = asyncio.get_running_loop()
+    c = _clients.get(loop)
+    if c is None:
+        import redis.asyncio as aredis
+        c = _clients[loop] = aredis.Redis.from_url(RING_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+    return c
+
+
+def available() -> bool:
+    return ENABLED and time.monotonic() >= _down_until
+
+
+def _failed(op: str, e: Exception) -> None:
+    global _down_until
+    _down_until = time.monotonic() + BACKOFF_S
+    log.warning("Chat ring %s failed (%s), falling back to Postgres for %.0fs", op, e, BACKOFF_S)
+
+
+def _row(turn) -> str:
+    return json.dumps({"id": turn.id, "role": turn.role, "content": turn.content}, ensure_ascii=False)
+
+
+async def aread(conv_id) -> Optional[List[Dict[str, Any]]]:
+    """-> turn user/assistant cũ -> mới (tối đa SIZE), hoặc None nếu miss / Redis lỗi."""
+    if not available():
+        return None
+    ring, ok, _ = _keys(conv_id)
+    try:
+        p = _client().pipeline(transaction=False)
+        p.exists(ok)
+        p.lrange(ring, 0, -1)
+        present, raw = await p.execute()
+    except Exception as e:
+        _failed("read", e)
+        return None
+    if not present:
+        return None
+    rows = [json.loads(r) for r in raw]
+    rows.sort(key=lambda r: r["id"])  # 2 request ghi song song có thể RPUSH lệch thứ tự
+    return rows
+
+
+async def aversion(conv_id) -> Optional[str]:
+    """:v hiện tại; đọc TRƯỚC khi query DB rồi đưa cho afill. None -> Redis lỗi, không nạp."""
+    if not available():
+        return None
+    try:
+        v = await _client().get(_keys(conv_id)[2])
+    except Exception as e:
+        _failed("version", e)
+        return None
+    return v.decode() if v else ""
+
+
+async def afill(conv_id, rows_asc: List[Dict[str, Any]], version: Optional[str]) -> bool:
+    """Nạp lại ring từ DB (rows: SIZE turn cuối, cũ -> mới). Có turn ghi / xoá kể từ aversion -> bỏ, trả False."""
+    if version is None or not available():
+        return False
+    rows = [json.dumps({"id": r["id"], "role": r["role"], "content": r["content"]}, ensure_ascii=False)
+            for r in rows_asc[-SIZE:]]
+    try:
+        return bool(await _client().eval(_FILL_LUA, 3, *_keys(conv_id), version, TTL, *rows))
+    except Exception as e:
+        _failed("fill", e)
+        return False
+
+
+async def aappend(conv_id, *turns) -> None:
+    """Write-through sau khi lưu Turn; ring chưa nạp (cờ :ok hết hạn) -> chỉ tăng :v, lần đọc sau tự nạp từ DB."""
+    turns = [t for t in turns if t is not None and t.role in ("user", "assistant")]
+    if not turns or not available():
+        return
+    try:
+        await _client().eval(_APPEND_LUA, 3, *_keys(conv_id), SIZE, TTL, *[_row(t) for t in turns])
+    except Exception as e:
+        _failed("append", e)
+
+
+async def ainvalidate(conv_id) -> None:
+    if not ENABLED:
+        return
+    try:
+        await _client().eval(_INVALIDATE_LUA, 3, *_keys(conv_id), TTL)
+    except Exception as e:
+        _failed("invalidate", e)
@@ -0,0 +1,37 @@
+import logging
+from celery import shared_task
+from django.utils import timezone
+from .models import Conversation, Turn
+from .services.history import SUMMARY_KEEP, TOKEN_BUDGET, split_for_summary, summarize_sync
+
+log = logging.getLogger(__name__)
+
+SUMMARY_BATCH = 200  # số turn tối đa gộp mỗi lần chạy
+
+
+@shared_task(name="chat.update_summary", bind=True, max_retries=2)
+def update_summary(self, conv_id: str):
+    """
+    Gộp các turn cũ (sau summary_upto, trừ phần đuôi ~budget*KEEP token) vào Conversation.summary.
+    Ghi có điều kiện summary_upto cũ -> 2 task chạy trùng thì task sau bỏ qua.
+    """
+    conv = Conversation.objects.only("id", "summary", "summary_upto").get(pk=conv_id)
+    rows = list(Turn.objects
+                .filter(conversation_id=conv.id, id__gt=conv.summary_upto, role__in=("user", "assistant"))
+                .order_by("id")
+                .values("id", "role", "content")[:SUMMARY_BATCH])
+    old, _keep = split_for_summary(rows, int(TOKEN_BUDGET * SUMMARY_KEEP))
+    if not old:
+        return {"summarized": 0}
+    try:
+        summary = summarize_sync(conv.summary, old)
+    except Exception as e:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e, countdown=10)
+        log.exception("Conversation %s: summary failed", conv_id)
+        return {"summarized": 0}
+    if not summary:
+        return {"summarized": 0}
+    n = Conversation.objects.filter(pk=conv.id, summary_upto=conv.summary_upto).update(
+        summary=summary, summary_upto=old[-1]["id"], summary_updated_at=timezone.now())
+    return {"summarized": len(old) if n else 0}
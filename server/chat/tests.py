@@ -1,3 +1,523 @@
-from django.test import TestCase
+import asyncio
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
 
-# Create your tests here.
+import httpx
+import numpy as np
+from django.test import SimpleTestCase, override_settings
+from rest_framework.views import exception_handler
+from unittest import mock
+
+from chat.rag import cache as rag_cache
+from chat.rag.lexical import BM25Builder, BM25Index, rrf_fuse, tokenize
+from chat.rag.retriever import RagIndex
+from chat.services import history, llm, llm_context, rag_refs, response_cache
+from utils import llm_gateway
+from utils.llm_gateway import GatewayBusy, Priority
+
+
+@contextmanager
+def gateway(limits, queue_max=32, deadlines=None):
+    """Gateway mới (slot / hàng đợi / deadline riêng cho test), thay _GATEWAY của process."""
+    gw = llm_gateway.LLMGateway()
+    with mock.patch.dict(llm_gateway.LIMITS, limits), \
+            mock.patch.dict(llm_gateway.DEADLINES, deadlines or {}), \
+            mock.patch.object(llm_gateway, "QUEUE_MAX", queue_max), \
+            mock.patch.object(llm_gateway, "_GATEWAY", gw):
+        yield gw
+
+
+_LOCMEM = {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+
+
+class AsyncLLMConcurrencyTests(SimpleTestCase):
+    """Nhiều reply LLM chậm cùng lúc trên 1 event loop: không tốn thread, dùng chung 1 client."""
+
+    N = 200
+    DELAY = 0.3
+
+    def _client(self):
+        async def handler(request):
+            await asyncio.sleep(self.DELAY)  # giả lập Ollama generate chậm
+            return httpx.Response(200, json={"message": {"role": "assistant", "content": "ok"}})
+        return httpx.AsyncClient(transport=httpx.MockTransport(handler),
+                                 limits=httpx.Limits(max_connections=self.N))
+
+    def test_many_slow_replies_share_loop_and_client(self):
+        async def run():
+            client = self._client()
+            seen = set()
+
+            async def get_client():
+                seen.add(id(client))
+                return client
+
+            # đủ slot cho N request: test đo event loop / client, không đo giới hạn gateway
+            with mock.patch.object(llm, "_get_async_client", get_client), \
+                    gateway({"ollama": self.N}, queue_max=self.N):
+                threads_before = threading.active_count()
+                t0 = time.perf_counter()
+                results = await asyncio.gather(*[
+                    llm.call_llm("sys", [], f"hi {i}") for i in range(self.N)
+                ])
+                elapsed = time.perf_counter() - t0
+                threads_after = threading.active_count()
+            await client.aclose()
+            return results, elapsed, threads_before, threads_after, seen
+
+        results, elapsed, before, after, seen = asyncio.run(run())
+        self.assertEqual(len(results), self.N)
+        self.assertTrue(all(r["text"] == "ok" for r in results))
+        # chạy song song: tổng thời gian ~ 1 lần DELAY, không phải N * DELAY
+        self.assertLess(elapsed, self.DELAY * 5)
+        self.assertLessEqual(after - before, 2)
+        self.assertEqual(len(seen), 1)
+
+    def test_async_client_is_reused_within_loop_and_rebuilt_across_loops(self):
+        async def two():
+            return await llm._get_async_client(), await llm._get_async_client()
+
+        a1, a2 = asyncio.run(two())
+        b1, _ = asyncio.run(two())
+        self.assertIs(a1, a2)
+        self.assertIsNot(a1, b1)
+
+
+class LLMGatewayTests(SimpleTestCase):
+    def test_waiters_are_granted_by_priority(self):
+        async def run():
+            with gateway({"ollama": 1}) as gw:
+                holder = await gw.acquire_async("ollama", Priority.INTERACTIVE)
+                order = []
+
+                async def want(priority):
+                    lease = await gw.acquire_async("ollama", priority)
+                    order.append(priority)
+                    lease.release()
+
+                tasks = [asyncio.create_task(want(p))
+                         for p in (Priority.BATCH, Priority.INTERACTIVE, Priority.STREAM)]
+                await asyncio.sleep(0)  # cả 3 đã xếp hàng
+                self.assertEqual(gw.stats()["ollama"]["queued"], 3)
+                holder.release()
+                await asyncio.gather(*tasks)
+                return order, gw.stats()["ollama"]
+
+        order, stats = asyncio.run(run())
+        self.assertEqual(order, [Priority.STREAM, Priority.INTERACTIVE, Priority.BATCH])
+        self.assertEqual((stats["active"], stats["queued"], stats["granted"]), (0, 0, 4))
+
+    def test_full_queue_raises_busy_with_retry_after(self):
+        from chat.async_views import _busy
+
+        async def run():
+            with gateway({"ollama": 1}, queue_max=1) as gw:
+                holder = await gw.acquire_async("ollama")
+                waiter = asyncio.create_task(gw.acquire_async("ollama"))
+                await asyncio.sleep(0)
+                with self.assertRaises(GatewayBusy) as cm:
+                    await gw.acquire_async("ollama", Priority.STREAM)
+                holder.release()
+                (await waiter).release()
+                return cm.exception, gw.stats()["ollama"]
+
+        e, stats = asyncio.run(run())
+        self.assertEqual((e.provider, e.reason), ("ollama", "queue_full"))
+        self.assertGreater(e.retry_after, 0)
+        self.assertEqual(stats["rejected"], 1)
+        # view ASGI và view DRF sync đều trả 429 + Retry-After
+        for resp in (_busy(e), exception_handler(e, {})):
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(int(resp["Retry-After"]), int(e.retry_after + 0.999))
+
+    def test_waiter_past_deadline_gives_up_and_leaves_queue(self):
+        async def run():
+            with gateway({"ollama": 1}, deadlines={Priority.INTERACTIVE: 0.05}) as gw:
+                holder = await gw.acquire_async("ollama", Priority.STREAM)
+                t0 = time.perf_counter()
+                with self.assertRaises(GatewayBusy) as cm:
+                    await gw.acquire_async("ollama", Priority.INTERACTIVE)
+                waited = time.perf_counter() - t0
+                holder.release()
+                return cm.exception, waited, gw.stats()["ollama"]
+
+        e, waited, stats = asyncio.run(run())
+        self.assertEqual(e.reason, "deadline")
+        self.assertLess(waited, 1.0)
+        self.assertEqual((stats["timeouts"], stats["queued"], stats["active"]), (1, 0, 0))
+
+    def test_sync_waiter_past_deadline(self):
+        with gateway({"gemini": 1}, deadlines={Priority.BATCH: 0.05}) as gw:
+            with llm_gateway.slot("gemini", Priority.INTERACTIVE):
+                with self.assertRaises(GatewayBusy) as cm:
+                    gw.acquire("gemini", Priority.BATCH)
+            self.assertEqual(cm.exception.reason, "deadline")
+            self.assertEqual(gw.stats()["gemini"]["active"], 0)
+
+
+@override_settings(CACHES={"default": _LOCMEM, "shared": {**_LOCMEM, "LOCATION": "chat-kv"}})
+class KVContextTests(SimpleTestCase):
+    def test_context_is_stored_and_reused_for_next_turn(self):
+        sent = []
+
+        async def handler(request):
+            body = json.loads(request.content)
+            sent.append(body)
+            return httpx.Response(200, json={"response": "ok", "context": [1, 2, 3], "done": True,
+                                             "prompt_eval_count": 7})
+
+        async def run():
+            client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+            async def get_client():
+                return client
+
+            with mock.patch.object(llm_context, "_get_async_client", get_client), \
+                    gateway({"ollama": 2}):
+                first = await llm_context.call_llm_ctx("c1", "sys", [], "hi", n_prev=0)
+                second = await llm_context.call_llm_ctx("c1", "sys", [], "again", n_prev=2)
+                stale = await llm_context.call_llm_ctx("c1", "other sys", [], "x", n_prev=4)
+            await client.aclose()
+            return first, second, stale
+
+        first, second, stale = asyncio.run(run())
+        self.assertFalse(first["meta"]["llm"]["kv_reuse"])
+        self.assertNotIn("context", sent[0])
+        self.assertTrue(second["meta"]["llm"]["kv_reuse"])
+        self.assertEqual((sent[1]["context"], sent[1]["prompt"]), ([1, 2, 3], "again"))
+        self.assertNotIn("context", sent[2])  # system prompt đổi -> fingerprint lệch -> prompt đầy đủ
+        self.assertFalse(stale["meta"]["llm"]["kv_reuse"])
+
+
+    def test_global_lease_runs_off_the_event_loop(self):
+        threads = []
+
+        def try_acquire(provider):
+            threads.append(("acquire", threading.get_ident()))
+            return "tok"
+
+        def release(provider, token):
+            threads.append(("release", threading.get_ident(), token))
+
+        async def run():
+            with gateway({"ollama": 1}) as gw, mock.patch.dict(llm_gateway.GLOBAL_LIMITS, {"ollama": 1}), \
+                    mock.patch.object(gw._global, "try_acquire", try_acquire), \
+                    mock.patch.object(gw._global, "_release", release):
+                lease = await gw.acquire_async("ollama", Priority.STREAM)
+                lease.release()
+                for _ in range(100):  # zrem chạy nền trong BLOCKING_POOL
+                    if len(threads) == 2:
+                        break
+                    await asyncio.sleep(0.01)
+                return threading.get_ident(), lease.token
+
+        loop_thread, token = asyncio.run(run())
+        self.assertEqual(token, "tok")
+        self.assertEqual([t[0] for t in threads], ["acquire", "release"])
+        self.assertNotIn(loop_thread, [t[1] for t in threads])
+        self.assertEqual(threads[1][2], "tok")
+
+
+class HistoryBudgetTests(SimpleTestCase):
+    @staticmethod
+    def _rows(*contents):
+        return [{"id": i + 1, "role": "user" if i % 2 == 0 else "assistant", "content": c}
+                for i, c in enumerate(contents)]
+
+    def test_count_tokens(self):
+        self.assertEqual(history.count_tokens(""), 0)
+        self.assertEqual(history.count_tokens(None), 0)
+        self.assertEqual(history.count_tokens("Hi there!"), 1 + 2 + 1)
+        # từ dài ~ 1 token / 4 ký tự, dấu câu 1 token
+        self.assertEqual(history.count_tokens("internationalization."), 1 + 19 // 4 + 1)
+        self.assertEqual(history.count_tokens("Xin chào, bạn"), 4)
+        self.assertEqual(history.turn_tokens("Hi"), 1 + history.MSG_OVERHEAD)
+
+    def test_fit_budget_takes_newest_first_and_returns_oldest_first(self):
+        rows = self._rows("one", "two", "six", "ten")  # mỗi turn 1 + MSG_OVERHEAD = 5 token
+        desc = list(reversed(rows))
+        self.assertEqual([r["id"] for r in history.fit_budget(desc, 10)], [3, 4])
+        self.assertEqual([r["id"] for r in history.fit_budget(desc, 14)], [3, 4])
+        self.assertEqual([r["id"] for r in history.fit_budget(desc, 100)], [1, 2, 3, 4])
+        # luôn giữ ít nhất turn mới nhất, kể cả khi vượt budget
+        self.assertEqual([r["id"] for r in history.fit_budget(desc, 1)], [4])
+        self.assertEqual(history.fit_budget([], 10), [])
+
+    def test_split_for_summary(self):
+        rows = self._rows("one", "two", "six", "ten", "red")
+        old, keep = history.split_for_summary(rows, 10)
+        self.assertEqual(([r["id"] for r in old], [r["id"] for r in keep]), ([1, 2, 3], [4, 5]))
+        old, keep = history.split_for_summary(rows, 1000)
+        self.assertEqual((old, keep), ([], rows))
+        old, keep = history.split_for_summary(rows, 0)
+        self.assertEqual([r["id"] for r in keep], [5])
+
+    def test_schedule_summary_enqueues_off_the_loop(self):
+        conv = mock.Mock(id="c1", summary_upto=0)
+        rows = self._rows(*["word " * 50] * 4)
+        seen = []
+
+        async def atail(conv_id, after_id, limit):
+            return list(reversed(rows))
+
+        def delay(conv_id):
+            seen.append((conv_id, threading.get_ident()))
+
+        async def run():
+            with mock.patch.object(history, "_atail", atail), \
+                    mock.patch("chat.tasks.update_summary.delay", delay), \
+                    mock.patch.object(history, "TOKEN_BUDGET", 100):
+                return await history.amaybe_schedule_summary(conv), threading.get_ident()
+
+        scheduled, loop_thread = asyncio.run(run())
+        self.assertTrue(scheduled)
+        self.assertEqual(seen[0][0], "c1")
+        self.assertNotEqual(seen[0][1], loop_thread)
+
+
+class ChatRoutingTests(SimpleTestCase):
+    def test_async_views_win_over_schema_stubs(self):
+        from django.urls import resolve
+        from chat import async_views
+        self.assertIs(resolve("/api/chat/chat/message/").func, async_views.message)
+        self.assertIs(resolve("/api/chat/chat/stream/").func, async_views.stream)
+
+
+class BM25BuilderSpillTests(SimpleTestCase):
+    DOCS = ["the cat sat on the mat", "a dog and a cat", "hello world", "", "cat cat cat dog",
+            "world of dogs and cats", "mat mat", "hello cat"]
+
+    def test_spilled_runs_merge_to_same_index(self):
+        ref = BM25Builder()
+        ref.add(self.DOCS)
+        expected = ref.arrays()
+        for spill in (1, 3, 6, 1000):  # 1000: không spill lần nào
+            with tempfile.TemporaryDirectory() as tmp:
+                runs = os.path.join(tmp, "runs")
+                bld = BM25Builder(spill_dir=runs, spill_postings=spill)
+                for i in range(0, len(self.DOCS), 3):  # batch 3 doc, batch cuối lẻ -> còn phần chưa spill
+                    bld.add(self.DOCS[i:i + 3])
+                path = os.path.join(tmp, "bm25.npz")
+                bld.save(path)
+                self.assertFalse(os.path.exists(runs))
+                with np.load(path) as got:
+                    for k, v in expected.items():
+                        np.testing.assert_array_equal(got[k], v, err_msg=f"{k} spill={spill}")
+
+
+class BM25ScoringTests(SimpleTestCase):
+    DOCS = BM25BuilderSpillTests.DOCS
+
+    def _reference(self, query, k1=1.2, b=0.75):
+        """Okapi BM25 viết thẳng theo công thức, để đối chiếu bản CSR."""
+        docs = [tokenize(d) for d in self.DOCS]
+        avgdl = sum(map(len, docs)) / len(docs)
+        out = []
+        for toks in docs:
+            score = 0.0
+            for t in dict.fromkeys(tokenize(query)):
+                df = sum(t in d for d in docs)
+                tf = toks.count(t)
+                if not tf:
+                    continue
+                idf = math.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+                score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(toks) / avgdl))
+            out.append(score)
+        return out
+
+    def test_scores_match_okapi_formula(self):
+        idx = BM25Index.from_docs(self.DOCS)
+        for q in ("cat", "hello cat", "cat cat", "dog mat", "nothing here"):
+            np.testing.assert_allclose(idx.scores(q), self._reference(q), rtol=1e-5, atol=1e-6, err_msg=q)
+
+    def test_topk_orders_by_score_and_honours_mask(self):
+        idx = BM25Index.from_docs(self.DOCS)
+        ids, scores = idx.topk("cat", 3)
+        ref = self._reference("cat")
+        self.assertEqual(ids.tolist(), sorted(range(len(ref)), key=lambda i: -ref[i])[:3])
+        self.assertTrue(all(scores[:-1] >= scores[1:]))
+        self.assertEqual(ids[0], 4)  # "cat cat cat dog": tf cao nhất
+
+        mask = np.ones(len(self.DOCS), dtype=bool)
+        mask[4] = False
+        ids, _ = idx.topk("cat", 10, mask=mask)
+        self.assertNotIn(4, ids.tolist())
+        self.assertEqual(sorted(ids.tolist()), [0, 1, 7])  # chỉ doc chứa đúng token "cat" ("cats" không tính)
+        self.assertEqual(idx.topk("unknownword", 5)[0].size, 0)
+
+    def test_rrf_fuse_ordering(self):
+        vec = np.array([3, 1, 2])
+        lex = np.array([1, 5, 3])
+        ids, scores = rrf_fuse([vec, lex], k0=60)
+        # 1: 1/62 + 1/61, 3: 1/61 + 1/63, 2: 1/63, 5: 1/62
+        self.assertEqual(ids.tolist(), [1, 3, 5, 2])
+        self.assertAlmostEqual(float(scores[0]), 1 / 62 + 1 / 61, places=6)
+        self.assertTrue(all(scores[:-1] >= scores[1:]))
+        # tie -> giữ thứ tự xuất hiện đầu tiên
+        self.assertEqual(rrf_fuse([np.array([7]), np.array([8])])[0].tolist(), [7, 8])
+        self.assertEqual(rrf_fuse([np.array([], dtype="int64")])[0].size, 0)
+
+
+@override_settings(CACHES={"default": _LOCMEM, "shared": {**_LOCMEM, "LOCATION": "rag-cache"}})
+class RagCacheTests(SimpleTestCase):
+    DOCS = ["how to greet politely", "ordering coffee at a cafe", "saying goodbye to friends"]
+
+    def setUp(self):
+        rag_cache._backend().clear()
+        p = mock.patch.object(rag_cache, "ENABLED", True)
+        p.start()
+        self.addCleanup(p.stop)
+        self.embedder = mock.Mock()
+        self.embedder.embed_query.side_effect = lambda q: np.eye(3, dtype="float32")[0]
+        idx = RagIndex("/nonexistent")
+        idx.docs, idx.metas = list(self.DOCS), [{"language": "en"} for _ in self.DOCS]
+        idx.embs = np.eye(3, dtype="float32")
+        idx.bm25 = BM25Index.from_docs(self.DOCS)
+        idx.generation, idx._embedder, idx._loaded = "gen-1", self.embedder, True
+        self.idx = idx
+
+    def test_key_depends_on_generation_not_on_spelling_or_filter_order(self):
+        key = rag_cache.make_key("How to greet?", 3, "hybrid", "gen-1", topics=["b", "a"])
+        self.assertEqual(key, rag_cache.make_key("how to  greet", 3, "hybrid", "gen-1", topics=["a", "b"]))
+        self.assertNotEqual(key, rag_cache.make_key("how to greet", 3, "hybrid", "gen-2", topics=["a", "b"]))
+        self.assertNotEqual(key, rag_cache.make_key("how to greet", 4, "hybrid", "gen-1", topics=["a", "b"]))
+        self.assertNotEqual(key, rag_cache.make_key("how to greet", 3, "vector", "gen-1", topics=["a", "b"]))
+
+    def test_search_is_cached_until_generation_changes(self):
+        first = self.idx.search("greet politely", top_k=2, mode="hybrid")
+        again = self.idx.search("Greet politely?", top_k=2, mode="hybrid")
+        self.assertEqual(self.embedder.embed_query.call_count, 1)
+        self.assertEqual([h["id"] for h in again], [h["id"] for h in first])
+        self.assertEqual(again[0]["text"], self.DOCS[first[0]["id"]])
+
+        self.idx.generation = "gen-2"  # index build lại -> key cũ không còn dùng
+        self.idx.search("greet politely", top_k=2, mode="hybrid")
+        self.assertEqual(self.embedder.embed_query.call_count, 2)
+
+    def test_downgraded_results_are_not_cached(self):
+        self.embedder.embed_query.side_effect = RuntimeError("embedder down")
+        hits = self.idx.search("greet politely", top_k=2, mode="hybrid")
+        self.assertEqual(hits[0]["retrieval"]["mode"], "lexical")
+        self.assertIsNone(rag_cache.lookup(rag_cache.make_key("greet politely", 2, "hybrid", "gen-1")))
+
+        self.embedder.embed_query.side_effect = lambda q: np.eye(3, dtype="float32")[0]
+        hits = self.idx.search("greet politely", top_k=2, mode="hybrid")
+        self.assertEqual(hits[0]["retrieval"]["mode"], "hybrid")
+        self.assertIsNotNone(rag_cache.lookup(rag_cache.make_key("greet politely", 2, "hybrid", "gen-1")))
+
+
+@override_settings(CACHES={"default": _LOCMEM, "shared": {**_LOCMEM, "LOCATION": "response-cache"}})
+class ResponseCacheTests(SimpleTestCase):
+    @staticmethod
+    def _unit(cos):  # vector đơn vị có cosine = cos với [1, 0]
+        return np.array([cos, np.sqrt(1 - cos * cos)], dtype="float32")
+
+    def setUp(self):
+        response_cache._backend().clear()
+        vecs = {"How do I say hello?": self._unit(1.0), "How can I say hello?": self._unit(0.97),
+                "What is the past tense?": self._unit(0.80)}
+        for name, new in (("ENABLED", True), ("THRESHOLD", 0.95), ("_embed", lambda t: vecs[t])):
+            p = mock.patch.object(response_cache, name, new)
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _scope(self, generation="g1"):
+        return response_cache.make_scope(language="en", topic="greetings", system_prompt="sys", model="m",
+                                         generation=generation)
+
+    def test_hit_only_at_or_above_threshold(self):
+        scope = self._scope()
+        response_cache.store(scope, "How do I say hello?", "Just say hello!", turn_id=7)
+        hit = response_cache.lookup(scope, "How can I say hello?")
+        self.assertEqual((hit["answer"], hit["turn_id"], hit["question"]), ("Just say hello!", 7, "How do I say hello?"))
+        self.assertGreaterEqual(hit["score"], 0.95)
+        self.assertEqual(response_cache.provenance(hit)["source_turn"], 7)
+        self.assertIsNone(response_cache.lookup(scope, "What is the past tense?"))
+        with mock.patch.object(response_cache, "THRESHOLD", 0.98):
+            self.assertIsNone(response_cache.lookup(scope, "How can I say hello?"))
+        self.assertIsNone(response_cache.lookup(self._scope("g2"), "How do I say hello?"))  # index build lại
+        self.assertFalse(response_cache.cacheable("ok"))
+        st = response_cache.stats()
+        self.assertEqual((st["hits"], st["misses"], st["stores"]), (1, 3, 1))
+
+    def test_invalidate_bumps_version_and_orphans_old_scopes(self):
+        scope = self._scope()
+        response_cache.store(scope, "How do I say hello?", "Just say hello!")
+        self.assertEqual(response_cache.stats()["version"], 0)
+        response_cache.invalidate()
+        self.assertEqual(response_cache.stats()["version"], 1)
+        new_scope = self._scope()
+        self.assertNotEqual(new_scope, scope)
+        self.assertIsNone(response_cache.lookup(new_scope, "How do I say hello?"))
+        response_cache.invalidate()
+        self.assertEqual(response_cache.stats()["version"], 2)
+
+
+class _Rows:
+    # QuerySet.values() giả: duyệt được cả sync lẫn async
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    async def __aiter__(self):
+        for r in self.rows:
+            yield r
+
+
+class RagRefsTests(SimpleTestCase):
+    def setUp(self):
+        self.saved = {}
+
+        async def abulk_create(docs, ignore_conflicts=False):
+            self.assertTrue(ignore_conflicts)
+            for d in docs:
+                self.saved.setdefault(d.sha, {"sha": d.sha, "text": d.text, "meta": d.meta})
+
+        def filter(sha__in):
+            rows = [self.saved[s] for s in sha__in if s in self.saved]
+            return mock.Mock(values=lambda *f: _Rows(rows))
+
+        objects = mock.Mock(abulk_create=abulk_create, filter=filter)
+        p = mock.patch.object(rag_refs.RagDocText, "objects", objects)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def _meta(self):
+        hits = [{"id": 3, "score": 0.81, "text": "Hello means xin chào.", "meta": {"src": "a"}},
+                {"id": 5, "score": 0.62, "text": "Bye means tạm biệt.", "meta": {"src": "b"}},
+                {"id": 3, "score": 0.40, "text": "Hello means xin chào.", "meta": {"src": "a"}}]
+        return {"model": "m", "rag": {"used": True, "hits": hits}}
+
+    def test_compact_then_expand_round_trip(self):
+        stored = asyncio.run(rag_refs.acompact_meta(self._meta(), generation="g1"))
+        self.assertEqual(stored["model"], "m")
+        self.assertEqual(stored["rag"]["generation"], "g1")
+        self.assertTrue(all(set(h) == {"id", "score", "sha"} for h in stored["rag"]["hits"]))
+        self.assertEqual(len(self.saved), 2)  # tài liệu trùng chỉ lưu 1 lần
+        self.assertEqual(stored["rag"]["hits"][0]["sha"], stored["rag"]["hits"][2]["sha"])
+
+        [full] = asyncio.run(rag_refs.aexpand([stored]))
+        self.assertEqual(full["rag"]["generation"], "g1")
+        self.assertEqual([(h["id"], h["score"], h["doc"], h["meta"]) for h in full["rag"]["hits"]],
+                         [(3, 0.81, "Hello means xin chào.", {"src": "a"}),
+                          (5, 0.62, "Bye means tạm biệt.", {"src": "b"}),
+                          (3, 0.40, "Hello means xin chào.", {"src": "a"})])
+        self.assertEqual(rag_refs.expand([stored]), [full])
+
+    def test_expand_keeps_legacy_and_missing_refs(self):
+        stored = asyncio.run(rag_refs.acompact_meta(self._meta()))
+        self.assertNotIn("generation", stored["rag"])
+        self.saved.pop(stored["rag"]["hits"][1]["sha"])  # text đã bị xoá
+        legacy = {"rag": {"used": True, "hits": [{"score": 0.5, "meta": {}, "doc": "old"}]}}
+        full, old, plain = asyncio.run(rag_refs.aexpand([stored, legacy, {"model": "m"}]))
+        self.assertEqual(full["rag"]["hits"][0]["doc"], "Hello means xin chào.")
+        self.assertEqual(full["rag"]["hits"][1], stored["rag"]["hits"][1])
+        self.assertEqual((old, plain), (legacy, {"model": "m"}))
+        self.assertEqual(rag_refs.compact(stored["rag"]), (stored["rag"], []))  # đã là tham chiếu: giữ nguyên
@@ -1,8 +1,13 @@
 from django.urls import path
 from rest_framework.routers import DefaultRouter
 from .views import ChatViewSet
+from . import async_views
 
 router = DefaultRouter()
 router.register(r'chat', ChatViewSet, basename='chat')
 
-urlpatterns = router.urls
+# message/stream là view async (ASGI) -> khai báo trước router để được match trước
+urlpatterns = [
+    path('chat/message/', async_views.message, name='chat-message'),
+    path('chat/stream/', async_views.stream, name='chat-stream'),
+] + router.urls
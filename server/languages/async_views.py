@@ -0,0 +1,139 @@
+import json
+
+from django.core.exceptions import ValidationError
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from .models import PracticeSession
+from .serializers import PracticeSubmitIn
+from .services import aget_session, asave_session, practice_log
+from .services.practice_stream import aiter_practice_turn
+from utils.aio import ClosingStream, run_db
+from utils.llm_gateway import GatewayBusy, Priority, acquire_async
+
+# View async (ASGI) cho practice dạng pipeline: text từng câu + audio từng câu qua SSE.
+# Bản blocking (chờ đủ reply rồi mới TTS cả đoạn) vẫn là RoleplaySessionViewSet.submit_practice.
+
+
+def _sse(event: str, data) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n".encode("utf-8")
+
+
+def _busy(e: GatewayBusy) -> JsonResponse:
+    resp = JsonResponse({"detail": str(e.detail), "code": "llm_busy", "provider": e.provider},
+                        status=429, json_dumps_params={"ensure_ascii": False})
+    resp["Retry-After"] = str(int(e.retry_after + 0.999))
+    return resp
+
+
+def _jwt_user(request):
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+    try:
+        res = JWTAuthentication().authenticate(request)
+    except Exception:
+        return None
+    return res[0] if res else None
+
+
+async def _auser(request):
+    """View Django thuần không qua DRF: tự đọc Bearer token, không có thì dùng session auth."""
+    user = await run_db(_jwt_user, request)
+    return user or await request.auser()
+
+
+async def _load_session(sid):
+    sess = await aget_session(sid)
+    if sess:
+        return sess
+    try:
+        db_sess = await PracticeSession.objects.select_related("scenario").aget(id=sid)
+    except (PracticeSession.DoesNotExist, ValidationError, ValueError):
+        return None
+    sess = {
+        "mode": "practice",
+        "scenario_id": str(db_sess.scenario.id),
+        "scenario_slug": db_sess.scenario.slug,
+        "user_role": db_sess.role,
+        "system_context": db_sess.system_context,
+        "history": await practice_log.atail(db_sess.id),
+        "created_at": db_sess.created_at.timestamp(),
+    }
+    await asave_session(sid, sess)
+    return sess
+
+
+@csrf_exempt
+@require_POST
+async def submit_practice_stream(request):
+    """
+    POST /api/roleplay-session/submit-practice-stream/ — body như submit-practice.
+    text/event-stream: text {seq, text} ngay khi 1 câu reply đóng, audio {seq, audio} khi TTS câu đó xong
+    (đúng thứ tự seq), error?, rồi done (cùng shape response của submit-practice, ai_audio là list theo câu).
+    """
+    try:
+        body = json.loads(request.body or b"{}")
+    except ValueError:
+        return JsonResponse({"detail": "Invalid JSON"}, status=400)
+    ser = PracticeSubmitIn(data=body)
+    if not ser.is_valid():
+        return JsonResponse(ser.errors, status=400)
+    sid = ser.validated_data["session_id"]
+    transcript = ser.validated_data["transcript"]
+
+    sess = await _load_session(sid)
+    if not sess:
+        return JsonResponse({"detail": "Invalid session"}, status=400)
+    if sess.get("mode") != "practice":
+        return JsonResponse({"detail": "Session mode mismatch"}, status=400)
+    user = await _auser(request)
+
+    # Giành slot Gemini trước khi trả 200: quá tải -> 429 thay vì stream lỗi giữa chừng
+    try:
+        lease = await acquire_async("gemini", Priority.STREAM)
+    except GatewayBusy as e:
+        return _busy(e)
+
+    history = sess.get("history", [])
+    turn = aiter_practice_turn(sess.get("system_context", ""), history, transcript,
+                               scenario_slug=sess.get("scenario_slug"), lang="en", lease=lease)
+
+    async def gen():
+        audio = []
+        try:
+            async for ev in turn:
+                kind = ev.pop("type")
+                if kind == "audio":
+                    audio.append(ev["audio"])
+                if kind != "done":
+                    yield _sse(kind, ev)
+                    continue
+
+                ai_reply = ev.get("reply") or "..."
+                correction = ev.get("corrected")
+                new_turns = [{"role": "user", "parts": [transcript]}, {"role": "model", "parts": [ai_reply]}]
+                sess["history"] = practice_log.trim(history + new_turns)
+                await asave_session(sid, sess)
+                if user is not None and user.is_authenticated:
+                    await practice_log.aappend_turns(sid, new_turns)
+
+                yield _sse("done", {
+                    "user_transcript": transcript,
+                    "ai_text": ai_reply,
+                    "ai_trans": ev.get("reply_trans", ""),
+                    "ai_audio": audio,
+                    "feedback": {
+                        "has_error": bool(correction),
+                        "original": transcript,
+                        "corrected": correction,
+                        "explanation": ev.get("explanation"),
+                    },
+                })
+        finally:
+            await turn.aclose()  # client ngắt -> huỷ stream Gemini + các TTS đang chạy
+            lease.release()
+
+    resp = StreamingHttpResponse(ClosingStream(gen(), lease.release), content_type="text/event-stream; charset=utf-8")
+    resp["Cache-Control"] = "no-cache"
+    resp["X-Accel-Buffering"] = "no"
+    return resp
@@ -1,8 +1,10 @@
+import asyncio
+import logging
 import uuid
 import time
 
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from django.shortcuts import get_object_or_404
+from django.core.exceptions import ValidationError
 
 from .models import (
     RoleplayScenario,
@@ -11,21 +13,55 @@ from .models import (
 )
 from .serializers import RoleplayBlockReadSerializer
 from .services import (
-    save_session,
-    get_session,
-    ask_gemini_chat,
+    asave_session,
+    aget_session,
+    aask_gemini_chat,
 )
-from speech.services_block_tts import generate_tts_from_text
+from .services import practice_log
+from .services.practice_stream import aiter_practice_turn
+from speech.services_block_tts import agenerate_tts_from_text
+from utils import loop_monitor
+from utils.aio import run_blocking
+from utils.llm_gateway import GatewayBusy
+
+log = logging.getLogger(__name__)
 
 
 class PracticeConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Mọi bước của 1 lượt practice đều là I/O async (ORM async, cache async, Gemini *_async,
+    Piper/ffmpeg qua asyncio subprocess) -> không chặn event loop của các socket khác trên worker.
+    Mỗi lượt chạy thành task riêng của connection: đóng socket -> huỷ task (và giết subprocess TTS).
+    """
 
     async def connect(self):
+        self._tasks = set()
+        self._turn_lock = asyncio.Lock()  # các lượt của 1 connection chạy lần lượt (history trong session)
+        loop_monitor.ensure_started()
         await self.accept()
 
     async def disconnect(self, close_code):
-        # Có thể cleanup session nếu muốn
-        pass
+        tasks = list(getattr(self, "_tasks", ()))
+        for t in tasks:
+            t.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self, coro):
+        t = asyncio.get_running_loop().create_task(self._guard(coro))
+        self._tasks.add(t)
+        t.add_done_callback(self._tasks.discard)
+        return t
+
+    async def _guard(self, coro):
+        try:
+            async with self._turn_lock:
+                await coro
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.exception("Practice handler failed")
+            await self.send_json({"type": "error", "detail": str(e) or e.__class__.__name__})
 
     # ===============================
     # ROUTER
@@ -33,11 +69,18 @@ class PracticeConsumer(AsyncJsonWebsocketConsumer):
     async def receive_json(self, content):
         msg_type = content.get("type")
 
+        # không await handler ở đây: receive_json trả về ngay để còn nhận tin kế tiếp / disconnect
         if msg_type == "start_practice":
-            await self.start_practice(content)
+            self._spawn(self.start_practice(content))
+
+        elif msg_type == "submit_practice" and content.get("stream"):
+            self._spawn(self.submit_practice_stream(content))
 
         elif msg_type == "submit_practice":
-            await self.submit_practice(content)
+            self._spawn(self.submit_practice(content))
+
+        elif msg_type == "loop_stats":
+            await self.send_json({"type": "loop_stats", **loop_monitor.stats()})
 
         else:
             await self.send_json({
@@ -53,19 +96,21 @@ class PracticeConsumer(AsyncJsonWebsocketConsumer):
         role = data["role"]
         language = data.get("language", "vi")
 
-        scn = (
-            RoleplayScenario.objects.filter(slug=sc_slug).first()
-            or get_object_or_404(RoleplayScenario, id=sc_slug)
-        )
-
-        all_blocks = RoleplayBlock.objects.filter(
-            scenario=scn
-        ).order_by("order")
+        scn = await RoleplayScenario.objects.filter(slug=sc_slug).afirst()
+        if scn is None:
+            try:
+                scn = await RoleplayScenario.objects.aget(id=sc_slug)
+            except (RoleplayScenario.DoesNotExist, ValidationError, ValueError):
+                await self.send_json({
+                    "type": "error",
+                    "detail": "Scenario not found"
+                })
+                return
 
         context_blocks = []
         warmup_blocks = []
 
-        for b in all_blocks:
+        async for b in RoleplayBlock.objects.filter(scenario=scn).order_by("order"):
             if b.section == "warmup":
                 warmup_blocks.append(b)
             else:
@@ -101,7 +146,7 @@ You are an AI language tutor participating in a roleplay conversation...
 
         sid = str(uuid.uuid4())
 
-        save_session(sid, {
+        await asave_session(sid, {
             "mode": "practice",
             "scenario_id": str(scn.id),
             "user_role": role,
@@ -111,13 +156,13 @@ You are an AI language tutor participating in a roleplay conversation...
             "language": language,
         })
 
+        # serialize vector embedding của từng block tốn CPU -> pool blocking
+        prologue = await run_blocking(lambda: RoleplayBlockReadSerializer(context_blocks, many=True).data)
+
         await self.send_json({
             "type": "practice_started",
             "session_id": sid,
-            "prologue": [
-                RoleplayBlockReadSerializer(b).data
-                for b in context_blocks
-            ],
+            "prologue": prologue,
             "ai_greeting": ai_greeting_data
         })
 
@@ -128,7 +173,7 @@ You are an AI language tutor participating in a roleplay conversation...
         sid = data["session_id"]
         transcript = data["transcript"]
 
-        sess = get_session(sid)
+        sess = await aget_session(sid)
 
         if not sess:
             await self.send_json({
@@ -140,19 +185,28 @@ You are an AI language tutor participating in a roleplay conversation...
         history = sess.get("history", [])
         sys_ctx = sess.get("system_context", "")
 
-        ai_data = ask_gemini_chat(sys_ctx, history, transcript)
+        try:
+            ai_data = await aask_gemini_chat(sys_ctx, history, transcript)
+        except GatewayBusy as e:
+            await self.send_json({
+                "type": "error",
+                "code": "llm_busy",
+                "detail": str(e.detail),
+                "retry_after": e.retry_after,
+            })
+            return
 
         ai_reply = ai_data.get("reply") or "..."
         correction = ai_data.get("corrected")
         explanation = ai_data.get("explanation")
 
-        history.append({"role": "user", "parts": [transcript]})
-        history.append({"role": "model", "parts": [ai_reply]})
+        sess["history"] = practice_log.trim(history + [
+            {"role": "user", "parts": [transcript]},
+            {"role": "model", "parts": [ai_reply]},
+        ])
+        await asave_session(sid, sess)
 
-        sess["history"] = history
-        save_session(sid, sess)
-
-        ai_audio = generate_tts_from_text(ai_reply, lang="en")
+        ai_audio = await agenerate_tts_from_text(ai_reply, lang="en")
 
         await self.send_json({
             "type": "ai_reply",
@@ -166,3 +220,73 @@ You are an AI language tutor participating in a roleplay conversation...
                 "explanation": explanation
             }
         })
+
+    # ===============================
+    # SUBMIT PRACTICE (PIPELINE)
+    # ===============================
+    async def submit_practice_stream(self, data):
+        """
+        {"type": "submit_practice", "stream": true, ...}: ai_text_chunk {seq, text} từng câu ngay khi câu đóng,
+        ai_audio_chunk {seq, audio} theo thứ tự seq -> client phát câu 1 khi model còn đang sinh câu sau;
+        cuối cùng ai_reply như bản thường (ai_audio là list theo câu).
+        """
+        sid = data["session_id"]
+        transcript = data["transcript"]
+
+        sess = await aget_session(sid)
+
+        if not sess:
+            await self.send_json({
+                "type": "error",
+                "detail": "Invalid session"
+            })
+            return
+
+        history = sess.get("history", [])
+        audio, ai_data = [], {}
+        turn = aiter_practice_turn(sess.get("system_context", ""), history, transcript,
+                                   scenario_slug=sess.get("scenario_slug"), lang="en")
+        try:
+            async for ev in turn:
+                kind = ev.pop("type")
+                if kind == "text":
+                    await self.send_json({"type": "ai_text_chunk", **ev})
+                elif kind == "audio":
+                    audio.append(ev["audio"])
+                    await self.send_json({"type": "ai_audio_chunk", **ev})
+                elif kind == "error":
+                    await self.send_json({"type": "error", **ev})
+                else:
+                    ai_data = ev
+        except GatewayBusy as e:
+            await self.send_json({
+                "type": "error",
+                "code": "llm_busy",
+                "detail": str(e.detail),
+                "retry_after": e.retry_after,
+            })
+            return
+        finally:
+            await turn.aclose()
+
+        ai_reply = ai_data.get("reply") or "..."
+        correction = ai_data.get("corrected")
+
+        sess["history"] = practice_log.trim(history + [
+            {"role": "user", "parts": [transcript]},
+            {"role": "model", "parts": [ai_reply]},
+        ])
+        await asave_session(sid, sess)
+
+        await self.send_json({
+            "type": "ai_reply",
+            "user_transcript": transcript,
+            "ai_text": ai_reply,
+            "ai_audio": audio,
+            "feedback": {
+                "has_error": bool(correction),
+                "original": transcript,
+                "corrected": correction,
+                "explanation": ai_data.get("explanation")
+            }
+        })
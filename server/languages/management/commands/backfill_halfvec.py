@@ -0,0 +1,53 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from languages.models import RoleplayBlock, RoleplayScenario
+from languages.services.vector_search import STORAGE, sync_indexes
+
+
+class Command(BaseCommand):
+    help = ("Điền embedding_half (halfvec) từ cột embedding float32, theo batch (không cần gọi lại model embed), "
+            "rồi chỉ giữ HNSW của storage được chọn (mặc định PGVECTOR_STORAGE). Migration luôn dựng HNSW trên "
+            "embedding: chạy lệnh này khi deploy với PGVECTOR_STORAGE=halfvec / sau mỗi lần đổi.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--model", choices=["block", "scenario", "all"], default="all")
+        parser.add_argument("--batch-size", type=int, default=2000)
+        parser.add_argument("--force", action="store_true", help="Ghi đè cả các dòng đã có embedding_half")
+        parser.add_argument("--storage", choices=["vector", "halfvec"], default=STORAGE,
+                            help="HNSW cần giữ (mặc định PGVECTOR_STORAGE)")
+        parser.add_argument("--skip-indexes", action="store_true", help="Không đổi HNSW")
+
+    def handle(self, *args, **o):
+        models = {"block": [RoleplayBlock], "scenario": [RoleplayScenario],
+                  "all": [RoleplayScenario, RoleplayBlock]}[o["model"]]
+        for Model in models:
+            table = Model._meta.db_table
+            dim = Model._meta.get_field("embedding_half").dimensions
+            if o["force"]:
+                with connection.cursor() as cur:
+                    cur.execute(f"UPDATE {table} SET embedding_half = NULL WHERE embedding_half IS NOT NULL")
+            total, t0 = 0, time.perf_counter()
+            while True:
+                # mỗi batch 1 transaction ngắn -> không khoá cả bảng, dừng giữa chừng chạy lại được
+                with transaction.atomic(), connection.cursor() as cur:
+                    cur.execute(
+                        f"UPDATE {table} SET embedding_half = embedding::halfvec({dim}) "
+                        f"WHERE id IN (SELECT id FROM {table} "
+                        f"WHERE embedding IS NOT NULL AND embedding_half IS NULL LIMIT %s)",
+                        [o["batch_size"]],
+                    )
+                    n = cur.rowcount
+                if not n:
+                    break
+                total += n
+                self.stdout.write(f"  {Model.__name__}: {total} rows")
+            self.stdout.write(self.style.SUCCESS(
+                f"{Model.__name__}: backfilled {total} rows in {time.perf_counter() - t0:.1f}s"
+            ))
+        if not o["skip_indexes"]:
+            t0 = time.perf_counter()
+            sync_indexes(mode=o["storage"])
+            self.stdout.write(self.style.SUCCESS(
+                f"HNSW indexes synced for storage={o['storage']} in {time.perf_counter() - t0:.1f}s"
+            ))
@@ -0,0 +1,66 @@
+import random, statistics, time
+from django.core.management.base import BaseCommand, CommandError
+from pgvector.django import CosineDistance
+from languages.models import RoleplayBlock, RoleplayScenario
+from languages.services.vector_search import ann_session, exact_scan
+
+
+class Command(BaseCommand):
+    help = "So sánh latency + recall@k của HNSW (theo từng ef_search) với quét tuần tự chính xác."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--model", choices=["block", "scenario"], default="block")
+        parser.add_argument("--queries", type=int, default=50, help="Số query (lấy embedding có sẵn trong DB)")
+        parser.add_argument("--k", type=int, default=8)
+        parser.add_argument("--ef", type=int, nargs="*", default=[20, 40, 80, 160])
+        parser.add_argument("--scenario", default=None, help="slug: benchmark kèm filter scenario (chỉ với block)")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **o):
+        Model = RoleplayBlock if o["model"] == "block" else RoleplayScenario
+        k = o["k"]
+        base = Model.objects.exclude(embedding__isnull=True)
+        filtered = False
+        if o["scenario"]:
+            if Model is not RoleplayScenario:
+                scn_id = RoleplayScenario.objects.filter(slug=o["scenario"]).values_list("id", flat=True).first()
+                if scn_id is None:
+                    raise CommandError(f"Scenario '{o['scenario']}' not found")
+                base = base.filter(scenario_id=scn_id)
+                filtered = True
+
+        ids = list(Model.objects.exclude(embedding__isnull=True).values_list("id", flat=True))
+        if not ids:
+            raise CommandError("No embeddings found. Run embed_all first.")
+        random.Random(o["seed"]).shuffle(ids)
+        vecs = [list(v) for v in Model.objects.filter(id__in=ids[:o["queries"]]).values_list("embedding", flat=True)]
+
+        def run(vec):
+            qs = base.annotate(d=CosineDistance("embedding", vec)).order_by("d").values_list("id", flat=True)[:k]
+            t0 = time.perf_counter()
+            res = list(qs)
+            return res, (time.perf_counter() - t0) * 1000
+
+        def pct(xs, p):
+            xs = sorted(xs)
+            return xs[min(len(xs) - 1, int(round(p * (len(xs) - 1))))]
+
+        truth, lat = [], []
+        for v in vecs:
+            with exact_scan():
+                r, ms = run(v)
+            truth.append(set(r)); lat.append(ms)
+        self.stdout.write(f"{Model.__name__}: {len(ids)} rows, {len(vecs)} queries, k={k}, filtered={filtered}")
+        self.stdout.write(f"  exact     p50={statistics.median(lat):7.2f}ms  p95={pct(lat, .95):7.2f}ms  recall=1.0000")
+
+        for ef in o["ef"]:
+            lat, rec = [], []
+            for v, t in zip(vecs, truth):
+                with ann_session(k, ef, filtered=filtered):
+                    r, ms = run(v)
+                lat.append(ms)
+                rec.append(len(t & set(r)) / len(t) if t else 1.0)
+            self.stdout.write(
+                f"  hnsw ef={ef:<4} p50={statistics.median(lat):7.2f}ms  p95={pct(lat, .95):7.2f}ms  "
+                f"recall={statistics.mean(rec):.4f}"
+            )
@@ -0,0 +1,23 @@
+import time
+from django.core.management.base import BaseCommand
+
+from languages.services.gemini_fake import FakeGemini
+
+
+class Command(BaseCommand):
+    help = "Chạy server Gemini giả (REST) cho dev/test: GEMINI_API_ENDPOINT=http://127.0.0.1:<port> GEMINI_TRANSPORT=rest"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--delay", type=float, default=0.0, help="Giây chờ giả lập mỗi request")
+
+    def handle(self, *args, **o):
+        with FakeGemini(host=o["host"], port=o["port"], delay_s=o["delay"]) as fake:
+            self.stdout.write(self.style.SUCCESS(f"Fake Gemini on {fake.url} (Ctrl+C to stop)"))
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                pass
+        self.stdout.write(f"{len(fake.requests)} requests served")
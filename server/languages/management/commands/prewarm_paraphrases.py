@@ -0,0 +1,35 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from languages.models import RoleplayScenario
+from languages.services.paraphrase import POOL_SIZE, warm_scenarios
+from languages.services.roleplay_flow import ordered_blocks, split_prologue_and_dialogue
+
+
+class Command(BaseCommand):
+    help = "Điền sẵn pool biến thể paraphrase cho các scenario phổ biến (1 request Gemini / scenario, chạy song song)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--top", type=int, default=20, help="N scenario có nhiều phiên practice nhất")
+        parser.add_argument("--scenario", nargs="*", default=[], help="slug cụ thể (bỏ qua --top)")
+        parser.add_argument("--rounds", type=int, default=POOL_SIZE,
+                            help="số lượt fill tối đa (mỗi lượt thêm biến thể còn thiếu tới PARAPHRASE_POOL_SIZE)")
+
+    def handle(self, *args, **o):
+        qs = RoleplayScenario.objects.filter(is_active=True).prefetch_related("blocks")
+        if o["scenario"]:
+            qs = qs.filter(slug__in=o["scenario"])
+        else:
+            qs = qs.annotate(n=Count("practice_sessions")).order_by("-n", "order")[:o["top"]]
+        scenarios = list(qs)
+        items = [(split_prologue_and_dialogue(ordered_blocks(s))[1], s.level) for s in scenarios]
+
+        t0 = time.perf_counter()
+        for r in range(max(1, o["rounds"])):
+            added = warm_scenarios(items)
+            self.stdout.write(f"  round {r + 1}: +{sum(added)} variants")
+            if not any(added):
+                break
+        self.stdout.write(self.style.SUCCESS(
+            f"Warmed {len(scenarios)} scenarios in {time.perf_counter() - t0:.1f}s"
+        ))
@@ -0,0 +1,51 @@
+import pgvector.django.halfvec
+from django.db import migrations
+
+# ANN cho RoleplayBlock / RoleplayScenario:
+#   - embedding_half (halfvec) luôn ghi cùng embedding; điền sẵn cho các dòng đã có vector
+#   - HNSW mặc định trên embedding (vector_cosine_ops). Chuyển sang HNSW trên embedding_half khi chạy
+#     PGVECTOR_STORAGE=halfvec là việc của `manage.py backfill_halfvec` (vector_search.sync_indexes),
+#     không phụ thuộc môi trường lúc migrate. Index không nằm trong Meta.indexes (state) vì đổi theo mode.
+MODELS = ("RoleplayBlock", "RoleplayScenario")
+HNSW = (
+    ("rpblock_emb_hnsw", "languages_roleplayblock"),
+    ("rpscenario_emb_hnsw", "languages_roleplayscenario"),
+)
+
+
+def backfill_half(apps, schema_editor):
+    with schema_editor.connection.cursor() as cur:
+        for name in MODELS:
+            Model = apps.get_model("languages", name)
+            dim = Model._meta.get_field("embedding_half").dimensions
+            cur.execute(f"UPDATE {Model._meta.db_table} SET embedding_half = embedding::halfvec({dim}) "
+                        f"WHERE embedding IS NOT NULL")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('languages', '0011_pronunciationprompt_tts_duration_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='roleplayblock',
+            name='embedding_half',
+            field=pgvector.django.halfvec.HalfVectorField(blank=True, dimensions=768, null=True),
+        ),
+        migrations.AddField(
+            model_name='roleplayscenario',
+            name='embedding_half',
+            field=pgvector.django.halfvec.HalfVectorField(blank=True, dimensions=768, null=True),
+        ),
+        migrations.RunPython(backfill_half, migrations.RunPython.noop),
+        *[
+            migrations.RunSQL(
+                f"CREATE INDEX IF NOT EXISTS {name} ON {table} "
+                f"USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64)",
+                f"DROP INDEX IF EXISTS {name}",
+            )
+            for name, table in HNSW
+        ],
+    ]
@@ -0,0 +1,22 @@
+import pgvector.django.vector
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('languages', '0013_embeddingjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='roleplayblock',
+            name='answer_embedding',
+            field=pgvector.django.vector.VectorField(blank=True, dimensions=768, null=True),
+        ),
+        migrations.AddField(
+            model_name='roleplayblock',
+            name='answer_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
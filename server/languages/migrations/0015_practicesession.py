@@ -0,0 +1,46 @@
+import uuid
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_if_missing(apps, schema_editor):
+    # PracticeSession chưa từng có migration: DB cũ có thể đã có bảng (dựng ngoài migration) kèm history_log thật
+    # -> giữ nguyên bảng đó để 0016 chép lịch sử sang PracticeTurn; DB mới thì tạo theo state.
+    PracticeSession = apps.get_model("languages", "PracticeSession")
+    if PracticeSession._meta.db_table not in schema_editor.connection.introspection.table_names():
+        schema_editor.create_model(PracticeSession)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('languages', '0014_roleplayblock_answer_embedding'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='PracticeSession',
+                    fields=[
+                        ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                        ('role', models.CharField(max_length=50)),
+                        ('history_log', models.JSONField(blank=True, default=list)),
+                        ('system_context', models.TextField(blank=True, default='')),
+                        ('created_at', models.DateTimeField(auto_now_add=True)),
+                        ('updated_at', models.DateTimeField(auto_now=True)),
+                        ('scenario', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='practice_sessions', to='languages.roleplayscenario')),
+                        ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='practice_sessions', to=settings.AUTH_USER_MODEL)),
+                    ],
+                    options={
+                        'ordering': ['-updated_at'],
+                        'indexes': [models.Index(fields=['user', 'scenario'], name='languages_p_user_id_78c83b_idx')],
+                    },
+                ),
+            ],
+        ),
+        migrations.RunPython(create_if_missing, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_history_log(apps, schema_editor):
+    PracticeSession = apps.get_model("languages", "PracticeSession")
+    PracticeTurn = apps.get_model("languages", "PracticeTurn")
+    for sess in PracticeSession.objects.exclude(history_log=[]).only("id", "history_log").iterator(chunk_size=200):
+        rows = [
+            PracticeTurn(session_id=sess.id, seq=i, role=(h or {}).get("role") or "user",
+                         text=" ".join(str(p) for p in ((h or {}).get("parts") or [])))
+            for i, h in enumerate(sess.history_log or [])
+        ]
+        PracticeTurn.objects.bulk_create(rows, batch_size=500)
+        PracticeSession.objects.filter(id=sess.id).update(turn_count=len(rows))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('languages', '0015_practicesession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='practicesession',
+            name='turn_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='PracticeTurn',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('seq', models.PositiveIntegerField()),
+                ('role', models.CharField(max_length=16)),
+                ('text', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='turns', to='languages.practicesession')),
+            ],
+            options={
+                'ordering': ['session_id', 'seq'],
+                'constraints': [models.UniqueConstraint(fields=('session', 'seq'), name='uq_practiceturn_session_seq')],
+            },
+        ),
+        migrations.RunPython(copy_history_log, migrations.RunPython.noop),
+    ]
@@ -4,7 +4,7 @@ from django.db import models
 from users.models import User
 import uuid
 from django.utils.text import slugify
-from pgvector.django import VectorField
+from pgvector.django import VectorField, HalfVectorField
 
 
 class Language(models.Model):
@@ -422,6 +422,8 @@ class RoleplayScenario(models.Model):
     embedding_updated_at = models.DateTimeField(null=True, blank=True)
     embedding_hash = models.CharField(max_length=64, blank=True, default="")
     embedding_model = models.CharField(max_length=100, blank=True, default="")
+    # bản half-precision (2 byte/chiều), luôn ghi cùng embedding; ANN dùng cột này khi PGVECTOR_STORAGE=halfvec
+    embedding_half = HalfVectorField(dimensions=768, null=True, blank=True)
 
 
     class Meta:
@@ -429,6 +431,7 @@ class RoleplayScenario(models.Model):
         indexes = [
             models.Index(fields=["order"]),
             models.Index(fields=["level"]),
+            # HNSW: migration 0012 dựng bản vector; đổi theo PGVECTOR_STORAGE bằng manage.py backfill_halfvec
         ]
 
     def save(self, *args, **kwargs):
@@ -477,6 +480,11 @@ class RoleplayBlock(models.Model):
     embedding_updated_at = models.DateTimeField(null=True, blank=True)
     embedding_hash = models.CharField(max_length=64, blank=True, default="")
     embedding_model = models.CharField(max_length=100, blank=True, default="")
+    # bản half-precision (2 byte/chiều), luôn ghi cùng embedding; ANN dùng cột này khi PGVECTOR_STORAGE=halfvec
+    embedding_half = HalfVectorField(dimensions=768, null=True, blank=True)
+    # vector của đáp án (text đã text_norm.normalize_answer) cho validate_turn, embed sẵn lúc lưu block dialogue
+    answer_embedding = VectorField(dimensions=768, null=True, blank=True)
+    answer_hash = models.CharField(max_length=64, blank=True, default="")  # sha256(model:text chuẩn hoá)
 
 
     class Meta:
@@ -488,6 +496,7 @@ class RoleplayBlock(models.Model):
             models.Index(fields=["scenario", "section", "order"]),
             models.Index(fields=["section"]),
             models.Index(fields=["role"]),
+            # HNSW: migration 0012 dựng bản vector; đổi theo PGVECTOR_STORAGE bằng manage.py backfill_halfvec
         ]
 
     def __str__(self):
@@ -500,8 +509,10 @@ class PracticeSession(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="practice_sessions")
     scenario = models.ForeignKey(RoleplayScenario, on_delete=models.CASCADE, related_name="practice_sessions")
     role = models.CharField(max_length=50) 
+    # legacy: không còn ghi, các lượt nằm ở PracticeTurn (migration 0016 đã chép sang)
     history_log = models.JSONField(default=list, blank=True)
     system_context = models.TextField(blank=True, default="")
+    turn_count = models.PositiveIntegerField(default=0)  # seq kế tiếp của PracticeTurn
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -512,4 +523,58 @@ class PracticeSession(models.Model):
         ]
 
     def __str__(self):
-        return f"{self.user.username} - {self.scenario.title}"
\ No newline at end of file
+        return f"{self.user.username} - {self.scenario.title}"
+
+
+class PracticeTurn(models.Model):
+    """1 lượt hội thoại practice, chỉ INSERT (languages.services.practice_log). role theo Gemini: user | model."""
+    id = models.BigAutoField(primary_key=True)
+    session = models.ForeignKey(PracticeSession, on_delete=models.CASCADE, related_name="turns")
+    seq = models.PositiveIntegerField()
+    role = models.CharField(max_length=16)
+    text = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["session_id", "seq"]
+        constraints = [
+            models.UniqueConstraint(fields=["session", "seq"], name="uq_practiceturn_session_seq")
+        ]
+
+    def __str__(self):
+        return f"{self.session_id} #{self.seq} {self.role}"
+
+class EmbeddingJob(models.Model):
+    """Tiến độ 1 lần re-embed hàng loạt (languages.tasks). Chạy lại = chỉ xử lý các dòng còn stale."""
+    class Kind(models.TextChoices):
+        BLOCKS    = "blocks",    "Roleplay blocks"
+        SCENARIOS = "scenarios", "Roleplay scenarios"
+
+    class Status(models.TextChoices):
+        PENDING   = "pending",   "Pending"
+        RUNNING   = "running",   "Running"
+        COMPLETED = "completed", "Completed"
+        FAILED    = "failed",    "Failed"
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField(max_length=16, choices=Kind.choices, default=Kind.BLOCKS)
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.PENDING)
+    force = models.BooleanField(default=False)
+    chunk_size = models.PositiveIntegerField(default=128)
+    model = models.CharField(max_length=100, blank=True, default="")
+    total = models.PositiveIntegerField(default=0)       # số dòng stale lúc scan
+    done = models.PositiveIntegerField(default=0)        # số dòng đã embed + commit
+    failed = models.PositiveIntegerField(default=0)      # số dòng thuộc chunk lỗi (hết retry)
+    chunks_total = models.PositiveIntegerField(default=0)
+    chunks_done = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default="")
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name="+")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return f"{self.kind} · {self.status} · {self.done}/{self.total}"
@@ -738,6 +738,11 @@ class PracticeSubmitIn(serializers.Serializer):
     session_id = serializers.CharField()
     transcript = serializers.CharField()
 
+class EmbedJobIn(serializers.Serializer):
+    kind = serializers.ChoiceField(choices=EmbeddingJob.Kind.choices, default=EmbeddingJob.Kind.BLOCKS)
+    force = serializers.BooleanField(required=False, default=False)
+    chunk_size = serializers.IntegerField(required=False, default=128, min_value=1, max_value=2000)
+
 class PracticeSessionSerializer(serializers.ModelSerializer):
     title = serializers.CharField(source='scenario.title', read_only=True)
     level = serializers.CharField(source='scenario.level', read_only=True)
@@ -754,6 +759,8 @@ class PracticeSessionDetailSerializer(serializers.ModelSerializer):
     scenario_slug = serializers.CharField(source='scenario.slug', read_only=True)
     
     scenario = serializers.UUIDField(source='scenario_id', read_only=True)
+    # tương thích client cũ: các lượt giờ nằm ở PracticeTurn, trả lại đúng shape [{role, parts: [text]}]
+    history_log = serializers.SerializerMethodField()
 
     class Meta:
         model = PracticeSession
@@ -770,4 +777,8 @@ class PracticeSessionDetailSerializer(serializers.ModelSerializer):
             "created_at", 
             "updated_at"
         ]
-        read_only_fields = fields
\ No newline at end of file
+        read_only_fields = fields
+
+    def get_history_log(self, obj):
+        from languages.services.practice_log import history_log
+        return history_log(obj)
\ No newline at end of file
@@ -1,11 +1,13 @@
 from .ai_speaker import ai_lines_for, _paraphrase_lines, _plain_lines
-from .embed_pipeline import embed_blocks, embed_scenarios, mark_dirty_blocks,mark_dirty_scenarios
+from .embed_pipeline import embed_blocks, embed_scenarios
+from .embed_text import mark_dirty_blocks, mark_dirty_scenarios
 from .ollama_client import embed_one, embed_many, _resize
-from .rag import ask_gemini_chat, ask_gemini
+from .rag import ask_gemini_chat, aask_gemini_chat, ask_gemini
 from .roleplay_flow import ordered_blocks, practice_blocks, split_prologue_and_dialogue, PRACTICE_SECTIONS, ORDER_PRIORITY
-from .session_mem import create_session, get_session, save_session 
+from .text_norm import normalize_answer
+from .session_mem import create_session, get_session, save_session, aget_session, asave_session
 from .validate_turn import (
-     score_user_turn, _lexical_score, _cosine, 
+     score_user_turn, score_batch, Candidate, _lexical_score, _cosine, 
      _normalize,_seq_ratio,  make_hint, _to_list, 
      _token_f1, _ascii_quotes,  _expand_contractions, _token_set_ratio,_tokens 
 ) 
\ No newline at end of file
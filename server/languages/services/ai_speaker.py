@@ -1,5 +1,5 @@
 import os, logging
-from typing import List
+from typing import List, Optional
 from languages.models import RoleplayBlock
 log = logging.getLogger(__name__)
 
@@ -16,50 +16,20 @@ def _plain_lines(blocks: List[RoleplayBlock]):
         for b in blocks
     ]
 
-def _paraphrase_lines(blocks: List[RoleplayBlock]):
+def _paraphrase_lines(blocks: List[RoleplayBlock], level: Optional[str] = None):
+    # 1 request có cấu trúc cho cả lượt + cache pool biến thể (languages.services.paraphrase);
+    # câu không có biến thể (ngắn / Gemini bỏ sót / lỗi) -> giữ câu gốc
     try:
-        import google.generativeai as genai
-        api = os.getenv("GEMINI_API_KEY")
-        if not api: 
-            return _plain_lines(blocks)
-        genai.configure(api_key=api)
-        model = genai.GenerativeModel(os.getenv("GEMINI_MODEL","models/gemini-2.5-flash"),
-                                      system_instruction="Paraphrase very concisely, preserve meaning, CEFR friendly.")
-        lines = []
-        for b in blocks:
-            if len(b.text.split()) < 3:
-                lines.append({
-                    "role": b.role or "-",
-                    "block_id": str(b.id),
-                    "text": b.text,
-                    "audio_key": b.audio_key,
-                })
-                continue
-            p = f"Paraphrase briefly and keep the intent. Original: {b.text}"
-            try:
-                out = (model.generate_content(p).text or "").strip()
-                lines.append({
-                    "role": b.role or "-",
-                    "block_id": str(b.id),
-                    "text": out or b.text,
-                    "audio_key": b.audio_key,
-                })
-            except Exception as e:
-                log.error(f"Paraphrasing failed for block {b.id}: {e}")
-                lines.append({
-                    "role": b.role or "-",
-                    "block_id": str(b.id),
-                    "text": b.text,
-                    "audio_key": b.audio_key,
-                }) # Fallback
-        return lines
-    except Exception:
-        return _plain_lines(blocks)
+        from .paraphrase import variants_for
+        para = variants_for(blocks, level)
+    except Exception as e:
+        log.error(f"Paraphrasing failed: {e}")
+        para = {}
+    return [{**line, "text": para.get(line["block_id"]) or line["text"]} for line in _plain_lines(blocks)]
 
-def ai_lines_for(blocks, learner_role: str):
+def ai_lines_for(blocks, learner_role: str, level: Optional[str] = None):
     blocks = [b for b in blocks if (b.role or "") != learner_role]
     if USE_PARAPHRASE:
-        return _paraphrase_lines(blocks)
+        return _paraphrase_lines(blocks, level)
     else:
         return _plain_lines(blocks)
-
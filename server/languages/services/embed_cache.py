@@ -0,0 +1,133 @@
+import hashlib, logging, threading, unicodedata
+from collections import OrderedDict
+from typing import Dict, Optional, Sequence
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+
+from .ollama_client import DIM, current_model, get_embed_backend
+
+log = logging.getLogger(__name__)
+
+# Cache embedding 2 tầng cho câu người học / đáp án:
+#   L1: LRU trong process (không tốn round-trip)   L2: Redis (cache "shared"), dùng chung giữa worker
+# key = model + sha256(text đã chuẩn hoá); value = float16 bytes (768 chiều -> 1.5 KB)
+CACHE_ALIAS = getattr(settings, "EMBED_CACHE_ALIAS", "shared")
+CACHE_TTL = int(getattr(settings, "EMBED_CACHE_TTL", 60 * 60 * 24 * 30))
+LRU_SIZE = int(getattr(settings, "EMBED_CACHE_LRU_SIZE", 4096))
+
+_PREFIX = "emb:"
+
+
+def _backend():
+    try:
+        return caches[CACHE_ALIAS]
+    except InvalidCacheBackendError:
+        return caches["default"]
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", text or "").split())
+
+
+def make_key(text: str, model: Optional[str] = None) -> str:
+    h = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+    return f"{_PREFIX}{model or current_model()}:{h}"
+
+
+def _pack(v: np.ndarray) -> bytes:
+    return np.asarray(v, dtype="float16").tobytes()
+
+
+def _unpack(b: bytes) -> np.ndarray:
+    return np.frombuffer(b, dtype="float16").astype("float32")
+
+
+class _LRU:
+    def __init__(self, size: int):
+        self.size = size
+        self._d: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            v = self._d.get(key)
+            if v is not None:
+                self._d.move_to_end(key)
+            return v
+
+    def put(self, key: str, val: bytes) -> None:
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._d[key] = val
+            self._d.move_to_end(key)
+            while len(self._d) > self.size:
+                self._d.popitem(last=False)
+
+
+_L1 = _LRU(LRU_SIZE)
+
+
+def put(text: str, vec, model: Optional[str] = None) -> None:
+    """Ghi sẵn 1 vector đã có (vd đáp án embed lúc lưu block) vào cả 2 tầng."""
+    key, b = make_key(text, model), _pack(vec)
+    _L1.put(key, b)
+    try:
+        _backend().set(key, b, CACHE_TTL)
+    except Exception as e:
+        log.warning("Embedding cache set failed: %s", e)
+
+
+def embed_texts(texts: Sequence[str]) -> np.ndarray:
+    """
+    (N, DIM) float32. Thứ tự tra: L1 -> Redis (1 get_many) -> embed phần còn thiếu (1 lời gọi batched).
+    Text trùng nhau trong cùng batch chỉ embed 1 lần.
+    """
+    texts = [normalize_text(t) for t in texts]
+    model = current_model()
+    keys = [make_key(t, model) for t in texts]
+    found: Dict[str, bytes] = {}
+    for k in set(keys):
+        b = _L1.get(k)
+        if b is not None:
+            found[k] = b
+
+    missing = [k for k in dict.fromkeys(keys) if k not in found]
+    if missing:
+        try:
+            got = _backend().get_many(missing)
+        except Exception as e:  # Redis down -> coi như miss
+            log.warning("Embedding cache get failed: %s", e)
+            got = {}
+        for k, b in got.items():
+            _L1.put(k, b)
+            found[k] = b
+
+    todo = {k: t for k, t in zip(keys, texts) if k not in found}
+    if todo:
+        X = get_embed_backend().embed_matrix(list(todo.values()))
+        fresh = {k: _pack(v) for k, v in zip(todo, X)}
+        for k, b in fresh.items():
+            _L1.put(k, b)
+        try:
+            _backend().set_many(fresh, CACHE_TTL)
+        except Exception as e:
+            log.warning("Embedding cache set failed: %s", e)
+        found.update(fresh)
+
+    if not keys:
+        return np.zeros((0, DIM), dtype="float32")
+    return np.stack([_unpack(found[k]) for k in keys])
+
+
+def embed_exact(texts: Sequence[str]) -> np.ndarray:
+    """(N, DIM) float32 thẳng từ model, bỏ qua cache (vector cache là float16) -> dùng khi cần so ngưỡng sát."""
+    if not texts:
+        return np.zeros((0, DIM), dtype="float32")
+    return np.asarray(get_embed_backend().embed_matrix([normalize_text(t) for t in texts]), dtype="float32")
+
+
+def embed_text(text: str) -> np.ndarray:
+    return embed_texts([text])[0]
@@ -1,41 +1,109 @@
-from typing import Iterable, Optional
+from datetime import datetime
+from typing import Callable, Iterable, List, Optional, Sequence, Tuple, Union
 from django.utils import timezone
 from django.db import transaction
 from languages.models import RoleplayScenario, RoleplayBlock
-from .embed_text import mark_dirty_scenarios, mark_dirty_blocks
-from .ollama_client import embed_many
-import os
+from .embed_text import build_scenario_text, build_block_text, sha256
+from .ollama_client import embed_many, current_model
+from .vector_search import with_half
+from .text_norm import normalize_answer
+from .validate_turn import answer_hash
+from . import embed_cache
 
-MODEL = os.getenv("RAG_OLLAMA_EMBED_MODEL", "nomic-embed-text:latest")
+# Mỗi chunk: 1 lần embed (client tự chia batch) + 1 transaction ngắn bulk_update.
+# Lỗi ở chunk sau không rollback các chunk đã commit; chạy lại chỉ xử lý dòng còn stale.
+CHUNK_SIZE = 128
+_FIELDS = ["embedding", "embedding_text", "embedding_hash", "embedding_model",
+           "embedding_updated_at", "updated_at"]
+_ANSWER_FIELDS = ["answer_embedding", "answer_hash", "updated_at"]
 
-@transaction.atomic
-def embed_scenarios(qs: Optional[Iterable[RoleplayScenario]] = None, batch=64, force=False):
-    qs = list(qs or RoleplayScenario.objects.all())
-    items = qs if force else mark_dirty_scenarios(qs)
-    if not items: return 0
-    texts = [x.embedding_text for x in items]
-    vecs = []
-    for i in range(0, len(texts), batch):
-        vecs.extend(embed_many(texts[i:i+batch]))
-    for x, v in zip(items, vecs):
-        x.embedding = v
-        x.embedding_model = MODEL
-        x.embedding_updated_at = timezone.now()
-        x.save(update_fields=["embedding", "embedding_model", "embedding_updated_at", "updated_at"])
-    return len(items)
-
-@transaction.atomic
-def embed_blocks(qs: Optional[Iterable[RoleplayBlock]] = None, batch=128, force=False):
-    qs = list(qs or RoleplayBlock.objects.select_related("scenario").all())
-    items = qs if force else mark_dirty_blocks(qs)
-    if not items: return 0
-    texts = [x.embedding_text for x in items]
-    vecs = []
-    for i in range(0, len(texts), batch):
-        vecs.extend(embed_many(texts[i:i+batch]))
-    for x, v in zip(items, vecs):
+# force=True: embed lại mọi dòng; force=<datetime>: chỉ dòng ghi trước mốc đó (job force chạy lại / retry chunk
+# không embed lại dòng đã commit trong chính job).
+Force = Union[bool, datetime]
+
+
+def _text_fn(Model) -> Callable:
+    return build_scenario_text if Model is RoleplayScenario else build_block_text
+
+
+def _forced(force: Force, ts: Optional[datetime]) -> bool:
+    if isinstance(force, datetime):
+        return ts is None or ts < force
+    return bool(force)
+
+
+def _main_stale(x, model: str, force: Force) -> bool:
+    """hash(text dựng lại từ nội dung hiện tại) khác embedding_hash, chưa có vector, hoặc embed bằng model khác. Gán sẵn text/hash mới."""
+    text = _text_fn(type(x))(x)
+    h = sha256(text)
+    if _forced(force, x.embedding_updated_at) or h != x.embedding_hash or x.embedding is None or x.embedding_model != model:
+        x.embedding_text, x.embedding_hash = text, h
+        return True
+    return False
+
+
+def _answer_stale(x, model: str, force: Force) -> Optional[Tuple[str, str]]:
+    """Block dialogue: đáp án (text đã normalize_answer) chưa được embed sẵn bằng model hiện tại -> (text, hash)."""
+    if not isinstance(x, RoleplayBlock) or x.section != RoleplayBlock.Section.DIALOGUE:
+        return None
+    norm = normalize_answer(x.text)
+    h = answer_hash(norm, model)
+    if _forced(force, x.updated_at) or h != x.answer_hash:
+        return norm, h
+    return None
+
+
+def stale_items(items: Iterable, force: Force = False) -> List:
+    model = current_model()
+    out = []
+    for x in items:
+        main = _main_stale(x, model, force)
+        if _answer_stale(x, model, force) or main:
+            out.append(x)
+    return out
+
+
+def embed_chunk(Model, items: Sequence, force: Force = False) -> int:
+    """
+    Embed 1 chunk bằng 1 lời gọi batched (vector nội dung + vector đáp án của block dialogue)
+    rồi commit bằng bulk_update. Trả về số dòng đã ghi.
+    """
+    model = current_model()
+    main = [x for x in items if _main_stale(x, model, force)]
+    answers = [(x, *a) for x in items for a in [_answer_stale(x, model, force)] if a]
+    texts = [x.embedding_text for x in main] + [t for _, t, _ in answers]
+    if not texts:
+        return 0
+    vecs = embed_many(texts)
+    now = timezone.now()
+    fields, half = set(), []
+    for x, v in zip(main, vecs):
         x.embedding = v
-        x.embedding_model = MODEL
-        x.embedding_updated_at = timezone.now()
-        x.save(update_fields=["embedding", "embedding_model", "embedding_updated_at", "updated_at"])
-    return len(items)
+        x.embedding_model = model
+        x.embedding_updated_at = now
+        x.updated_at = now  # bulk_update không chạy auto_now
+        half = with_half(x, v)
+        fields.update(_FIELDS + half)
+    for (x, t, h), v in zip(answers, vecs[len(main):]):
+        x.answer_embedding, x.answer_hash, x.updated_at = v, h, now
+        embed_cache.put(t, v, model)  # validate_turn tra cache theo đúng text này
+        fields.update(_ANSWER_FIELDS)
+    objs = list({x.pk: x for x in main + [a[0] for a in answers]}.values())
+    with transaction.atomic():
+        Model.objects.bulk_update(objs, sorted(fields), batch_size=500)
+    return len(objs)
+
+
+def _run(Model, items: List, batch: int, force: bool) -> int:
+    n = 0
+    for i in range(0, len(items), batch):
+        n += embed_chunk(Model, items[i:i + batch], force=force)
+    return n
+
+
+def embed_scenarios(qs: Optional[Iterable[RoleplayScenario]] = None, batch=64, force=False):
+    return _run(RoleplayScenario, list(qs or RoleplayScenario.objects.all()), batch, force)
+
+
+def embed_blocks(qs: Optional[Iterable[RoleplayBlock]] = None, batch=CHUNK_SIZE, force=False):
+    return _run(RoleplayBlock, list(qs or RoleplayBlock.objects.select_related("scenario").all()), batch, force)
@@ -1,42 +1,50 @@
 import hashlib
 from typing import Iterable
 from languages.models import RoleplayScenario, RoleplayBlock
+from .vector_search import with_half
 
 def sha256(s: str) -> str:
     return hashlib.sha256(s.encode("utf-8")).hexdigest()
 
-def scenario_text(s: RoleplayScenario) -> str:
-    if s.embedding_text:
-        return s.embedding_text.strip()
+def build_scenario_text(s: RoleplayScenario) -> str:
+    """Text embed dựng lại từ các block hiện tại (không đọc embedding_text đã lưu) -> phát hiện được chỉnh sửa."""
     parts = [f"[{b.section}#{b.order}] {b.role or '-'}: {b.text}"
              for b in s.blocks.order_by("section", "order", "created_at")]
     return "\n".join(parts).strip()
 
+def build_block_text(b: RoleplayBlock) -> str:
+    return f"[{b.section}#{b.order}] {b.role or '-'}: {b.text}".strip()
+
+def scenario_text(s: RoleplayScenario) -> str:
+    if s.embedding_text:
+        return s.embedding_text.strip()
+    return build_scenario_text(s)
+
 def block_text(b: RoleplayBlock) -> str:
-    return (b.embedding_text or f"[{b.section}#{b.order}] {b.role or '-'}: {b.text}").strip()
+    return (b.embedding_text or build_block_text(b)).strip()
 
 def mark_dirty_scenarios(items: Iterable[RoleplayScenario]) -> list[RoleplayScenario]:
     dirty = []
     for s in items:
-        new_text = scenario_text(s)
+        new_text = build_scenario_text(s)
         new_hash = sha256(new_text)
         if new_hash != getattr(s, "embedding_hash", ""):
             s.embedding_text = new_text
             s.embedding_hash = new_hash
             s.embedding = None  # đánh dấu cần embed lại
-            s.save(update_fields=["embedding_text", "embedding_hash", "embedding", "updated_at"])
+            s.save(update_fields=["embedding_text", "embedding_hash", "embedding", "updated_at", *with_half(s, None)])
             dirty.append(s)
     return dirty
 
 def mark_dirty_blocks(items: Iterable[RoleplayBlock]) -> list[RoleplayBlock]:
     dirty = []
     for b in items:
-        new_text = block_text(b)
+        new_text = build_block_text(b)
         new_hash = sha256(new_text)
         if new_hash != getattr(b, "embedding_hash", ""):
             b.embedding_text = new_text
             b.embedding_hash = new_hash
             b.embedding = None
-            b.save(update_fields=["embedding_text", "embedding_hash", "embedding", "updated_at"])
+            b.save(update_fields=["embedding_text", "embedding_hash", "embedding", "updated_at", *with_half(b, None)])
             dirty.append(b)
     return dirty
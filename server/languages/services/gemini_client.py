@@ -0,0 +1,225 @@
+"""
+Client Gemini dùng chung (google.generativeai) cho practice / roleplay / paraphrase.
+
+    resp, usage = generate(prompt, system=SYS)                    # gọi 1 lần, sync
+    chat = start_chat(system, JSON, history)                      # ChatSession trên model đã cache
+    resp, usage = await asend(chat, prompt)
+    async for text in astream(chat, prompt, usage=u): ...          # u được điền khi stream xong
+
+GenerativeModel được tái sử dụng theo (model, system instruction, generation config, safety) trong 1 LRU của
+process, không dựng lại mỗi lượt. configure() chạy 1 lần / process: SDK giữ client mặc định (gRPC channel HTTP/2
+hoặc REST keep-alive) cho mọi model -> kết nối được dùng lại giữa các lượt. GEMINI_API_ENDPOINT +
+GEMINI_TRANSPORT=rest trỏ sang server giả (gemini_fake.FakeGemini) khi test. SDK chỉ có client async cho gRPC:
+với REST, asend / astream chạy lời gọi sync trên utils.aio.run_blocking.
+
+Mỗi lời gọi trả usage {model, latency_ms, ttft_ms?, prompt_tokens, output_tokens, total_tokens}; tổng theo loại
+lời gọi ở stats(). Slot gateway vẫn do người gọi giữ (mỗi luồng một Priority).
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import google.generativeai as genai
+from django.conf import settings
+
+from utils.aio import run_blocking
+
+log = logging.getLogger(__name__)
+
+MODEL = os.getenv("GEMINI_MODEL", "models/gemini-2.5-flash")
+ENDPOINT = getattr(settings, "GEMINI_API_ENDPOINT", "") or ""
+TRANSPORT = getattr(settings, "GEMINI_TRANSPORT", "") or ""
+MODEL_CACHE_SIZE = int(getattr(settings, "GEMINI_MODEL_CACHE_SIZE", 64))
+
+JSON = {"response_mime_type": "application/json"}
+
+_lock = threading.Lock()
+_models: "OrderedDict[tuple, Any]" = OrderedDict()
+_configured = False
+_transport = ""
+_totals: Dict[str, Dict[str, float]] = {}
+
+
+def available() -> bool:
+    return bool(os.getenv("GEMINI_API_KEY"))
+
+
+def configure(api_key: Optional[str] = None, endpoint: Optional[str] = None, transport: Optional[str] = None) -> None:
+    """Cấu hình SDK (1 lần / process, hoặc lại khi test đổi endpoint). Model cũ giữ client cũ -> bỏ cache."""
+    global _configured, _transport
+    opts: Dict[str, Any] = {}
+    endpoint = endpoint if endpoint is not None else ENDPOINT
+    transport = transport if transport is not None else TRANSPORT
+    if endpoint:
+        opts["client_options"] = {"api_endpoint": endpoint}
+    if transport:
+        opts["transport"] = transport
+    with _lock:
+        genai.configure(api_key=api_key or os.getenv("GEMINI_API_KEY"), **opts)
+        _models.clear()
+        _configured, _transport = True, transport or ""
+
+
+def _ensure_configured() -> None:
+    if not _configured:
+        configure()
+
+
+def _rest() -> bool:
+    """transport=rest: send_message_async không dùng được (trả response sync) -> asend / astream đi đường sync."""
+    _ensure_configured()
+    return _transport == "rest"
+
+
+def _canon(obj) -> str:
+    return json.dumps(obj, sort_keys=True, default=str) if obj else ""
+
+
+def model(system_instruction: Optional[str] = None, config: Optional[Dict] = None,
+          safety: Optional[Dict] = None, name: Optional[str] = None):
+    name = name or MODEL
+    key = (name, system_instruction or "", _canon(config), _canon(safety))
+    with _lock:
+        m = _models.get(key)
+        if m is not None:
+            _models.move_to_end(key)
+            return m
+    _ensure_configured()
+    m = genai.GenerativeModel(name, system_instruction=system_instruction,
+                              generation_config=config, safety_settings=safety)
+    with _lock:
+        m = _models.setdefault(key, m)
+        while len(_models) > MODEL_CACHE_SIZE:
+            _models.popitem(last=False)
+    return m
+
+
+def start_chat(system_instruction: Optional[str], config: Optional[Dict] = None, history: Optional[List] = None):
+    return model(system_instruction, config).start_chat(history=history or [])
+
+
+# ---------------- metrics ----------------
+def _usage(resp, name: str, t0: float, ttft: Optional[float] = None) -> Dict[str, Any]:
+    u = getattr(resp, "usage_metadata", None) if resp is not None else None
+    out = {
+        "model": name,
+        "latency_ms": round((time.perf_counter() - t0) * 1000, 1),
+        "prompt_tokens": int(getattr(u, "prompt_token_count", 0) or 0),
+        "output_tokens": int(getattr(u, "candidates_token_count", 0) or 0),
+        "total_tokens": int(getattr(u, "total_token_count", 0) or 0),
+    }
+    if ttft is not None:
+        out["ttft_ms"] = round((ttft - t0) * 1000, 1)
+    return out
+
+
+def _record(kind: str, usage: Optional[Dict[str, Any]], error: bool = False) -> None:
+    with _lock:
+        t = _totals.setdefault(kind, {"calls": 0, "errors": 0, "latency_ms": 0.0, "latency_max_ms": 0.0,
+                                      "prompt_tokens": 0, "output_tokens": 0})
+        t["calls"] += 1
+        if error or usage is None:
+            t["errors"] += 1
+            return
+        t["latency_ms"] += usage["latency_ms"]
+        t["latency_max_ms"] = max(t["latency_max_ms"], usage["latency_ms"])
+        t["prompt_tokens"] += usage["prompt_tokens"]
+        t["output_tokens"] += usage["output_tokens"]
+    log.debug("gemini %s: %s", kind, usage)
+
+
+def stats() -> Dict[str, Dict[str, Any]]:
+    """Tổng theo loại lời gọi trong process: calls, errors, latency trung bình / max, token vào / ra."""
+    with _lock:
+        out = {}
+        for kind, t in _totals.items():
+            ok = t["calls"] - t["errors"]
+            out[kind] = {**t, "latency_avg_ms": round(t["latency_ms"] / ok, 1) if ok else 0.0,
+                         "models_cached": len(_models)}
+        return out
+
+
+def _name(obj) -> str:
+    m = getattr(obj, "model", obj)  # ChatSession.model -> GenerativeModel
+    return getattr(m, "model_name", MODEL)
+
+
+# ---------------- calls ----------------
+def generate(prompt, *, system: Optional[str] = None, config: Optional[Dict] = None,
+             safety: Optional[Dict] = None, kind: str = "generate") -> Tuple[Any, Dict[str, Any]]:
+    m = model(system, config, safety)
+    t0 = time.perf_counter()
+    try:
+        resp = m.generate_content(prompt)
+    except Exception:
+        _record(kind, None, error=True)
+        raise
+    usage = _usage(resp, _name(m), t0)
+    _record(kind, usage)
+    return resp, usage
+
+
+def send(chat, prompt, *, kind: str = "chat") -> Tuple[Any, Dict[str, Any]]:
+    t0 = time.perf_counter()
+    try:
+        resp = chat.send_message(prompt)
+    except Exception:
+        _record(kind, None, error=True)
+        raise
+    usage = _usage(resp, _name(chat), t0)
+    _record(kind, usage)
+    return resp, usage
+
+
+async def asend(chat, prompt, *, kind: str = "chat") -> Tuple[Any, Dict[str, Any]]:
+    if _rest():
+        return await run_blocking(send, chat, prompt, kind=kind)
+    t0 = time.perf_counter()
+    try:
+        resp = await chat.send_message_async(prompt)
+    except Exception:  # huỷ (CancelledError) không tính là lỗi
+        _record(kind, None, error=True)
+        raise
+    usage = _usage(resp, _name(chat), t0)
+    _record(kind, usage)
+    return resp, usage
+
+
+async def _aiter_blocking(it) -> AsyncIterator[Any]:
+    """Stream sync (REST) -> async: mỗi next() (đọc chunk HTTP) chạy trên BLOCKING_POOL."""
+    it = iter(it)
+    while True:
+        chunk = await run_blocking(next, it, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+async def astream(chat, prompt, *, kind: str = "chat_stream",
+                  usage: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+    """Text từng chunk; `usage` (nếu truyền) được điền khi stream kết thúc (ttft_ms = tới chunk đầu)."""
+    t0, ttft, resp = time.perf_counter(), None, None
+    try:
+        if _rest():
+            resp = await run_blocking(chat.send_message, prompt, stream=True)
+            chunks = _aiter_blocking(resp)
+        else:
+            resp = await chat.send_message_async(prompt, stream=True)
+            chunks = resp
+        async for chunk in chunks:
+            if ttft is None:
+                ttft = time.perf_counter()
+            text = getattr(chunk, "text", "") or ""
+            if text:
+                yield text
+    except Exception:  # huỷ / client đóng stream không tính là lỗi
+        _record(kind, None, error=True)
+        raise
+    u = _usage(resp, _name(chat), t0, ttft)
+    _record(kind, u)
+    if usage is not None:
+        usage.update(u)
@@ -0,0 +1,122 @@
+"""
+Server Gemini giả (REST v1beta) cho test / chạy local không cần API key thật.
+
+    with FakeGemini(reply=lambda req: '{"reply": "Hi!"}') as fake:
+        gemini_client.configure(api_key="test", endpoint=fake.url, transport="rest")
+        ...
+        fake.requests   # body JSON các request đã nhận (kiểm tra system instruction, history, config)
+
+Hỗ trợ :generateContent và :streamGenerateContent (mảng JSON như SDK dùng, hoặc ?alt=sse; reply cắt thành
+STREAM_CHUNKS chunk), trả usageMetadata đếm token thô theo khoảng trắng. `delay_s` giả lập độ trễ model. Chạy tay: manage.py fake_gemini --port 8765.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional
+
+STREAM_CHUNKS = 4
+
+
+def _tokens(text: str) -> int:
+    return len((text or "").split())
+
+
+def _prompt_text(req: Dict) -> str:
+    parts = [p.get("text", "") for c in req.get("contents") or [] for p in c.get("parts") or []]
+    sys = (req.get("systemInstruction") or req.get("system_instruction") or {}).get("parts") or []
+    return " ".join([p.get("text", "") for p in sys] + parts)
+
+
+def _last_user_text(req: Dict) -> str:
+    contents = req.get("contents") or [{}]
+    return " ".join(p.get("text", "") for p in contents[-1].get("parts") or [])
+
+
+def _payload(text: str, req: Dict, final: bool = True) -> Dict:
+    out = {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}]}
+    if final:
+        out["candidates"][0]["finishReason"] = "STOP"
+        n_in, n_out = _tokens(_prompt_text(req)), _tokens(text)
+        out["usageMetadata"] = {"promptTokenCount": n_in, "candidatesTokenCount": n_out,
+                                "totalTokenCount": n_in + n_out}
+    return out
+
+
+class FakeGemini:
+    def __init__(self, reply: Optional[Callable[[Dict], str]] = None, host: str = "127.0.0.1", port: int = 0,
+                 delay_s: float = 0.0):
+        self.reply = reply or (lambda req: json.dumps({"reply": f"echo: {_last_user_text(req)}",
+                                                       "corrected": None, "explanation": None}))
+        self.delay_s = delay_s
+        self.requests: List[Dict] = []
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive: client giữ kết nối như với API thật
+
+            def log_message(self, *args):
+                pass
+
+            def _json(self, status: int, body: Dict):
+                raw = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(raw)))
+                self.end_headers()
+                self.wfile.write(raw)
+
+            def do_POST(self):
+                req = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                fake.requests.append(req)
+                if fake.delay_s:
+                    time.sleep(fake.delay_s)
+                text = fake.reply(req)
+                if ":generateContent" in self.path:
+                    return self._json(200, _payload(text, req))
+                if ":streamGenerateContent" not in self.path:
+                    return self._json(404, {"error": {"code": 404, "message": self.path, "status": "NOT_FOUND"}})
+                # alt=sse: từng event "data: {...}"; còn lại (SDK google.generativeai qua REST): 1 mảng JSON
+                # gửi dần từng phần tử
+                sse = "alt=sse" in self.path
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream" if sse else "application/json")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                step = max(1, -(-len(text) // STREAM_CHUNKS))
+                pieces = [text[i:i + step] for i in range(0, len(text), step)] or [""]
+                for i, piece in enumerate(pieces):
+                    body = json.dumps(_payload(piece, req, final=i == len(pieces) - 1))
+                    if sse:
+                        out = f"data: {body}\r\n\r\n"
+                    else:
+                        out = ("[" if i == 0 else ",\r\n") + body + ("]" if i == len(pieces) - 1 else "")
+                    self.wfile.write(out.encode("utf-8"))
+                    self.wfile.flush()
+                self.close_connection = True
+
+        return Handler
+
+    def start(self) -> "FakeGemini":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-gemini", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeGemini":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
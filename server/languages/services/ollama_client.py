@@ -1,5 +1,8 @@
-import os, time, requests, logging
-from typing import List
+import os, time, logging, threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+import httpx
+import numpy as np
 
 
 log = logging.getLogger(__name__)
@@ -7,28 +10,136 @@ BASE = os.getenv("RAG_OLLAMA_URL", "http://127.0.0.1:11435")
 MODEL = os.getenv("RAG_OLLAMA_EMBED_MODEL", "nomic-embed-text:latest")
 DIM = int(os.getenv("EMBED_DIM", "768"))
 
+BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))      # số text / 1 request /api/embed
+CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))     # số request song song tối đa
+RETRIES = int(os.getenv("EMBED_RETRIES", "2"))
+BACKOFF = float(os.getenv("EMBED_BACKOFF", "0.6"))
+TIMEOUT = float(os.getenv("EMBED_TIMEOUT", "60"))
+
 def _resize(vec: List[float]) -> List[float]:
     if len(vec) == DIM: return vec
     return (vec[:DIM]) if len(vec) > DIM else (vec + [0.0]*(DIM-len(vec)))
 
-def embed_one(text: str, timeout=60, retries=2, backoff=0.6) -> List[float]:
-    url = f"{BASE}/api/embeddings"
-    payload = {"model": MODEL, "prompt": text}
-    last = None
-    for i in range(retries+1):
-        try:
-            r = requests.post(url, json=payload, timeout=timeout)
-            r.raise_for_status()
-            vec = r.json().get("embedding") or []
-            return _resize(vec)
-        except Exception as e:
-            last = e
-            time.sleep(backoff * (2**i))
-    raise RuntimeError(f"Ollama embed failed: {last}")
-
-def embed_many(texts: List[str], sleep_ms=20) -> List[List[float]]:
-    out = []
-    for t in texts:
-        out.append(embed_one(t))
-        if sleep_ms: time.sleep(sleep_ms/1000.0)
+def _resize_matrix(X: np.ndarray, dim: int = DIM) -> np.ndarray:
+    """Cắt / pad 0 cả ma trận (N, d) -> (N, dim) một lần."""
+    n, d = X.shape
+    if d == dim:
+        return X
+    if d > dim:
+        return np.ascontiguousarray(X[:, :dim])
+    out = np.zeros((n, dim), dtype=X.dtype)
+    out[:, :d] = X
     return out
+
+
+class OllamaEmbedClient:
+    """
+    Client embedding dùng chung cho cả `languages` và `chat.rag`:
+      - 1 httpx.Client / (base, model) -> giữ kết nối keep-alive (pool)
+      - gom text thành batch gửi /api/embed (input=[...]); Ollama cũ không có /api/embed -> /api/embeddings từng text
+      - tối đa `concurrency` request song song, retry + backoff theo từng batch
+    """
+    def __init__(self, base_url: str = BASE, model: str = MODEL, *, batch_size: int = BATCH_SIZE,
+                 concurrency: int = CONCURRENCY, retries: int = RETRIES, backoff: float = BACKOFF,
+                 timeout: float = TIMEOUT):
+        self.base = base_url.rstrip("/")
+        self.model = model
+        self.batch_size = max(1, batch_size)
+        self.concurrency = max(1, concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.http = httpx.Client(
+            timeout=httpx.Timeout(timeout, connect=10.0),
+            limits=httpx.Limits(max_keepalive_connections=self.concurrency,
+                                max_connections=self.concurrency * 2),
+        )
+        self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="embed")
+        self._legacy = False  # True khi server không hỗ trợ /api/embed
+
+    def _post_batch(self, texts: Sequence[str]) -> List[List[float]]:
+        if not self._legacy:
+            r = self.http.post(f"{self.base}/api/embed", json={"model": self.model, "input": list(texts)})
+            if r.status_code != 404:
+                r.raise_for_status()
+                embs = r.json().get("embeddings") or []
+                if len(embs) != len(texts):
+                    raise RuntimeError(f"Ollama returned {len(embs)} embeddings for {len(texts)} inputs")
+                return embs
+            log.info("Ollama %s has no /api/embed, falling back to /api/embeddings", self.base)
+            self._legacy = True
+        out = []
+        for t in texts:
+            r = self.http.post(f"{self.base}/api/embeddings", json={"model": self.model, "prompt": t})
+            r.raise_for_status()
+            out.append(r.json().get("embedding") or [])
+        return out
+
+    def _embed_batch(self, texts: Sequence[str]) -> np.ndarray:
+        last = None
+        for i in range(self.retries + 1):
+            try:
+                vs = self._post_batch(texts)
+                dim = max((len(v) for v in vs), default=DIM)
+                X = np.zeros((len(vs), dim), dtype="float32")
+                for j, v in enumerate(vs):
+                    X[j, :len(v)] = v
+                return X
+            except Exception as e:
+                last = e
+                if i < self.retries:
+                    time.sleep(self.backoff * (2**i))
+        raise RuntimeError(f"Ollama embed failed: {last}")
+
+    def embed_matrix(self, texts: Sequence[str], dim: Optional[int] = DIM) -> np.ndarray:
+        """(N, dim) float32; dim=None -> giữ nguyên số chiều của model."""
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, dim or DIM), dtype="float32")
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if len(batches) == 1:
+            parts = [self._embed_batch(batches[0])]
+        else:
+            parts = list(self._pool.map(self._embed_batch, batches))
+        width = max(p.shape[1] for p in parts)
+        X = np.concatenate([_resize_matrix(p, width) for p in parts], axis=0)
+        return _resize_matrix(X, dim) if dim else X
+
+
+_CLIENTS: Dict[Tuple[str, str], OllamaEmbedClient] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+def get_client(base_url: Optional[str] = None, model: Optional[str] = None) -> OllamaEmbedClient:
+    key = ((base_url or BASE).rstrip("/"), model or MODEL)
+    c = _CLIENTS.get(key)
+    if c is None:
+        with _CLIENTS_LOCK:
+            c = _CLIENTS.get(key)
+            if c is None:
+                c = _CLIENTS[key] = OllamaEmbedClient(*key)
+    return c
+
+
+def _backend_name() -> str:
+    from django.conf import settings
+    return getattr(settings, "EMBED_BACKEND", os.getenv("EMBED_BACKEND", "ollama"))
+
+def get_embed_backend():
+    """'ollama' (HTTP, mặc định) | 'onnx' (onnxruntime CPU trong process). Cả hai có embed_matrix(texts, dim)."""
+    if _backend_name() == "onnx":
+        from .onnx_embedder import get_onnx_embedder
+        return get_onnx_embedder()
+    return get_client()
+
+def current_model() -> str:
+    """Tên model của backend đang dùng (ghi vào embedding_model)."""
+    if _backend_name() == "onnx":
+        from .onnx_embedder import MODEL_NAME
+        return MODEL_NAME
+    return MODEL
+
+
+def embed_one(text: str) -> List[float]:
+    return get_embed_backend().embed_matrix([text])[0].tolist()
+
+def embed_many(texts: List[str]) -> List[List[float]]:
+    return get_embed_backend().embed_matrix(texts).tolist()
@@ -0,0 +1,133 @@
+import os, time, logging, threading
+from concurrent.futures import Future
+from queue import Queue, Empty
+from typing import List, Optional, Sequence, Tuple
+import numpy as np
+from django.conf import settings
+
+from .ollama_client import DIM, _resize_matrix
+
+log = logging.getLogger(__name__)
+
+# Embedding chạy trong process bằng onnxruntime (CPU) - không tranh hàng đợi Ollama với chat.
+# Thư mục model = bản export ONNX của sentence-embedding model (vd nomic-embed-text / bge / MiniLM):
+#   model.onnx + tokenizer.json (HF tokenizers)
+MODEL_DIR = getattr(settings, "ONNX_EMBED_MODEL_DIR", os.getenv("ONNX_EMBED_MODEL_DIR", ""))
+MODEL_NAME = getattr(settings, "ONNX_EMBED_MODEL_NAME", "") or os.path.basename(str(MODEL_DIR).rstrip("/\\")) or "onnx"
+INTRA_THREADS = int(getattr(settings, "ONNX_EMBED_INTRA_THREADS", 0))   # 0 = onnxruntime tự chọn (= số core)
+INTER_THREADS = int(getattr(settings, "ONNX_EMBED_INTER_THREADS", 1))
+MAX_BATCH = int(getattr(settings, "ONNX_EMBED_MAX_BATCH", 32))          # text / 1 lần session.run
+MAX_WAIT_MS = float(getattr(settings, "ONNX_EMBED_MAX_WAIT_MS", 5))      # chờ gom request đồng thời
+MAX_LEN = int(getattr(settings, "ONNX_EMBED_MAX_LEN", 256))             # token / text
+POOLING = getattr(settings, "ONNX_EMBED_POOLING", "mean")               # 'mean' | 'cls'
+PREFIX = getattr(settings, "ONNX_EMBED_PREFIX", "")                     # vd "search_query: " cho nomic
+
+
+class OnnxEmbedder:
+    """
+    Session onnxruntime dùng chung / process:
+      - số thread chỉnh được (intra/inter op), graph optimization mức cao nhất
+      - micro-batching: các lời gọi đồng thời (thread khác nhau) được gom trong MAX_WAIT_MS
+        thành 1 lần session.run, tối đa MAX_BATCH text
+      - output: mean/CLS pooling -> L2 normalize -> cắt/pad về DIM
+    """
+    def __init__(self, model_dir: str = MODEL_DIR, *, intra_threads: int = INTRA_THREADS,
+                 inter_threads: int = INTER_THREADS, max_batch: int = MAX_BATCH,
+                 max_wait_ms: float = MAX_WAIT_MS, max_len: int = MAX_LEN, pooling: str = POOLING):
+        if not model_dir:
+            raise RuntimeError("ONNX_EMBED_MODEL_DIR is not configured")
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        if intra_threads:
+            opts.intra_op_num_threads = intra_threads
+        opts.inter_op_num_threads = max(1, inter_threads)
+        self.session = ort.InferenceSession(os.path.join(model_dir, "model.onnx"), sess_options=opts,
+                                            providers=["CPUExecutionProvider"])
+        self.inputs = {i.name for i in self.session.get_inputs()}
+
+        self.tok = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tok.enable_truncation(max_length=max_len)
+        self.tok.enable_padding()
+
+        self.model = MODEL_NAME
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.pooling = pooling
+        self._q: "Queue[Tuple[List[str], Future]]" = Queue()
+        self._worker = threading.Thread(target=self._loop, name="onnx-embed", daemon=True)
+        self._worker.start()
+
+    def _run(self, texts: Sequence[str]) -> np.ndarray:
+        enc = self.tok.encode_batch([PREFIX + t for t in texts])
+        ids = np.asarray([e.ids for e in enc], dtype="int64")
+        mask = np.asarray([e.attention_mask for e in enc], dtype="int64")
+        feed = {"input_ids": ids, "attention_mask": mask}
+        if "token_type_ids" in self.inputs:
+            feed["token_type_ids"] = np.zeros_like(ids)
+        out = self.session.run(None, {k: v for k, v in feed.items() if k in self.inputs})[0]
+        if out.ndim == 3:  # last_hidden_state (B, T, H) -> pooling
+            if self.pooling == "cls":
+                out = out[:, 0]
+            else:
+                m = mask[..., None].astype("float32")
+                out = (out * m).sum(axis=1) / np.clip(m.sum(axis=1), 1e-9, None)
+        X = np.asarray(out, dtype="float32")
+        return X / (np.linalg.norm(X, axis=1, keepdims=True) + 1e-9)
+
+    def _loop(self) -> None:
+        while True:
+            texts, fut = self._q.get()
+            jobs = [(texts, fut)]
+            n = len(texts)
+            deadline = time.monotonic() + self.max_wait
+            while n < self.max_batch:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                try:
+                    t, f = self._q.get(timeout=left)
+                except Empty:
+                    break
+                jobs.append((t, f))
+                n += len(t)
+            try:
+                X = self._run([t for ts, _ in jobs for t in ts])
+            except Exception as e:
+                for _, f in jobs:
+                    f.set_exception(e)
+                continue
+            i = 0
+            for ts, f in jobs:
+                f.set_result(X[i:i + len(ts)])
+                i += len(ts)
+
+    def embed_matrix(self, texts: Sequence[str], dim: Optional[int] = DIM) -> np.ndarray:
+        """Cùng giao diện OllamaEmbedClient.embed_matrix: (N, dim) float32; dim=None -> số chiều gốc."""
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, dim or DIM), dtype="float32")
+        if len(texts) >= self.max_batch:
+            # batch lớn (pipeline/index) chạy thẳng, không qua hàng đợi
+            X = np.concatenate([self._run(texts[i:i + self.max_batch])
+                                for i in range(0, len(texts), self.max_batch)], axis=0)
+        else:
+            fut: Future = Future()
+            self._q.put((texts, fut))
+            X = fut.result()
+        return _resize_matrix(X, dim) if dim else X
+
+
+_EMBEDDER: Optional[OnnxEmbedder] = None
+_LOCK = threading.Lock()
+
+def get_onnx_embedder() -> OnnxEmbedder:
+    global _EMBEDDER
+    if _EMBEDDER is None:
+        with _LOCK:
+            if _EMBEDDER is None:
+                _EMBEDDER = OnnxEmbedder()
+    return _EMBEDDER
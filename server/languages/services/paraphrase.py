@@ -0,0 +1,196 @@
+"""
+Paraphrase lượt AI trong roleplay: 1 request Gemini có cấu trúc cho cả scenario thay vì 1 request / câu.
+
+    variants_for(blocks, level)        # {block_id: text} — cache trước, chỉ gọi Gemini cho câu chưa có biến thể nào
+    warm_scenarios([(blocks, level)])  # điền đầy pool biến thể, nhiều scenario song song (lệnh prewarm_paraphrases)
+
+Cache theo (block, hash text, level): mỗi key giữ 1 pool tối đa POOL_SIZE biến thể; lượt đọc xoay vòng trong pool
+nên người học vẫn thấy câu khác nhau. Pool chưa đầy -> đẩy task nền thêm biến thể, không bắt người dùng chờ.
+Câu Gemini bỏ sót trong request đầu -> hỏi lại riêng các câu đó 1 lần (request thứ 2, chỉ gồm câu thiếu).
+Câu ngắn (< MIN_WORDS từ), vẫn thiếu sau lần hỏi lại, hoặc request lỗi -> giữ nguyên câu gốc (không cache);
+task top-up nền sẽ điền sau.
+"""
+import hashlib
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+
+from utils.llm_gateway import Priority, slot
+from . import gemini_client
+
+log = logging.getLogger(__name__)
+
+CACHE_ALIAS = getattr(settings, "PARAPHRASE_CACHE_ALIAS", "shared")
+CACHE_TTL = int(getattr(settings, "PARAPHRASE_CACHE_TTL", 60 * 60 * 24 * 30))
+POOL_SIZE = int(getattr(settings, "PARAPHRASE_POOL_SIZE", 3))
+CONCURRENCY = int(getattr(settings, "PARAPHRASE_CONCURRENCY", 4))  # số scenario gọi Gemini song song
+MIN_WORDS = 3
+
+_PREFIX = "para:"
+
+SYSTEM = (
+    "You paraphrase lines of a language-learning roleplay. Paraphrase very concisely, preserve meaning and intent, "
+    "CEFR friendly. Return JSON only: {\"lines\": [{\"i\": <index>, \"variants\": [<string>, ...]}]} with exactly "
+    "the requested number of distinct variants per line."
+)
+
+
+def _backend():
+    try:
+        return caches[CACHE_ALIAS]
+    except InvalidCacheBackendError:
+        return caches["default"]
+
+
+def _key(block, level: Optional[str]) -> str:
+    h = hashlib.sha1((block.text or "").encode("utf-8")).hexdigest()[:12]
+    return f"{_PREFIX}{block.id}:{h}:{level or '-'}"
+
+
+def eligible(block) -> bool:
+    return len((block.text or "").split()) >= MIN_WORDS
+
+
+def _prompt(blocks: Sequence, level: Optional[str], n: int, avoid: Dict[str, List[str]]) -> str:
+    rows = []
+    for i, b in enumerate(blocks):
+        row = {"i": i, "role": b.role or "-", "text": b.text}
+        if avoid.get(str(b.id)):
+            row["avoid"] = avoid[str(b.id)]  # biến thể đã có -> xin câu khác
+        rows.append(row)
+    return (f"CEFR level: {level or 'any'}\nVariants per line: {n}\n"
+            f"Lines:\n{json.dumps(rows, ensure_ascii=False)}")
+
+
+def generate(blocks: Sequence, level: Optional[str], n: int = 1,
+             avoid: Optional[Dict[str, List[str]]] = None,
+             priority: Priority = Priority.BATCH) -> Dict[str, List[str]]:
+    """
+    1 request cho cả danh sách -> {block_id: [biến thể]}; câu thiếu / lỗi không có trong kết quả.
+    priority: BATCH cho job nền (fill / top-up); INTERACTIVE khi người dùng đang chờ (variants_for lúc mở session).
+    """
+    if not blocks:
+        return {}
+    if not gemini_client.available():
+        return {}
+    try:
+        # BATCH nhường slot cho chat/practice tương tác
+        with slot("gemini", priority):
+            resp, _ = gemini_client.generate(_prompt(blocks, level, n, avoid or {}), system=SYSTEM,
+                                             config=gemini_client.JSON, kind="paraphrase")
+        data = json.loads((resp.text or "").strip())
+    except Exception as e:
+        log.error(f"Paraphrase batch failed ({len(blocks)} lines): {e}")
+        return {}
+    out: Dict[str, List[str]] = {}
+    for row in (data.get("lines") if isinstance(data, dict) else None) or []:
+        try:
+            b = blocks[int(row["i"])]
+        except (KeyError, IndexError, TypeError, ValueError):
+            continue
+        vs = [v.strip() for v in (row.get("variants") or []) if isinstance(v, str) and v.strip()]
+        if vs:
+            out[str(b.id)] = vs[:n]
+    return out
+
+
+def _store(blocks: Sequence, level: Optional[str], pools: Dict[str, List[str]], new: Dict[str, List[str]]) -> None:
+    c = _backend()
+    updates = {}
+    for b in blocks:
+        vs = new.get(str(b.id))
+        if not vs:
+            continue
+        pool = list(dict.fromkeys(pools.get(_key(b, level), []) + vs))[:POOL_SIZE]
+        pools[_key(b, level)] = pool
+        updates[_key(b, level)] = pool
+    if updates:
+        try:
+            c.set_many(updates, CACHE_TTL)
+        except Exception as e:
+            log.warning("Paraphrase cache set failed: %s", e)
+
+
+def _pools(blocks: Sequence, level: Optional[str]) -> Dict[str, List[str]]:
+    try:
+        return _backend().get_many([_key(b, level) for b in blocks])
+    except Exception as e:  # Redis down -> coi như miss
+        log.warning("Paraphrase cache get failed: %s", e)
+        return {}
+
+
+def _rotation(blocks: Sequence) -> int:
+    key = f"{_PREFIX}rot:{blocks[0].id}"
+    c = _backend()
+    try:
+        return c.incr(key)
+    except ValueError:
+        c.add(key, 0, CACHE_TTL)
+        return c.incr(key)
+    except Exception:
+        return 0
+
+
+def variants_for(blocks: Sequence, level: Optional[str] = None) -> Dict[str, str]:
+    """-> {block_id: câu paraphrase}; block không có trong dict = dùng câu gốc."""
+    blocks = [b for b in blocks if eligible(b)]
+    if not blocks:
+        return {}
+    pools = _pools(blocks, level)
+    missing = [b for b in blocks if not pools.get(_key(b, level))]
+    if missing:
+        # người học đang chờ mở session -> INTERACTIVE, không xếp sau job nền
+        new = generate(missing, level, n=1, priority=Priority.INTERACTIVE)
+        left = [b for b in missing if str(b.id) not in new]
+        if new and left:  # request thành công nhưng bỏ sót câu -> hỏi lại riêng các câu đó
+            new.update(generate(left, level, n=1, priority=Priority.INTERACTIVE))
+        _store(missing, level, pools, new)
+    if any(len(pools.get(_key(b, level)) or []) < POOL_SIZE for b in blocks):
+        _schedule_topup(blocks, level)
+
+    r = _rotation(blocks)
+    out = {}
+    for b in blocks:
+        pool = pools.get(_key(b, level))
+        if pool:
+            out[str(b.id)] = pool[r % len(pool)]
+    return out
+
+
+def fill(blocks: Sequence, level: Optional[str] = None) -> int:
+    """Điền pool các câu tới POOL_SIZE biến thể bằng 1 request. -> số biến thể mới."""
+    blocks = [b for b in blocks if eligible(b)]
+    pools = _pools(blocks, level)
+    need = [b for b in blocks if len(pools.get(_key(b, level)) or []) < POOL_SIZE]
+    if not need:
+        return 0
+    n = max(POOL_SIZE - len(pools.get(_key(b, level)) or []) for b in need)
+    avoid = {str(b.id): pools.get(_key(b, level)) or [] for b in need}
+    new = generate(need, level, n=n, avoid=avoid)
+    _store(need, level, pools, new)
+    return sum(len(v) for v in new.values())
+
+
+def warm_scenarios(items: Iterable[Tuple[Sequence, Optional[str]]]) -> List[int]:
+    """Nhiều scenario độc lập -> gọi song song (tối đa CONCURRENCY), mỗi scenario 1 request."""
+    items = list(items)
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(CONCURRENCY, len(items))), thread_name_prefix="paraphrase") as ex:
+        return list(ex.map(lambda it: fill(it[0], it[1]), items))
+
+
+def _schedule_topup(blocks: Sequence, level: Optional[str]) -> None:
+    from languages.tasks import paraphrase_topup
+    try:
+        # 1 task / nhóm câu / 5 phút: các session bắt đầu liền nhau không đẩy trùng task
+        if not _backend().add(f"{_PREFIX}topup:{blocks[0].id}:{level or '-'}", 1, 300):
+            return
+        paraphrase_topup.delay([str(b.id) for b in blocks], level)
+    except Exception as e:  # broker down -> lần sau thử lại; người dùng vẫn có câu từ pool
+        log.warning("paraphrase_topup enqueue failed: %s", e)
@@ -0,0 +1,74 @@
+"""
+Log lượt practice dạng append-only (PracticeTurn), thay cho đọc/ghi cả PracticeSession.history_log mỗi lượt.
+
+    append_turns(sid, [{"role": "user", "parts": [...]}, ...])   # 1 UPDATE turn_count + 1 INSERT, không phụ thuộc độ dài phiên
+    tail(sid)                                                     # N lượt cuối (shape Gemini) cho prompt
+    history_log(session)                                          # toàn bộ, shape cũ - chỉ cho serializer tương thích
+
+seq cấp bằng UPDATE turn_count = turn_count + k trong transaction: 2 submit đồng thời bị xếp hàng trên
+row session thay vì ghi đè history_log của nhau.
+"""
+from typing import Dict, List
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from languages.models import PracticeSession, PracticeTurn
+from utils.aio import run_db
+
+TAIL_TURNS = int(getattr(settings, "PRACTICE_HISTORY_TAIL", 12))  # số lượt đưa vào prompt
+
+
+def _text(h: Dict) -> str:
+    return " ".join(str(p) for p in (h.get("parts") or []))
+
+
+def as_history(rows) -> List[Dict]:
+    return [{"role": r.role, "parts": [r.text]} for r in rows]
+
+
+def trim(history: List[Dict], n: int = TAIL_TURNS) -> List[Dict]:
+    """History giữ trong cache session chỉ là phần đuôi; DB mới là log đầy đủ."""
+    return list(history or [])[-n:]
+
+
+def append_turns(session_id, turns: List[Dict]) -> bool:
+    """-> False nếu session không có trong DB (khách chưa đăng nhập: chỉ có cache)."""
+    if not turns:
+        return True
+    with transaction.atomic():
+        n = PracticeSession.objects.filter(id=session_id).update(
+            turn_count=F("turn_count") + len(turns), updated_at=timezone.now())
+        if not n:
+            return False
+        # row session đang bị khoá bởi UPDATE trên -> đọc lại turn_count là giá trị của riêng mình
+        end = PracticeSession.objects.filter(id=session_id).values_list("turn_count", flat=True).get()
+        start = end - len(turns)
+        PracticeTurn.objects.bulk_create([
+            PracticeTurn(session_id=session_id, seq=start + i, role=h.get("role") or "user", text=_text(h))
+            for i, h in enumerate(turns)
+        ])
+    return True
+
+
+def tail(session_id, n: int = TAIL_TURNS) -> List[Dict]:
+    rows = list(PracticeTurn.objects.filter(session_id=session_id).order_by("-seq").only("role", "text")[:n])
+    rows.reverse()
+    return as_history(rows)
+
+
+def history_log(session: PracticeSession) -> List[Dict]:
+    """Shape cũ của PracticeSession.history_log (dùng prefetch "turns" nếu có)."""
+    cache = getattr(session, "_prefetched_objects_cache", {})
+    rows = cache["turns"] if "turns" in cache else session.turns.order_by("seq")
+    return as_history(rows)
+
+
+async def aappend_turns(session_id, turns: List[Dict]) -> bool:
+    return await run_db(append_turns, session_id, turns)
+
+
+async def atail(session_id, n: int = TAIL_TURNS) -> List[Dict]:
+    return await run_db(tail, session_id, n)
@@ -0,0 +1,219 @@
+"""
+Practice dạng pipeline: Gemini stream -> tách câu -> TTS từng câu ngay khi câu đóng.
+
+    async for ev in aiter_practice_turn(sys_ctx, history, transcript, scenario_slug):
+        ev["type"] == "text"   {"seq", "text"}       câu vừa hoàn chỉnh của reply
+        ev["type"] == "audio"  {"seq", "audio"}      audio của câu seq (luôn theo thứ tự seq, sau "text" cùng seq)
+        ev["type"] == "error"  {"detail"}
+        ev["type"] == "done"   {"reply", "reply_trans", "corrected", "explanation"}   (luôn là event cuối)
+
+Người học nghe câu đầu trong lúc model còn sinh các câu sau: độ trễ cảm nhận ~ thời gian ra câu 1 + TTS câu 1,
+thay vì toàn bộ LLM + TTS cả đoạn.
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import re
+from collections import deque
+from typing import AsyncIterator, Dict, List, Optional
+
+from django.conf import settings
+
+from speech.services_block_tts import agenerate_tts_from_text
+from utils.llm_gateway import GatewayBusy, Priority, aslot
+from . import gemini_client
+from .rag import _CHAT_ERROR, aprepare_practice
+
+log = logging.getLogger(__name__)
+
+MIN_SENTENCE_CHARS = int(getattr(settings, "PRACTICE_STREAM_MIN_SENTENCE_CHARS", 12))  # câu quá ngắn gộp với câu sau
+
+_SENT_END_RE = re.compile(r"[.!?…]+[\"')\]]*\s+|\n+")
+
+
+class SentenceSplitter:
+    """feed(text) -> các câu đã đóng; flush() -> phần còn lại khi stream kết thúc."""
+
+    def __init__(self, min_chars: int = MIN_SENTENCE_CHARS):
+        self.min_chars = min_chars
+        self.buf = ""
+
+    def feed(self, text: str) -> List[str]:
+        self.buf += text
+        out, start = [], 0
+        for m in _SENT_END_RE.finditer(self.buf):
+            sent = self.buf[start:m.end()].strip()
+            if len(sent) < self.min_chars:
+                continue  # "Mr. ", "Yes! " -> chờ thêm cho đủ 1 cụm đọc tự nhiên
+            out.append(sent)
+            start = m.end()
+        self.buf = self.buf[start:]
+        return out
+
+    def flush(self) -> List[str]:
+        rest, self.buf = self.buf.strip(), ""
+        return [rest] if rest else []
+
+
+class JsonStringField:
+    """
+    Đọc dần 1 field string (vd. "reply") từ JSON đang stream, chưa cần JSON hoàn chỉnh.
+    feed(chunk) -> phần text mới giải mã được của field; raw giữ toàn bộ để json.loads khi xong.
+    """
+
+    _ESC = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+    def __init__(self, name: str):
+        self._key_re = re.compile(r'"%s"\s*:\s*"' % re.escape(name))
+        self.raw = ""
+        self._pos = None   # vị trí đang đọc trong raw (None = chưa gặp key)
+        self.closed = False
+
+    def feed(self, chunk: str) -> str:
+        self.raw += chunk
+        if self.closed:
+            return ""
+        if self._pos is None:
+            m = self._key_re.search(self.raw)
+            if not m:
+                return ""
+            self._pos = m.end()
+        out, i, raw = [], self._pos, self.raw
+        while i < len(raw):
+            c = raw[i]
+            if c == '"':
+                self.closed = True
+                i += 1
+                break
+            if c != "\\":
+                out.append(c)
+                i += 1
+                continue
+            if i + 1 >= len(raw):
+                break  # escape bị cắt giữa 2 chunk
+            e = raw[i + 1]
+            if e == "u":
+                if i + 6 > len(raw):
+                    break
+                cp, n = int(raw[i + 2:i + 6], 16), 6
+                if 0xD800 <= cp <= 0xDBFF:  # nửa đầu cặp surrogate (emoji, ...): ghép với \uDCxx ngay sau
+                    tail = raw[i + 6:i + 12]
+                    if len(tail) < 6 and "\\u".startswith(tail[:2]):
+                        break  # nửa sau bị cắt sang chunk sau
+                    lo = int(tail[2:], 16) if tail[:2] == "\\u" else 0
+                    if 0xDC00 <= lo <= 0xDFFF:
+                        cp, n = 0x10000 + ((cp - 0xD800) << 10) + (lo - 0xDC00), 12
+                    else:
+                        cp = 0xFFFD  # surrogate lẻ: không encode UTF-8 được (_sse sẽ lỗi)
+                elif 0xDC00 <= cp <= 0xDFFF:
+                    cp = 0xFFFD
+                out.append(chr(cp))
+                i += n
+            else:
+                out.append(self._ESC.get(e, e))
+                i += 2
+        self._pos = i
+        return "".join(out)
+
+
+def _parse_final(raw: str, streamed_reply: str) -> Dict:
+    try:
+        data = json.loads(raw.strip())
+    except Exception as e:
+        log.error(f"Gemini Chat Error: {e}")
+        data = dict(_CHAT_ERROR) if not streamed_reply else {"reply": streamed_reply}
+    return data if isinstance(data, dict) else dict(_CHAT_ERROR)
+
+
+async def aiter_gemini_chat(system_instructions: str, history: list, new_user_input: str,
+                            scenario_slug: Optional[str] = None, lease=None) -> AsyncIterator[str]:
+    """Text thô từng chunk của reply JSON; giữ slot gateway suốt stream (lease có sẵn -> dùng lại)."""
+    chat, final_user_prompt = await aprepare_practice(system_instructions, history, new_user_input, scenario_slug)
+    async with aslot("gemini", Priority.STREAM, lease=lease):
+        async for text in gemini_client.astream(chat, final_user_prompt, kind="practice_stream"):
+            yield text
+
+
+async def aiter_practice_turn(system_instructions: str, history: list, new_user_input: str,
+                              scenario_slug: Optional[str] = None, lang: str = "en",
+                              lease=None) -> AsyncIterator[Dict]:
+    if not gemini_client.available():
+        yield {"type": "done", "reply": "AI service not configured.", "corrected": None}
+        return
+
+    field, splitter = JsonStringField("reply"), SentenceSplitter()
+    upstream = aiter_gemini_chat(system_instructions, history, new_user_input, scenario_slug, lease=lease)
+    pending: deque = deque()  # (seq, task TTS) theo thứ tự câu
+    reply_parts: List[str] = []
+    seq = 0
+
+    def start_tts(sentences):
+        nonlocal seq
+        events = []
+        for s in sentences:
+            pending.append((seq, asyncio.ensure_future(agenerate_tts_from_text(s, lang=lang))))
+            events.append({"type": "text", "seq": seq, "text": s})
+            seq += 1
+        return events
+
+    def ready_audio():
+        events = []
+        while pending and pending[0][1].done():
+            i, t = pending.popleft()
+            events.append({"type": "audio", "seq": i, "audio": t.result()})
+        return events
+
+    error, nxt = None, None
+    try:
+        try:
+            while True:
+                if nxt is None:
+                    nxt = asyncio.ensure_future(upstream.__anext__())
+                # chờ chunk LLM kế tiếp HOẶC audio của câu đứng đầu hàng -> đẩy audio ngay khi xong
+                await asyncio.wait({nxt} | ({pending[0][1]} if pending else set()),
+                                   return_when=asyncio.FIRST_COMPLETED)
+                for ev in ready_audio():
+                    yield ev
+                if not nxt.done():
+                    continue
+                task, nxt = nxt, None
+                try:
+                    chunk = task.result()
+                except StopAsyncIteration:
+                    break
+                piece = field.feed(chunk)
+                reply_parts.append(piece)
+                for ev in start_tts(splitter.feed(piece)):
+                    yield ev
+        except GatewayBusy:
+            raise  # người gọi trả 429 / llm_busy
+        except Exception as e:
+            log.error(f"Gemini Chat Error: {e}")
+            error = str(e) or e.__class__.__name__
+        finally:
+            if nxt is not None and not nxt.done():
+                nxt.cancel()
+                with contextlib.suppress(BaseException):
+                    await nxt
+            await upstream.aclose()
+
+        streamed = "".join(reply_parts).strip()
+        if error is not None:
+            yield {"type": "error", "detail": error}
+            data = {**_CHAT_ERROR, "reply": streamed} if streamed else dict(_CHAT_ERROR)
+        else:
+            data = _parse_final(field.raw, streamed)
+        if not streamed:
+            # model không trả JSON đúng dạng / lỗi trước khi có reply -> đọc reply cuối cùng 1 lần
+            splitter.buf = data.get("reply") or "..."
+        for ev in start_tts(splitter.flush()):
+            yield ev
+        while pending:
+            await asyncio.wait({pending[0][1]})
+            for ev in ready_audio():
+                yield ev
+        yield {"type": "done", **data, "reply": data.get("reply") or streamed or "..."}
+    finally:
+        for _, t in pending:
+            t.cancel()  # client ngắt giữa chừng -> dừng Piper/ffmpeg của các câu chưa phát
@@ -1,32 +1,30 @@
+import asyncio
 import json
-import os, logging
+import logging
 from typing import Optional
 from django.db.models import F
-from pgvector.django import CosineDistance
-from languages.models import RoleplayBlock
-from .ollama_client import embed_one
-import google.generativeai as genai
+from languages.models import RoleplayBlock, RoleplayScenario
+from .embed_cache import embed_text
+from .vector_search import nearest
+from . import gemini_client
+from utils.aio import run_db, submit_db
+from utils.llm_gateway import Priority, aslot, slot
 log = logging.getLogger(__name__)
 
-def retrieve_blocks(q_text: str, top_k=8, scenario_slug: Optional[str] = None):
-    q_vec = embed_one(q_text)
-    qs = (
-        # RoleplayBlock.objects.exclude(embedding__isnull=True)
-        # .exclude(section='dialogue') 
-        RoleplayBlock.objects
-        .filter(scenario__slug=scenario_slug)       # Chỉ tìm trong bài học hiện tại
-        .exclude(embedding__isnull=True)            # Bỏ qua block chưa có vector
-        .annotate(score=CosineDistance("embedding", q_vec)) # So khớp vector
-        .order_by("score")                          # Xếp theo độ tương đồng (thấp nhất là giống nhất với CosineDistance)
-        [:top_k]
-    )
-    if scenario_slug: qs = qs.filter(scenario__slug=scenario_slug)
-    return (qs.annotate(score=CosineDistance("embedding", q_vec))
-             .order_by("score")[:top_k])
-
-
-GEMINI_MODEL = os.getenv("GEMINI_MODEL", "models/gemini-2.5-flash")
-if os.getenv("GEMINI_API_KEY"): genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+def retrieve_blocks(q_text: str, top_k=8, scenario_slug: Optional[str] = None, ef_search: Optional[int] = None):
+    q_vec = embed_text(q_text)  # L1 / Redis trước, miss mới gọi embed (client dùng chung, keep-alive)
+    qs = RoleplayBlock.objects.exclude(embedding__isnull=True)   # Bỏ qua block chưa có vector
+    if scenario_slug:
+        # Chỉ tìm trong bài học hiện tại: lọc theo scenario_id (btree) thay vì join theo slug
+        scn_id = RoleplayScenario.objects.filter(slug=scenario_slug).values_list("id", flat=True).first()
+        if scn_id is None:
+            return []
+        qs = qs.filter(scenario_id=scn_id)
+    # CosineDistance thấp nhất = giống nhất; chạy trong ann_session (ef_search, halfvec + rescore)
+    return nearest(qs, q_vec, top_k, ef_search=ef_search, filtered=bool(scenario_slug))
+
+
+GEMINI_MODEL = gemini_client.MODEL
 
 SYS = ("You are a helpful and friendly English tutor. "
        "You will be provided with CONTEXT from a roleplay scenario. This CONTEXT includes background, instructions, warmup exercises, and vocabulary lists. "
@@ -66,25 +64,30 @@ SYS_PRACTICE = (
     "  \"explanation\": \"(String or Null) Grammar explanation in support language.\"\n"
     "}"
 )
+SAFETY = {
+    'HARM_CATEGORY_HATE_SPEECH': 'BLOCK_MEDIUM_AND_ABOVE',
+    'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_MEDIUM_AND_ABOVE',
+    'HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_MEDIUM_AND_ABOVE',
+    'HARM_CATEGORY_HARASSMENT': 'BLOCK_MEDIUM_AND_ABOVE',
+}
+
+
 def ask_gemini(query: str, blocks) -> str:
-    if not os.getenv("GEMINI_API_KEY"): return ""
+    if not gemini_client.available(): return ""
     ctx = "\n".join([f"[{b.section}#{b.order}] {b.role or '-'}: {b.text}" for b in blocks])
     prompt = f"""<DIALOGUE_CONTEXT>
     {ctx}
     </DIALOGUE_CONTEXT>
     USER: {query}
     """
-    m = genai.GenerativeModel(GEMINI_MODEL, system_instruction=SYS)
+    # hết slot gateway -> GatewayBusy (429) bay lên view, không bị nuốt bởi except bên dưới
+    with slot("gemini", Priority.INTERACTIVE):
+        return _ask_gemini(prompt)
+
+
+def _ask_gemini(prompt: str) -> str:
     try:
-        response = m.generate_content(
-            prompt,
-            safety_settings={
-                'HARM_CATEGORY_HATE_SPEECH': 'BLOCK_MEDIUM_AND_ABOVE',
-                'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_MEDIUM_AND_ABOVE',
-                'HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_MEDIUM_AND_ABOVE',
-                'HARM_CATEGORY_HARASSMENT': 'BLOCK_MEDIUM_AND_ABOVE',
-            }
-        )
+        response, _ = gemini_client.generate(prompt, system=SYS, safety=SAFETY, kind="ask")
         
         # Kiểm tra xem response có bị block không
         if response.prompt_feedback.block_reason:
@@ -104,41 +107,105 @@ def ask_gemini_chat(
     new_user_input: str, 
     scenario_slug: Optional[str] = None
 ) -> dict:
-    if not os.getenv("GEMINI_API_KEY"): 
+    if not gemini_client.available():
         return {"reply": "AI service not configured.", "corrected": None}
 
-    # 1. RAG Retrieve (Giữ nguyên)
+    # 1. RAG retrieve chạy ở DB pool trong lúc dựng chat (model cache + history)
+    rag = submit_db(retrieve_blocks, new_user_input, top_k=3, scenario_slug=scenario_slug) if scenario_slug else None
+    chat = _practice_chat(system_instructions, history)
     rag_context = ""
-    if scenario_slug:
+    if rag is not None:
         try:
-            relevant_blocks = retrieve_blocks(new_user_input, top_k=3, scenario_slug=scenario_slug)
-            if relevant_blocks:
-                block_texts = [f"- {b.embedding_text or b.text}" for b in relevant_blocks]
-                rag_context = "\nDETAILS FOUND IN SCENARIO:\n" + "\n".join(block_texts) + "\n"
+            rag_context = _rag_context(rag.result())
         except Exception as e:
             log.warning(f"RAG Retrieval failed: {e}")
+    final_user_prompt = _user_prompt(new_user_input, rag_context)
 
+    with slot("gemini", Priority.INTERACTIVE):
+        try:
+            response, _ = gemini_client.send(chat, final_user_prompt, kind="practice")
+        except Exception as e:
+            log.error(f"Gemini Chat Error: {e}")
+            return dict(_CHAT_ERROR)
+    return _parse_chat(response)
+
+
+_CHAT_ERROR = {"reply": "Sorry, I encountered an error.", "corrected": None, "explanation": None}
+
+
+def _rag_context(relevant_blocks) -> str:
+    if not relevant_blocks:
+        return ""
+    block_texts = [f"- {b.embedding_text or b.text}" for b in relevant_blocks]
+    return "\nDETAILS FOUND IN SCENARIO:\n" + "\n".join(block_texts) + "\n"
+
+
+def _practice_chat(system_instructions: str, history: list):
     # 2. [QUAN TRỌNG] Kết hợp SYS_PRACTICE (Luật) + system_instructions (Dữ liệu bài học)
     # SYS_PRACTICE đứng đầu để định hình hành vi (System Prompt)
     combined_system_prompt = f"{SYS_PRACTICE}\n\n=== CURRENT SCENARIO INFO ===\n{system_instructions}"
 
+    # Model theo (system prompt gộp, JSON) lấy từ cache của gemini_client: cùng scenario -> cùng object
+    return gemini_client.start_chat(combined_system_prompt, gemini_client.JSON, history)
+
+
+def _user_prompt(new_user_input: str, rag_context: str) -> str:
     # 3. Prompt User
-    final_user_prompt = f"{rag_context}\nSTUDENT SAYS: {new_user_input}"
+    return f"{rag_context}\nSTUDENT SAYS: {new_user_input}"
 
-    # Khởi tạo model với Prompt gộp
-    model = genai.GenerativeModel(os.getenv("GEMINI_MODEL"), system_instruction=combined_system_prompt)
-    
-    if not history:
-        chat = model.start_chat(history=[])
-    else:
-        chat = model.start_chat(history=history)
 
+async def aprepare_practice(system_instructions: str, history: list, new_user_input: str,
+                            scenario_slug: Optional[str] = None):
+    """-> (chat, prompt). Retrieve (embed + ORM, DB pool) chạy song song với dựng chat trên event loop."""
+    rag = asyncio.ensure_future(
+        run_db(retrieve_blocks, new_user_input, top_k=3, scenario_slug=scenario_slug)) if scenario_slug else None
+    rag_context = ""
+    try:
+        if rag is not None:
+            await asyncio.sleep(0)  # cho task retrieve đẩy việc sang DB pool trước khi dựng chat
+        chat = _practice_chat(system_instructions, history)
+        if rag is not None:
+            try:
+                rag_context = _rag_context(await rag)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning(f"RAG Retrieval failed: {e}")
+    finally:
+        if rag is not None and not rag.done():
+            rag.cancel()
+    return chat, _user_prompt(new_user_input, rag_context)
+
+
+def _parse_chat(response) -> dict:
     try:
-        response = chat.send_message(
-            final_user_prompt,
-            generation_config={"response_mime_type": "application/json"}
-        )
         return json.loads(response.text.strip())
     except Exception as e:
         log.error(f"Gemini Chat Error: {e}")
-        return {"reply": "Sorry, I encountered an error.", "corrected": None, "explanation": None}
\ No newline at end of file
+        return dict(_CHAT_ERROR)
+
+
+async def aask_gemini_chat(
+    system_instructions: str,
+    history: list,
+    new_user_input: str,
+    scenario_slug: Optional[str] = None
+) -> dict:
+    """
+    Bản async của ask_gemini_chat cho consumer: retrieve (ORM + embed) ở DB pool giới hạn, song song với dựng chat,
+    Gemini qua send_message_async -> không giữ event loop / thread trong lúc chờ model.
+    """
+    if not gemini_client.available():
+        return {"reply": "AI service not configured.", "corrected": None}
+
+    chat, final_user_prompt = await aprepare_practice(system_instructions, history, new_user_input, scenario_slug)
+
+    async with aslot("gemini", Priority.STREAM):
+        try:
+            response, _ = await gemini_client.asend(chat, final_user_prompt, kind="practice")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.error(f"Gemini Chat Error: {e}")
+            return dict(_CHAT_ERROR)
+    return _parse_chat(response)
@@ -0,0 +1,165 @@
+"""
+"Scenario plan" đã biên dịch cho roleplay start/submit: build 1 lần / phiên bản scenario, để trong cache dùng chung.
+
+    plan = get_plan(scn)            # start: 1 query aggregate lấy version + 1 cache read (miss -> build)
+    plan = load_plan(sess["plan"])  # submit: đúng 1 cache read, không query block nào
+    plan_blocks(plan, i, j)         # PlanBlock (id, role, text, audio_key, ...) cho ai_lines_for / score_user_turn
+
+Plan gồm dialogue theo thứ tự, đáp án + hint, vector (float16) và audio_key của từng block; session chỉ giữ
+con trỏ {plan, idx, role}. Version = updated_at của scenario + count/max(updated_at) của block + model embed
+-> sửa block / re-embed là sinh key mới, plan cũ tự hết hạn theo TTL.
+"""
+import hashlib
+import logging
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+from django.db.models import Count, Max
+
+from languages.models import RoleplayBlock, RoleplayScenario
+from .ollama_client import current_model
+from .roleplay_flow import ordered_blocks, split_prologue_and_dialogue
+from .validate_turn import answer_vec_for, make_hint
+
+log = logging.getLogger(__name__)
+
+CACHE_ALIAS = getattr(settings, "ROLEPLAY_PLAN_CACHE_ALIAS", "shared")
+CACHE_TTL = int(getattr(settings, "ROLEPLAY_PLAN_CACHE_TTL", 60 * 60 * 24))
+
+_PREFIX = "rp:plan:"
+
+
+class PlanBlock(NamedTuple):
+    id: str
+    role: str
+    text: str
+    audio_key: str
+    order: int
+    section: str
+    hint: str
+    vec: Any = None         # embedding của block (expected_vec)
+    answer_vec: Any = None  # vector đáp án đã embed sẵn (None nếu stale)
+
+
+def _backend():
+    try:
+        return caches[CACHE_ALIAS]
+    except InvalidCacheBackendError:
+        return caches["default"]
+
+
+def _f16(vec) -> Optional[bytes]:
+    if vec is None:
+        return None
+    return np.asarray(vec, dtype="float32").reshape(-1).astype("float16").tobytes()
+
+
+def _vec(raw: Optional[bytes]):
+    return None if raw is None else np.frombuffer(raw, dtype="float16").astype("float32")
+
+
+def version(scn: RoleplayScenario) -> str:
+    agg = RoleplayBlock.objects.filter(scenario=scn).aggregate(n=Count("id"), m=Max("updated_at"))
+    raw = f"{scn.updated_at.isoformat() if scn.updated_at else ''}|{agg['n']}|{agg['m']}|{current_model()}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def plan_key(scn_id, ver: str) -> str:
+    return f"{_PREFIX}{scn_id}:{ver}"
+
+
+def _entry(b) -> Dict[str, Any]:
+    return {
+        "id": str(b.id),
+        "role": b.role or "",
+        "text": b.text,
+        "audio_key": b.audio_key,
+        "order": b.order,
+        "section": b.section,
+        "hint": make_hint(b.text, 80),
+        "vec": _f16(b.embedding),
+        "answer_vec": _f16(answer_vec_for(b)),
+    }
+
+
+def build(scn: RoleplayScenario, ver: Optional[str] = None) -> Dict[str, Any]:
+    ver = ver or version(scn)
+    prologue, dialogue = split_prologue_and_dialogue(ordered_blocks(scn))
+    return {
+        "key": plan_key(scn.id, ver),
+        "scenario_id": str(scn.id),
+        "slug": scn.slug,
+        "level": scn.level,
+        "version": ver,
+        "prologue": [
+            {"role": b.role or "-", "text": b.text, "section": b.section, "audio_key": b.audio_key, "order": b.order}
+            for b in prologue
+        ],
+        "dialogue": [_entry(b) for b in dialogue],
+    }
+
+
+def get_plan(scn: RoleplayScenario) -> Dict[str, Any]:
+    ver = version(scn)
+    key = plan_key(scn.id, ver)
+    c = _backend()
+    try:
+        plan = c.get(key)
+    except Exception as e:  # Redis down -> build tại chỗ, không cache
+        log.warning("Scenario plan cache get failed: %s", e)
+        return build(scn, ver)
+    if plan is None:
+        plan = build(scn, ver)
+        try:
+            c.set(key, plan, CACHE_TTL)
+        except Exception as e:
+            log.warning("Scenario plan cache set failed: %s", e)
+    return plan
+
+
+def load_plan(key: str, scenario_id=None) -> Optional[Dict[str, Any]]:
+    """
+    Cache miss (bị evict) -> build lại bản hiện tại của scenario (nếu biết scenario_id). Scenario đã sửa thì
+    plan["key"] khác key truyền vào: idx cũ của session không còn khớp dialogue, người gọi phải xử lý.
+    """
+    try:
+        plan = _backend().get(key)
+    except Exception as e:
+        log.warning("Scenario plan cache get failed: %s", e)
+        plan = None
+    if plan is None and scenario_id:
+        scn = RoleplayScenario.objects.filter(id=scenario_id).first()
+        plan = get_plan(scn) if scn else None
+    return plan
+
+
+def plan_blocks(plan: Dict[str, Any], start: int = 0, stop: Optional[int] = None) -> List[PlanBlock]:
+    return [
+        PlanBlock(**{**e, "vec": _vec(e["vec"]), "answer_vec": _vec(e["answer_vec"])})
+        for e in plan["dialogue"][start:stop]
+    ]
+
+
+def next_user_index(plan: Dict[str, Any], idx: int, role: str) -> int:
+    """Vị trí lượt kế tiếp của người học từ idx (== len(dialogue) nếu hết)."""
+    dlg = plan["dialogue"]
+    while idx < len(dlg) and dlg[idx]["role"] != role:
+        idx += 1
+    return idx
+
+
+def await_payload(plan: Dict[str, Any], idx: int, role: str) -> Optional[Dict[str, Any]]:
+    if idx >= len(plan["dialogue"]):
+        return None
+    e = plan["dialogue"][idx]
+    return {
+        "block_id": e["id"],
+        "role": role,
+        "order": e["order"],
+        "expected_text": e["text"],
+        "audio_key": e["audio_key"],
+        "expected_hint": e["hint"],
+    }
@@ -1,21 +1,37 @@
-from django.core.cache import cache
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
 import uuid, time
 
 TTL = 60*60 
 
-def create_session(scn_id, chosen_role, dialogue_ids):
+# cache dùng chung (Redis) -> session roleplay/practice đi qua được mọi worker; chưa cấu hình -> LocMem
+def _backend():
+    try:
+        return caches["shared"]
+    except InvalidCacheBackendError:
+        return caches["default"]
+
+def create_session(scn_id, chosen_role, plan_key, idx=0):
+    """Session roleplay chỉ là con trỏ vào scenario plan (languages.services.scenario_plan)."""
     sid = str(uuid.uuid4())
-    cache.set(f"rp:{sid}", {
+    _backend().set(f"rp:{sid}", {
         "scenario_id": scn_id,
         "role": chosen_role,
-        "dialogue_ids": dialogue_ids,
-        "idx": 0,
+        "plan": plan_key,
+        "idx": idx,
         "created_at": int(time.time()),
     }, TTL)
     return sid
 
 def get_session(sid):
-    return cache.get(f"rp:{sid}")
+    return _backend().get(f"rp:{sid}")
 
 def save_session(sid, data):
-    cache.set(f"rp:{sid}", data, TTL)
+    _backend().set(f"rp:{sid}", data, TTL)
+
+
+async def aget_session(sid):
+    return await _backend().aget(f"rp:{sid}")
+
+async def asave_session(sid, data):
+    await _backend().aset(f"rp:{sid}", data, TTL)
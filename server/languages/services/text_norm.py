@@ -0,0 +1,65 @@
+"""
+Chuẩn hoá câu trả lời hội thoại trước khi so khớp / embed: smart quotes -> ascii, NFKC + lower, mở viết tắt,
+gom số điện thoại / giờ / tiền thành placeholder, bỏ dấu câu. Dùng chung cho validate_turn (chấm điểm) và
+embed_pipeline (vector đáp án embed sẵn) -> 2 bên luôn chuẩn hoá giống hệt nhau.
+"""
+import re, unicodedata
+
+# ==== patterns ====
+PHONE_RE = re.compile(r"\+?\d[\d\-\s]{6,}\d")
+TIME_RE  = re.compile(r"\b([01]?\d|2[0-3])\s*[:.]\s*[0-5]\d(\s*(am|pm))?\b", re.I)
+
+# $80 / 80$ / 80 dollars / 80 usd / eighty dollars (số chữ vẫn để, nhưng gom các cụm rõ ràng)
+CURRENCY_WORDS = r"(dollars?|bucks?|usd|euros?|eur|pounds?|gbp|yen|jpy|vnd|dong)"
+MONEY_RE = re.compile(
+    rf"(\$|\€|\£|\¥)\s*\d+(\.\d+)?|\d+(\.\d+)?\s*({CURRENCY_WORDS})",
+    re.I
+)
+
+# Một số viết tắt phổ biến
+CONTRACTIONS = {
+    "i'm": "i am", "we're": "we are", "you're": "you are",
+    "they're": "they are", "it's": "it is", "that's": "that is",
+    "there's": "there is", "i've": "i have", "we've": "we have",
+    "can't": "cannot", "won't": "will not", "don't": "do not",
+    "didn't": "did not", "couldn't": "could not", "wouldn't": "would not",
+    "shouldn't": "should not", "i'll": "i will", "we'll": "we will",
+    "you'll": "you will", "they'll": "they will", "let's": "let us",
+}
+
+# chuẩn hoá unicode → ascii (thay smart quotes)
+_QUOTES_TBL = str.maketrans({
+    ord("’"): "'",
+    ord("‘"): "'",
+    ord("“"): '"',
+    ord("”"): '"',
+    ord("–"): "-",
+    ord("—"): "-",
+    ord("…"): "...",
+    160: 32,  # NBSP → space
+})
+# mọi contraction trong 1 regex (1 lượt quét); giá trị thay thế không chứa "'" nên kết quả = thay lần lượt
+CONTRACTION_RE = re.compile(r"\b(" + "|".join(map(re.escape, sorted(CONTRACTIONS, key=len, reverse=True))) + r")\b")
+_PUNCT_RE = re.compile(r"[^a-z0-9<>\s]")
+_SPACE_RE = re.compile(r"\s+")
+
+def ascii_quotes(s: str) -> str:
+    return s.translate(_QUOTES_TBL)
+
+def expand_contractions(s: str) -> str:
+    return CONTRACTION_RE.sub(lambda m: CONTRACTIONS[m.group(1)], s)
+
+def normalize_answer(s: str) -> str:
+    s = ascii_quotes(s or "")
+    s = unicodedata.normalize("NFKC", s).lower().strip()
+    s = expand_contractions(s)
+
+    # placeholders
+    s = PHONE_RE.sub("<PHONE>", s)
+    s = TIME_RE.sub("<TIME>", s)
+    s = MONEY_RE.sub("<MONEY>", s)
+
+    # bỏ hầu hết punctuation, giữ chữ số/chữ và placeholders <>
+    s = _PUNCT_RE.sub(" ", s)
+    s = _SPACE_RE.sub(" ", s).strip()
+    return s
@@ -1,30 +1,11 @@
-import re, math, unicodedata, hashlib
+import re, math, hashlib
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+import numpy as np
 from collections import Counter
 from difflib import SequenceMatcher
-from languages.services.ollama_client import embed_one
-from django.core.cache import cache
-
-# ==== patterns ====
-PHONE_RE = re.compile(r"\+?\d[\d\-\s]{6,}\d")
-TIME_RE  = re.compile(r"\b([01]?\d|2[0-3])\s*[:.]\s*[0-5]\d(\s*(am|pm))?\b", re.I)
-
-# $80 / 80$ / 80 dollars / 80 usd / eighty dollars (số chữ vẫn để, nhưng gom các cụm rõ ràng)
-CURRENCY_WORDS = r"(dollars?|bucks?|usd|euros?|eur|pounds?|gbp|yen|jpy|vnd|dong)"
-MONEY_RE = re.compile(
-    rf"(\$|\€|\£|\¥)\s*\d+(\.\d+)?|\d+(\.\d+)?\s*({CURRENCY_WORDS})",
-    re.I
-)
-
-# Một số viết tắt phổ biến
-CONTRACTIONS = {
-    "i'm": "i am", "we're": "we are", "you're": "you are",
-    "they're": "they are", "it's": "it is", "that's": "that is",
-    "there's": "there is", "i've": "i have", "we've": "we have",
-    "can't": "cannot", "won't": "will not", "don't": "do not",
-    "didn't": "did not", "couldn't": "could not", "wouldn't": "would not",
-    "shouldn't": "should not", "i'll": "i will", "we'll": "we will",
-    "you'll": "you will", "they'll": "they will", "let's": "let us",
-}
+from languages.services.ollama_client import DIM, current_model
+from languages.services import embed_cache
+from languages.services.text_norm import ascii_quotes, expand_contractions, normalize_answer
 
 # filler words cần bỏ qua khi so khớp tokens
 FILLERS = {"uh", "um", "er", "ah", "uhm", "hmm", "like", "you", "know"}
@@ -32,43 +13,16 @@ FILLERS = {"uh", "um", "er", "ah", "uhm", "hmm", "like", "you", "know"}
 # stopwords tối giản để giảm nhiễu lexical
 STOPWORDS = {"a", "an", "the", "to", "for", "at", "is", "am", "are", "of", "and"}
 
+_TOKEN_RE = re.compile(r"[a-z0-9<>]+")
 
-def _ascii_quotes(s: str) -> str:
-    # chuẩn hoá unicode → ascii (thay smart quotes)
-    tbl = {
-        ord("’"): "'",
-        ord("‘"): "'",
-        ord("“"): '"',
-        ord("”"): '"',
-        ord("–"): "-",
-        ord("—"): "-",
-        ord("…"): "...",
-        160: 32,  # NBSP → space
-    }
-    return s.translate(tbl)
-
-def _expand_contractions(s: str) -> str:
-    for k, v in CONTRACTIONS.items():
-        s = re.sub(rf"\b{k}\b", v, s)
-    return s
-
-def _normalize(s: str) -> str:
-    s = _ascii_quotes(s or "")
-    s = unicodedata.normalize("NFKC", s).lower().strip()
-    s = _expand_contractions(s)
+# tên cũ giữ cho languages.services (re-export) và code đang import trực tiếp
+_ascii_quotes = ascii_quotes
+_expand_contractions = expand_contractions
+_normalize = normalize_answer
 
-    # placeholders
-    s = re.sub(PHONE_RE, "<PHONE>", s)
-    s = re.sub(TIME_RE, "<TIME>", s)
-    s = re.sub(MONEY_RE, "<MONEY>", s)
-
-    # bỏ hầu hết punctuation, giữ chữ số/chữ và placeholders <>
-    s = re.sub(r"[^a-z0-9<>\s]", " ", s)
-    s = re.sub(r"\s+", " ", s).strip()
-    return s
 
 def _tokens(s: str):
-    toks = re.findall(r"[a-z0-9<>]+", s)
+    toks = _TOKEN_RE.findall(s)
     # bỏ fillers/stopwords nhẹ
     return [t for t in toks if t not in FILLERS and t not in STOPWORDS]
 
@@ -136,54 +90,175 @@ COS_SOFT   = 0.72  # cosine mềm + lexical cao 2. Ý nghĩa hơi đúng + Từ
 LEX_STRONG = 0.82  # lexical mạnh khi cosine mềm
 LEX_HARD   = 0.88  # chỉ lexical đủ cao là pass # 3. Từ vựng y xì đúc (dù AI ko hiểu) -> OK
 
-def score_user_turn(expected_text: str, expected_vec, user_text: str):
+# vector từ embed_cache là float16 (sai số cosine ~1e-3): cosine cách ngưỡng quyết định < COS_EXACT_EPS
+# -> embed lại các text đó bằng float32 (bỏ qua cache) rồi mới quyết định, giữ đúng kết quả như trước khi có cache
+COS_EXACT_EPS = 0.005
+
+def _borderline(cs: float, lex: float) -> bool:
+    """Quyết định passed có thể lật nếu cosine lệch ±COS_EXACT_EPS."""
+    if lex >= LEX_HARD:
+        return False
+    if abs(cs - COS_MAIN) < COS_EXACT_EPS:
+        return True
+    return lex >= LEX_STRONG and abs(cs - COS_SOFT) < COS_EXACT_EPS
+
+def answer_hash(exp_norm: str, model: str = None) -> str:
+    return hashlib.sha256(f"{model or current_model()}:{exp_norm}".encode("utf-8")).hexdigest()
+
+def answer_vec_for(block):
+    """Vector đáp án đã embed sẵn lúc lưu block (None nếu text/model đã đổi từ lúc embed)."""
+    vec = getattr(block, "answer_embedding", None)
+    if vec is None or block.answer_hash != answer_hash(normalize_answer(block.text)):
+        return None
+    return vec
+
+class Candidate(NamedTuple):
+    text: str
+    vec: Any = None         # embedding của block trong DB (expected_vec)
+    answer_vec: Any = None  # vector của normalize_answer(text) đã embed sẵn
+
+
+def _rows(vecs: Sequence, dim: int) -> np.ndarray:
+    """list vector -> ma trận (n, dim) đã chuẩn hoá L2 (cắt về dim chung như _cosine)."""
+    if not vecs:
+        return np.zeros((0, dim), dtype="float32")
+    X = np.stack([np.asarray(v, dtype="float32").reshape(-1)[:dim] for v in vecs])
+    n = np.linalg.norm(X, axis=1, keepdims=True)
+    n[n == 0] = 1e-9
+    return X / n
+
+
+def _lexical_fast(exp_norm: str, usr_norm: str, expt, usrt, full: bool = False):
+    """
+    = _lexical_score nhưng chỉ chạy SequenceMatcher.ratio() khi cận trên quick_ratio còn có thể vượt
+    max(f1, set) -> giá trị lexical giống hệt, phần lớn cặp bỏ qua được bước đắt nhất.
+    """
+    f1 = _token_f1(expt, usrt)
+    ts = _token_set_ratio(expt, usrt)
+    best = max(f1, ts)
+    sm = SequenceMatcher(None, exp_norm, usr_norm)
+    seq = None
+    if full or (sm.real_quick_ratio() > best and sm.quick_ratio() > best):
+        seq = sm.ratio()
+    return max(best, seq or 0.0), f1, ts, seq
+
+
+def score_batch(pairs: Iterable[Tuple[str, Sequence]], *, embed: Optional[Callable] = None,
+                embed_exact: Optional[Callable] = None, debug: bool = False) -> List[Dict]:
+    """
+    Chấm nhiều lượt 1 lúc: pairs = [(user_text, [expected_text | Candidate, ...]), ...]
+      - mỗi text chỉ normalize_answer/tokenize 1 lần, mọi text cần vector embed trong 1 lời gọi (qua embed_cache)
+      - cosine của mọi cặp (user, candidate) tính bằng 1 phép nhân trên ma trận đã chuẩn hoá
+      - quyết định passed giữ nguyên luật COS_MAIN / COS_SOFT+LEX_STRONG / LEX_HARD; cặp sát ngưỡng được tính lại
+        bằng vector float32 (embed_exact, mặc định embed_cache.embed_exact; embed tự truyền vào -> dùng chính nó)
+    -> [{"passed", "best", "candidates": [{"cosine", "lexical", "passed"[, "debug"]}, ...]}, ...]
+    """
+    if embed is None:
+        embed, embed_exact = embed_cache.embed_texts, embed_exact or embed_cache.embed_exact
+    else:
+        embed_exact = embed_exact or embed
+    pairs = [(u, [c if isinstance(c, Candidate) else Candidate(c) for c in cands]) for u, cands in pairs]
+
+    norm: Dict[str, str] = {}
+    toks: Dict[str, list] = {}
+    def N(t: str) -> str:
+        n = norm.get(t)
+        if n is None:
+            n = norm[t] = normalize_answer(t or "")
+            toks.setdefault(n, _tokens(n))
+        return n
+
+    # (pair, candidate) phẳng
+    flat = []  # (pair_idx, usr_norm, exp_norm, cand)
+    for pi, (u, cands) in enumerate(pairs):
+        un = N(u or "")
+        for c in cands:
+            flat.append((pi, un, N(c.text or ""), c))
+
+    need = list(dict.fromkeys([f[1] for f in flat] + [f[2] for f in flat if f[3].answer_vec is None]))
+    X = np.asarray(embed(need), dtype="float32") if need else np.zeros((0, DIM), dtype="float32")
+    pre = [f[3].answer_vec for f in flat if f[3].answer_vec is not None]
+    dbv = [_to_list(f[3].vec) for f in flat]
+    dims = [X.shape[1]] + [len(np.asarray(v).reshape(-1)) for v in pre] + [len(v) for v in dbv if v]
+    dim = min(dims)
+
+    row = {t: i for i, t in enumerate(need)}
+    M = np.concatenate([_rows(list(X), dim), _rows(pre, dim)], axis=0)
+    ui = np.array([row[f[1]] for f in flat], dtype="int64")
+    ei, k = [], len(need)
+    for f in flat:
+        if f[3].answer_vec is None:
+            ei.append(row[f[2]])
+        else:
+            ei.append(k); k += 1
+    ei = np.array(ei, dtype="int64")
+
+    cos1 = np.einsum("ij,ij->i", M[ui], M[ei]) if flat else np.zeros(0, dtype="float32")
+    has_db = np.array([bool(v) for v in dbv], dtype=bool)
+    cos2 = np.full(len(flat), -np.inf, dtype="float32")
+    if has_db.any():
+        D = _rows([v for v in dbv if v], dim)
+        cos2[has_db] = np.einsum("ij,ij->i", M[ui[has_db]], D)
+    cos = np.maximum(cos1, cos2)
+    lexes = [_lexical_fast(en, un, toks[en], toks[un], full=debug) for _, un, en, _ in flat]
+
+    near = [n for n in range(len(flat)) if _borderline(float(cos[n]), lexes[n][0])]
+    redo = list(dict.fromkeys([flat[n][1] for n in near] + [flat[n][2] for n in near if flat[n][3].answer_vec is None]))
+    if redo:
+        E = _rows(list(np.asarray(embed_exact(redo), dtype="float32")), dim)
+        for t, v in zip(redo, E):
+            M[row[t]] = v
+        near = np.array(near, dtype="int64")
+        cos1[near] = np.einsum("ij,ij->i", M[ui[near]], M[ei[near]])
+        nd = near[has_db[near]]
+        if len(nd):
+            Dfull = np.zeros((len(flat), dim), dtype="float32")
+            Dfull[has_db] = D
+            cos2[nd] = np.einsum("ij,ij->i", M[ui[nd]], Dfull[nd])
+        cos[near] = np.maximum(cos1[near], cos2[near])
+
+    out = [{"passed": False, "best": None, "candidates": []} for _ in pairs]
+    for n, (pi, un, en, c) in enumerate(flat):
+        lex, f1, ts, seq = lexes[n]
+        cs = float(cos[n])
+        passed = (cs >= COS_MAIN) or (cs >= COS_SOFT and lex >= LEX_STRONG) or (lex >= LEX_HARD)
+        item = {"cosine": round(cs, 4), "lexical": round(lex, 4), "passed": bool(passed)}
+        if debug:
+            item["debug"] = {
+                "expected_norm": en,
+                "user_norm": un,
+                "cos_norm": round(float(cos1[n]), 4),
+                **({"cos_db": round(float(cos2[n]), 4)} if has_db[n] else {}),
+                "seq": round(seq, 4),
+                "f1": round(f1, 4),
+                "set": round(ts, 4),
+                "exp_tokens": toks[en],
+                "usr_tokens": toks[un],
+                "thresholds": {
+                    "COS_MAIN": COS_MAIN, "COS_SOFT": COS_SOFT,
+                    "LEX_STRONG": LEX_STRONG, "LEX_HARD": LEX_HARD
+                }
+            }
+        res = out[pi]
+        res["candidates"].append(item)
+        j = len(res["candidates"]) - 1
+        best = res["candidates"][res["best"]] if res["best"] is not None else None
+        if best is None or (passed, cs) > (best["passed"], best["cosine"]):
+            res["best"] = j
+        res["passed"] = res["passed"] or bool(passed)
+    return out
+
+
+def score_user_turn(expected_text: str, expected_vec, user_text: str, answer_vec=None):
     """
     expected_text: câu chuẩn
     expected_vec : vector trong DB (có cũng được, không có cũng ok)
     user_text    : người học nói (đã STT)
+    answer_vec   : vector của normalize_answer(expected_text) đã embed sẵn (answer_vec_for(block))
     """
-    exp_norm = _normalize(expected_text or "")
-    usr_norm = _normalize(user_text or "")
-
-    # lexical
-    lex, lex_dbg = _lexical_score(exp_norm, usr_norm)
-
-    # semantic: embed cả 2 NORMALIZED strings
-    exp_norm_key = f"embed_cache:{hashlib.sha256(exp_norm.encode('utf-8')).hexdigest()}"
-    evec_norm = embed_one(exp_norm_key)  
-    if evec_norm is None:
-        evec_norm = embed_one(exp_norm) # Chỉ embed nếu không có trong cache
-        cache.set(exp_norm_key, evec_norm, timeout=3600*24)
-
-    uvec      = embed_one(usr_norm)
-    cos1 = _cosine(uvec, evec_norm)
-
-    # nếu DB có vec, cũng thử với vec đó rồi lấy max (tránh lệch cách embed cũ)
-    cos2 = None
-    ev_db = _to_list(expected_vec)
-    if ev_db:
-        cos2 = _cosine(uvec, ev_db)
-
-    cos = max(cos1, cos2) if cos2 is not None else cos1
-
-    passed = (cos >= COS_MAIN) or (cos >= COS_SOFT and lex >= LEX_STRONG) or (lex >= LEX_HARD)
-
-    return {
-        "cosine": round(cos, 4),
-        "lexical": round(lex, 4),
-        "passed": bool(passed),
-        "debug": {
-            "expected_norm": exp_norm,
-            "user_norm": usr_norm,
-            "cos_norm": round(cos1, 4),
-            **({"cos_db": round(cos2, 4)} if cos2 is not None else {}),
-            **lex_dbg,
-            "thresholds": {
-                "COS_MAIN": COS_MAIN, "COS_SOFT": COS_SOFT,
-                "LEX_STRONG": LEX_STRONG, "LEX_HARD": LEX_HARD
-            }
-        }
-    }
+    # 1 cặp của score_batch: embed qua cache LRU -> Redis -> model (tối đa 1 lời gọi embed)
+    res = score_batch([(user_text, [Candidate(expected_text, expected_vec, answer_vec)])], debug=True)
+    return res[0]["candidates"][0]
 
 
 
@@ -0,0 +1,119 @@
+import os, logging
+from contextlib import contextmanager
+from typing import List, Optional, Sequence
+from django.db import connection, transaction, DatabaseError
+from django.db.models import QuerySet
+from pgvector import HalfVector
+from pgvector.django import CosineDistance
+
+log = logging.getLogger(__name__)
+
+# hnsw.ef_search: số ứng viên HNSW duyệt mỗi query (pgvector mặc định 40).
+# Lớn hơn -> recall cao hơn, chậm hơn. Phải >= top_k thì mới trả đủ kết quả.
+EF_SEARCH = int(os.getenv("PGVECTOR_EF_SEARCH", "40"))
+# pgvector >= 0.8: khi có WHERE, quét tiếp index cho tới khi đủ LIMIT (tránh thiếu kết quả do post-filter)
+ITERATIVE_SCAN = os.getenv("PGVECTOR_ITERATIVE_SCAN", "relaxed_order")  # "" để tắt
+# "vector" (float32, mặc định) | "halfvec": tìm ANN trên cột embedding_half (index nhỏ ~1/2),
+# rồi chấm lại shortlist bằng cột float32 đầy đủ. Đổi mode -> chạy `manage.py backfill_halfvec`
+# (điền embedding_half còn thiếu + đổi HNSW sang cột của mode mới, xem sync_indexes).
+STORAGE = os.getenv("PGVECTOR_STORAGE", "vector")
+RESCORE_MULT = int(os.getenv("PGVECTOR_RESCORE_MULT", "4"))  # shortlist = top_k * N
+
+
+def use_half() -> bool:
+    return STORAGE == "halfvec"
+
+
+def with_half(obj, vec) -> List[str]:
+    """
+    Ghi embedding_half cùng lúc với embedding ở MỌI mode -> đổi PGVECTOR_STORAGE không để lại half vector cũ.
+    Trả về field cần thêm vào update_fields.
+    """
+    obj.embedding_half = None if vec is None else list(vec)
+    return ["embedding_half"]
+
+
+# HNSW chỉ dựng cho cột mà nearest() dùng ở mode hiện tại (không nằm trong Meta.indexes của model)
+HNSW_TABLES = {"languages_roleplayblock": "rpblock", "languages_roleplayscenario": "rpscenario"}
+_HNSW = {
+    "vector": ("emb_hnsw", "embedding", "vector_cosine_ops"),
+    "halfvec": ("embh_hnsw", "embedding_half", "halfvec_cosine_ops"),
+}
+
+
+def sync_indexes(conn=None, mode: Optional[str] = None) -> List[str]:
+    """Tạo HNSW của `mode` (IF NOT EXISTS), bỏ HNSW của mode kia -> mỗi bảng đúng 1 index ANN. -> câu SQL đã chạy."""
+    mode = mode or STORAGE
+    stmts = []
+    for table, prefix in HNSW_TABLES.items():
+        for m, (suffix, col, ops) in _HNSW.items():
+            name = f"{prefix}_{suffix}"
+            if m == mode:
+                stmts.append(f"CREATE INDEX IF NOT EXISTS {name} ON {table} "
+                             f"USING hnsw ({col} {ops}) WITH (m = 16, ef_construction = 64)")
+            else:
+                stmts.append(f"DROP INDEX IF EXISTS {name}")
+    with (conn or connection).cursor() as cur:
+        for sql in stmts:
+            cur.execute(sql)
+    return stmts
+
+
+def ef_for(top_k: int, ef_search: Optional[int] = None) -> int:
+    return max(int(ef_search or EF_SEARCH), int(top_k))
+
+
+@contextmanager
+def ann_session(top_k: int, ef_search: Optional[int] = None, filtered: bool = False):
+    """
+    Mở transaction và SET LOCAL tham số HNSW cho riêng query bên trong (hết transaction là tự reset,
+    không ảnh hưởng connection dùng chung). Query phải được evaluate BÊN TRONG block `with`.
+    """
+    with transaction.atomic():
+        with connection.cursor() as cur:
+            cur.execute(f"SET LOCAL hnsw.ef_search = {ef_for(top_k, ef_search)}")
+            if filtered and ITERATIVE_SCAN:
+                try:
+                    with transaction.atomic():  # savepoint: pgvector < 0.8 không có tham số này
+                        cur.execute(f"SET LOCAL hnsw.iterative_scan = {ITERATIVE_SCAN}")
+                except DatabaseError as e:
+                    log.debug("hnsw.iterative_scan unsupported: %s", e)
+        yield
+
+
+@contextmanager
+def exact_scan():
+    """Tắt index scan -> buộc quét tuần tự + sort chính xác (dùng làm chuẩn khi benchmark recall)."""
+    with transaction.atomic():
+        with connection.cursor() as cur:
+            cur.execute("SET LOCAL enable_indexscan = off")
+        yield
+
+
+def nearest(qs: QuerySet, vec: Sequence[float], top_k: int, *, ef_search: Optional[int] = None,
+            filtered: bool = False, alias: str = "score") -> list:
+    """
+    top_k object gần `vec` nhất (cosine), annotate khoảng cách vào `alias`.
+    halfvec: lấy top_k*RESCORE_MULT ứng viên qua index embedding_half, sau đó chỉ shortlist
+    được tính lại CosineDistance trên cột float32 (lookup theo PK, rất rẻ).
+    """
+    vec = list(vec)
+    if not use_half():
+        qs = (qs.exclude(embedding__isnull=True)
+                .annotate(**{alias: CosineDistance("embedding", vec)})
+                .order_by(alias)[:top_k])
+        with ann_session(top_k, ef_search, filtered=filtered):
+            return list(qs)
+
+    pool = top_k * max(1, RESCORE_MULT)
+    cand = (qs.exclude(embedding_half__isnull=True)
+              .annotate(_hdist=CosineDistance("embedding_half", HalfVector(vec)))
+              .order_by("_hdist")
+              .values_list("pk", flat=True)[:pool])
+    with ann_session(pool, ef_search, filtered=filtered):
+        ids = list(cand)
+    if not ids:
+        return []
+    return list(qs.filter(pk__in=ids)
+                  .annotate(**{alias: CosineDistance("embedding", vec)})
+                  .order_by(alias)[:top_k])
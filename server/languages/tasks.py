@@ -0,0 +1,101 @@
+import logging
+from celery import shared_task
+from django.db.models import F
+from django.utils import timezone
+from .models import EmbeddingJob, RoleplayBlock, RoleplayScenario
+from .services.embed_pipeline import embed_chunk, stale_items
+from .services.ollama_client import current_model
+
+log = logging.getLogger(__name__)
+
+SCAN_BATCH = 2000  # số dòng / lần đọc khi tìm dòng stale
+_MODELS = {EmbeddingJob.Kind.BLOCKS: RoleplayBlock, EmbeddingJob.Kind.SCENARIOS: RoleplayScenario}
+_SCAN_FIELDS = {
+    RoleplayBlock: ("id", "section", "order", "role", "text", "embedding", "embedding_text",
+                    "embedding_hash", "embedding_model", "embedding_updated_at", "answer_hash", "updated_at"),
+    RoleplayScenario: ("id", "embedding", "embedding_text", "embedding_hash", "embedding_model",
+                       "embedding_updated_at"),
+}
+
+
+def enqueue_embed_job(kind: str = EmbeddingJob.Kind.BLOCKS, force: bool = False,
+                      chunk_size: int = 128, user=None) -> EmbeddingJob:
+    job = EmbeddingJob.objects.create(kind=kind, force=force, chunk_size=max(1, chunk_size),
+                                      model=current_model(), created_by=user)
+    start_embed_job.delay(str(job.id))
+    return job
+
+
+def _force(job: EmbeddingJob):
+    # force chỉ áp cho dòng ghi trước lúc tạo job: resume / retry không embed lại phần đã commit
+    return job.created_at if job.force else False
+
+
+def _finish_if_done(job_id: str) -> None:
+    job = EmbeddingJob.objects.get(pk=job_id)
+    if job.chunks_done >= job.chunks_total and job.status == EmbeddingJob.Status.RUNNING:
+        status = EmbeddingJob.Status.FAILED if job.failed else EmbeddingJob.Status.COMPLETED
+        EmbeddingJob.objects.filter(pk=job_id, status=EmbeddingJob.Status.RUNNING).update(
+            status=status, finished_at=timezone.now())
+
+
+@shared_task(name="languages.start_embed_job")
+def start_embed_job(job_id: str):
+    """
+    Scan các dòng stale (hash text / model đổi, chưa có vector) rồi chia chunk cố định giao cho worker.
+    Gọi lại với cùng job_id = resume: chunk đã commit không còn stale nên không bị embed lại
+    (job force cũng vậy: chỉ dòng có embedding_updated_at trước job.created_at bị ép embed lại).
+    """
+    job = EmbeddingJob.objects.get(pk=job_id)
+    Model = _MODELS[job.kind]
+    qs = Model.objects.only(*_SCAN_FIELDS[Model]).order_by("pk")
+    ids, batch = [], []
+    for obj in qs.iterator(chunk_size=SCAN_BATCH):
+        batch.append(obj)
+        if len(batch) >= SCAN_BATCH:
+            ids += [str(x.pk) for x in stale_items(batch, force=_force(job))]
+            batch = []
+    ids += [str(x.pk) for x in stale_items(batch, force=_force(job))]
+
+    chunks = [ids[i:i + job.chunk_size] for i in range(0, len(ids), job.chunk_size)]
+    EmbeddingJob.objects.filter(pk=job_id).update(
+        status=EmbeddingJob.Status.RUNNING if chunks else EmbeddingJob.Status.COMPLETED,
+        total=len(ids), done=0, failed=0, chunks_total=len(chunks), chunks_done=0, error="",
+        model=current_model(), finished_at=None if chunks else timezone.now(),
+    )
+    for chunk in chunks:
+        embed_job_chunk.delay(job_id, chunk)
+    log.info("Embedding job %s: %s stale %s rows in %s chunks", job_id, len(ids), job.kind, len(chunks))
+    return {"job_id": job_id, "total": len(ids), "chunks": len(chunks)}
+
+
+@shared_task(name="languages.embed_job_chunk", bind=True, max_retries=3)
+def embed_job_chunk(self, job_id: str, ids: list):
+    job = EmbeddingJob.objects.get(pk=job_id)
+    Model = _MODELS[job.kind]
+    qs = Model.objects.filter(pk__in=ids)
+    if Model is RoleplayBlock:
+        qs = qs.select_related("scenario")
+    try:
+        n = embed_chunk(Model, list(qs), force=_force(job))
+    except Exception as e:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e, countdown=2 ** self.request.retries * 5)
+        log.exception("Embedding job %s: chunk of %s rows failed", job_id, len(ids))
+        EmbeddingJob.objects.filter(pk=job_id).update(
+            failed=F("failed") + len(ids), chunks_done=F("chunks_done") + 1, error=str(e)[:2000])
+        _finish_if_done(job_id)
+        return {"failed": len(ids)}
+    # dòng đã fresh (vd. job khác vừa embed) vẫn tính là xong
+    EmbeddingJob.objects.filter(pk=job_id).update(done=F("done") + len(ids), chunks_done=F("chunks_done") + 1)
+    _finish_if_done(job_id)
+    return {"embedded": n}
+
+
+@shared_task(name="languages.paraphrase_topup")
+def paraphrase_topup(block_ids: list, level=None):
+    """Thêm biến thể paraphrase cho các câu có pool chưa đầy (đẩy từ paraphrase.variants_for)."""
+    from .services.paraphrase import fill
+    by_id = {str(b.id): b for b in RoleplayBlock.objects.filter(pk__in=block_ids).only("id", "role", "text")}
+    blocks = [by_id[i] for i in block_ids if i in by_id]
+    return {"added": fill(blocks, level)}
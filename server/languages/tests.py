@@ -1,3 +1,483 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from unittest import mock
 
-# Create your tests here.
+import httpx
+import numpy as np
+from channels.testing import WebsocketCommunicator
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from languages import consumer
+from languages.models import RoleplayBlock, RoleplayScenario
+from languages.services import (
+    embed_cache, embed_pipeline, gemini_client, paraphrase, practice_stream, rag, scenario_plan, validate_turn,
+)
+from languages.services.embed_text import sha256
+from languages.services.ollama_client import OllamaEmbedClient, _resize_matrix
+from languages.services.gemini_fake import FakeGemini
+from languages.services.practice_stream import JsonStringField, SentenceSplitter, aiter_practice_turn
+from utils import loop_monitor
+from utils.llm_gateway import Priority
+
+
+class JsonStringFieldTests(SimpleTestCase):
+    REPLY = 'Hi 😀 there! Ça va? He said "ok"\\\n\tBye 👋🏽.'
+
+    def _feed_split(self, raw, cut):
+        f = JsonStringField("reply")
+        return f, f.feed(raw[:cut]) + f.feed(raw[cut:])
+
+    def test_any_chunk_boundary_decodes_like_json(self):
+        # ensure_ascii: emoji thành cặp \ud83d\ude00 (Gemini cũng có thể trả dạng này)
+        for ensure_ascii in (True, False):
+            raw = json.dumps({"reply": self.REPLY, "corrected": None}, ensure_ascii=ensure_ascii)
+            for cut in range(len(raw) + 1):
+                f, text = self._feed_split(raw, cut)
+                self.assertEqual(text, self.REPLY, (ensure_ascii, cut))
+                self.assertTrue(f.closed)
+                text.encode("utf-8")  # không còn surrogate lẻ
+
+    def test_char_by_char(self):
+        raw = json.dumps({"corrected": "x", "reply": self.REPLY})
+        f = JsonStringField("reply")
+        self.assertEqual("".join(f.feed(c) for c in raw), self.REPLY)
+        self.assertEqual(json.loads(f.raw)["reply"], self.REPLY)
+
+    def test_lone_surrogate_is_replaced(self):
+        f = JsonStringField("reply")
+        self.assertEqual(f.feed('{"reply": "a\\ud83d b\\ude00"}'), "a\ufffd b\ufffd")
+
+    def test_other_fields_and_text_after_close_are_ignored(self):
+        f = JsonStringField("reply")
+        self.assertEqual(f.feed('{"explanation": "no", '), "")
+        self.assertEqual(f.feed('"reply" : "yes"'), "yes")
+        self.assertEqual(f.feed(', "reply_trans": "có"}'), "")
+
+
+class SentenceSplitterTests(SimpleTestCase):
+    def test_emits_closed_sentences_across_chunks(self):
+        s = SentenceSplitter(min_chars=5)
+        out = []
+        for piece in ["Hello the", "re. How are", " you? I'm fi", "ne"]:
+            out += s.feed(piece)
+        self.assertEqual(out, ["Hello there.", "How are you?"])
+        self.assertEqual(s.flush(), ["I'm fine"])
+        self.assertEqual(s.flush(), [])
+
+    def test_short_sentences_merge_with_next(self):
+        s = SentenceSplitter(min_chars=12)
+        self.assertEqual(s.feed("Yes! Mr. Smith is here. "), ["Yes! Mr. Smith is here."])
+
+    def test_newline_ends_sentence(self):
+        s = SentenceSplitter(min_chars=3)
+        self.assertEqual(s.feed("First line\nSecond"), ["First line"])
+        self.assertEqual(s.flush(), ["Second"])
+
+
+class EmbedStaleTests(SimpleTestCase):
+    def _embedded_block(self, text):
+        b = RoleplayBlock(section=RoleplayBlock.Section.DIALOGUE, order=1, role="student_a", text=text)
+        b.embedding_text = f"[dialogue#1] student_a: {text}"
+        b.embedding_hash = sha256(b.embedding_text)
+        b.embedding, b.embedding_model = [0.1] * 4, "m"
+        return b
+
+    def test_unchanged_block_is_fresh(self):
+        self.assertFalse(embed_pipeline._main_stale(self._embedded_block("I'd like a latte."), "m", False))
+
+    def test_edited_text_is_stale_even_with_stored_embedding_text(self):
+        b = self._embedded_block("I'd like a latte.")
+        b.text = "I'd like a cappuccino."
+        self.assertTrue(embed_pipeline._main_stale(b, "m", False))
+        self.assertEqual(b.embedding_text, "[dialogue#1] student_a: I'd like a cappuccino.")
+        self.assertEqual(b.embedding_hash, sha256(b.embedding_text))
+
+    def test_model_change_is_stale(self):
+        self.assertTrue(embed_pipeline._main_stale(self._embedded_block("Hi."), "other", False))
+
+
+class ScoreNearThresholdTests(SimpleTestCase):
+    """Vector float16 của embed_cache không được làm lật quyết định so với vector float32 gốc."""
+
+    DIM = 768
+    OFFSETS = (-3e-3, -1e-3, -3e-4, -1e-4, 0.0, 1e-4, 3e-4, 1e-3, 3e-3)
+
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        e = rng.standard_normal(self.DIM).astype("float32")
+        e /= np.linalg.norm(e)
+        w = rng.standard_normal(self.DIM).astype("float32")
+        w -= w.dot(e) * e
+        w /= np.linalg.norm(w)
+        self.exact = {"the expected answer": e}
+        self.users = []
+        for i, c in enumerate(validate_turn.COS_MAIN + d for d in self.OFFSETS):
+            text = f"reply number {i}"
+            self.exact[text] = (c * e + np.sqrt(1 - c * c) * w).astype("float32")
+            self.users.append(text)
+
+    def _embed(self, texts):
+        return np.stack([self.exact[t] for t in texts])
+
+    def _embed_f16(self, texts):  # như embed_cache: _pack (float16) rồi _unpack
+        return self._embed(texts).astype("float16").astype("float32")
+
+    def _decisions(self, **kw):
+        pairs = [(u, ["the expected answer"]) for u in self.users]
+        return [r["passed"] for r in validate_turn.score_batch(pairs, **kw)]
+
+    def test_float16_cache_gives_float32_decisions(self):
+        reference = self._decisions(embed=self._embed)
+        self.assertEqual(reference, [d >= 0 for d in self.OFFSETS])
+        self.assertEqual(self._decisions(embed=self._embed_f16, embed_exact=self._embed), reference)
+
+    def test_only_borderline_pairs_are_reembedded(self):
+        far = self.users[0]
+        self.exact[far] = -self.exact["the expected answer"]
+        seen = []
+
+        def exact(texts):
+            seen.extend(texts)
+            return self._embed(texts)
+
+        self._decisions(embed=self._embed_f16, embed_exact=exact)
+        self.assertNotIn(far, seen)
+        self.assertIn(self.users[4], seen)
+
+
+class OllamaEmbedClientTests(SimpleTestCase):
+    def _client(self, handler, **kw):
+        c = OllamaEmbedClient("http://ollama.test", "m", backoff=0.0, **kw)
+        c.http = httpx.Client(transport=httpx.MockTransport(handler))
+        self.addCleanup(c._pool.shutdown)
+        return c
+
+    @staticmethod
+    def _vec(text, dim=3):
+        i = int(text.split()[-1])
+        return [float(i)] + [0.5] * (dim - 1)
+
+    def test_batches_keep_order_and_resize(self):
+        sizes = []
+
+        def handler(request):
+            inputs = json.loads(request.content)["input"]
+            sizes.append(len(inputs))
+            return httpx.Response(200, json={"embeddings": [self._vec(t) for t in inputs]})
+
+        c = self._client(handler, batch_size=3, concurrency=2)
+        X = c.embed_matrix([f"text {i}" for i in range(7)], dim=4)
+        self.assertEqual(sorted(sizes), [1, 3, 3])
+        self.assertEqual(X.shape, (7, 4))
+        self.assertEqual(X[:, 0].tolist(), list(range(7)))
+        self.assertEqual(X[:, 3].tolist(), [0.0] * 7)  # model 3 chiều -> pad 0
+        self.assertEqual(c.embed_matrix(["text 1"], dim=None).shape, (1, 3))
+        self.assertEqual(c.embed_matrix([], dim=4).shape, (0, 4))
+
+    def test_legacy_endpoint_fallback_is_remembered(self):
+        paths = []
+
+        def handler(request):
+            paths.append(request.url.path)
+            if request.url.path == "/api/embed":
+                return httpx.Response(404)
+            return httpx.Response(200, json={"embedding": self._vec(json.loads(request.content)["prompt"])})
+
+        c = self._client(handler, batch_size=8)
+        self.assertEqual(c.embed_matrix(["a 1", "b 2"], dim=3)[:, 0].tolist(), [1.0, 2.0])
+        c.embed_matrix(["c 3"], dim=3)
+        self.assertEqual(paths, ["/api/embed", "/api/embeddings", "/api/embeddings", "/api/embeddings"])
+
+    def test_failed_batch_is_retried(self):
+        calls = []
+
+        def handler(request):
+            calls.append(1)
+            if len(calls) == 1:
+                return httpx.Response(500)
+            inputs = json.loads(request.content)["input"]
+            return httpx.Response(200, json={"embeddings": [self._vec(t) for t in inputs]})
+
+        c = self._client(handler, retries=1)
+        self.assertEqual(c.embed_matrix(["x 5"], dim=3)[0, 0], 5.0)
+        self.assertEqual(len(calls), 2)
+        with self.assertRaises(RuntimeError):
+            self._client(lambda r: httpx.Response(500), retries=1).embed_matrix(["x 1"])
+
+    def test_resize_matrix(self):
+        X = np.arange(6, dtype="float32").reshape(2, 3)
+        self.assertIs(_resize_matrix(X, 3), X)
+        np.testing.assert_array_equal(_resize_matrix(X, 2), [[0, 1], [3, 4]])
+        np.testing.assert_array_equal(_resize_matrix(X, 5), [[0, 1, 2, 0, 0], [3, 4, 5, 0, 0]])
+        self.assertTrue(_resize_matrix(X, 2).flags["C_CONTIGUOUS"])
+        self.assertEqual(_resize_matrix(X, 5).dtype, X.dtype)
+
+
+class GeminiFakeTests(SimpleTestCase):
+    """ask_gemini_chat / aask_gemini_chat / aiter_practice_turn qua REST tới FakeGemini (không cần API key thật)."""
+
+    REPLY = {"reply": "Sure, one latte coming up. Anything else for you today?", "reply_trans": "Vâng.",
+             "corrected": "I want a latte.", "explanation": "Thiếu mạo từ."}
+
+    def setUp(self):
+        self.fake = FakeGemini(reply=lambda req: json.dumps(self.REPLY)).start()
+        self.addCleanup(self.fake.stop)
+        env = mock.patch.dict(os.environ, {"GEMINI_API_KEY": "test"})
+        env.start()
+        self.addCleanup(env.stop)
+        gemini_client.configure(api_key="test", endpoint=self.fake.url, transport="rest")
+        self.addCleanup(setattr, gemini_client, "_configured", False)  # test sau cấu hình lại từ settings
+
+    def _calls(self, kind):
+        return gemini_client.stats().get(kind, {"calls": 0, "prompt_tokens": 0, "output_tokens": 0})
+
+    def test_sync_chat_reuses_cached_model_and_records_usage(self):
+        before = self._calls("practice")
+        with mock.patch.object(gemini_client.genai, "GenerativeModel",
+                               wraps=gemini_client.genai.GenerativeModel) as built:
+            first = rag.ask_gemini_chat("Cafe scenario", [], "I want latte")
+            second = rag.ask_gemini_chat("Cafe scenario", [{"role": "user", "parts": ["Hi"]},
+                                                             {"role": "model", "parts": ["Hello!"]}], "Thanks")
+        self.assertEqual(first, self.REPLY)
+        self.assertEqual(second, self.REPLY)
+        self.assertEqual(built.call_count, 1)  # cùng system prompt + config -> 1 GenerativeModel
+        req = self.fake.requests[-1]
+        self.assertIn("Cafe scenario", req["systemInstruction"]["parts"][0]["text"])
+        self.assertEqual(req["generationConfig"]["responseMimeType"], "application/json")
+        self.assertEqual([c["role"] for c in req["contents"]], ["user", "model", "user"])
+        after = self._calls("practice")
+        self.assertEqual(after["calls"] - before["calls"], 2)
+        self.assertGreater(after["prompt_tokens"], before["prompt_tokens"])
+        self.assertGreater(after["output_tokens"], before["output_tokens"])
+
+    def test_async_chat_under_rest(self):
+        before = self._calls("practice")
+        out = asyncio.run(rag.aask_gemini_chat("Cafe scenario", [], "I want latte"))
+        self.assertEqual(out, self.REPLY)
+        self.assertEqual(self._calls("practice")["calls"] - before["calls"], 1)
+
+    def test_practice_turn_streams_sentences_then_audio_in_order(self):
+        async def tts(text, lang="en"):
+            await asyncio.sleep(0.01)
+            return f"mp3:{text}"
+
+        async def run():
+            return [ev async for ev in aiter_practice_turn("Cafe scenario", [], "I want latte")]
+
+        before = self._calls("practice_stream")
+        with mock.patch.object(practice_stream, "agenerate_tts_from_text", tts):
+            events = asyncio.run(run())
+
+        texts = [e["text"] for e in events if e["type"] == "text"]
+        audio = [e for e in events if e["type"] == "audio"]
+        self.assertEqual(texts, ["Sure, one latte coming up.", "Anything else for you today?"])
+        self.assertEqual([e["seq"] for e in audio], [0, 1])
+        self.assertEqual([e["audio"] for e in audio], [f"mp3:{t}" for t in texts])
+        done = events[-1]
+        self.assertEqual(done["type"], "done")
+        self.assertEqual({k: done[k] for k in self.REPLY}, self.REPLY)
+        after = self._calls("practice_stream")
+        self.assertEqual(after["calls"] - before["calls"], 1)
+        self.assertEqual(after["errors"], before.get("errors", 0))
+        self.assertGreater(after["output_tokens"], before["output_tokens"])
+
+
+_LOCMEM = {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+
+
+@override_settings(CACHES={"default": _LOCMEM, "shared": {**_LOCMEM, "LOCATION": "embed-cache"}})
+class EmbedCacheTests(SimpleTestCase):
+    def setUp(self):
+        embed_cache._backend().clear()
+        self.backend = mock.Mock()
+        self.backend.embed_matrix.side_effect = lambda texts: np.array(
+            [[len(t), 1 / 3, 0.0] for t in texts], dtype="float32")
+        for name, new in (("_L1", embed_cache._LRU(16)), ("get_embed_backend", lambda: self.backend),
+                          ("current_model", lambda: "m")):
+            p = mock.patch.object(embed_cache, name, new)
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_miss_embeds_once_then_l1_then_redis(self):
+        X = embed_cache.embed_texts(["hello", "hi  there", "hello"])
+        self.backend.embed_matrix.assert_called_once_with(["hello", "hi there"])  # trùng -> embed 1 lần
+        self.assertEqual(X.dtype, np.float32)
+        self.assertEqual(X[:, 0].tolist(), [5.0, 8.0, 5.0])
+        self.assertEqual(X[0, 1], np.float32(np.float16(1 / 3)))  # lưu float16
+
+        np.testing.assert_array_equal(embed_cache.embed_texts(["hi there"]), X[1:2])  # L1
+        embed_cache._L1 = embed_cache._LRU(16)  # process khác: L1 rỗng, Redis còn
+        np.testing.assert_array_equal(embed_cache.embed_texts(["hello"]), X[:1])
+        self.assertEqual(self.backend.embed_matrix.call_count, 1)
+        self.assertIsNotNone(embed_cache._L1.get(embed_cache.make_key("hello", "m")))  # nạp lại L1
+
+    def test_put_prewarms_both_tiers(self):
+        embed_cache.put("expected answer", np.array([1.0, 2.0, 3.0], dtype="float32"))
+        embed_cache._L1 = embed_cache._LRU(16)
+        self.assertEqual(embed_cache.embed_text("expected answer").tolist(), [1.0, 2.0, 3.0])
+        self.backend.embed_matrix.assert_not_called()
+
+    def test_model_is_part_of_key(self):
+        self.assertNotEqual(embed_cache.make_key("hello", "a"), embed_cache.make_key("hello", "b"))
+        self.assertEqual(embed_cache.make_key("hello  world", "a"), embed_cache.make_key("hello world", "a"))
+
+
+@override_settings(CACHES={"default": _LOCMEM, "shared": {**_LOCMEM, "LOCATION": "scenario-plan"}})
+class ScenarioPlanVersionTests(SimpleTestCase):
+    def setUp(self):
+        scenario_plan._backend().clear()
+        self.t0 = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        self.scn = RoleplayScenario(id=1, slug="cafe", title="Cafe", level="A2", updated_at=self.t0)
+        self.agg = {"n": 2, "m": self.t0}
+        self.model = "m1"
+        self.blocks = [
+            RoleplayBlock(id=10, section=RoleplayBlock.Section.BACKGROUND, order=0, text="A cafe."),
+            RoleplayBlock(id=11, section=RoleplayBlock.Section.DIALOGUE, order=1, role="waiter",
+                          text="What would you like?"),
+        ]
+        self.builds = 0
+
+        def ordered(scn):
+            self.builds += 1
+            return list(self.blocks)
+
+        qs = mock.Mock()
+        qs.aggregate.side_effect = lambda **kw: dict(self.agg)
+        for target, name, new in ((RoleplayBlock, "objects", mock.Mock(filter=lambda **kw: qs)),
+                                  (scenario_plan, "current_model", lambda: self.model),
+                                  (scenario_plan, "ordered_blocks", ordered)):
+            p = mock.patch.object(target, name, new)
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_version_tracks_scenario_blocks_and_model(self):
+        v0 = scenario_plan.version(self.scn)
+        self.assertEqual(scenario_plan.version(self.scn), v0)
+        seen = {v0}
+        for change in (lambda: self.agg.update(n=3),                             # thêm / xoá block
+                       lambda: self.agg.update(m=self.t0 + timedelta(seconds=1)),  # sửa block
+                       lambda: setattr(self.scn, "updated_at", self.t0 + timedelta(days=1)),
+                       lambda: setattr(self, "model", "m2")):                    # đổi model embed
+            change()
+            v = scenario_plan.version(self.scn)
+            self.assertNotIn(v, seen)
+            seen.add(v)
+
+    def test_plan_is_shared_until_version_changes(self):
+        plan = scenario_plan.get_plan(self.scn)
+        self.assertEqual(scenario_plan.get_plan(self.scn), plan)
+        self.assertEqual(self.builds, 1)
+        self.assertEqual(scenario_plan.load_plan(plan["key"]), plan)
+        self.assertEqual([e["id"] for e in plan["dialogue"]], ["11"])
+        self.assertEqual(scenario_plan.await_payload(plan, 0, "waiter")["expected_text"], "What would you like?")
+
+        self.blocks[1].text = "What can I get you?"
+        self.agg["m"] = self.agg["m"].replace(minute=5)
+        new = scenario_plan.get_plan(self.scn)
+        self.assertEqual(self.builds, 2)
+        self.assertNotEqual(new["key"], plan["key"])
+        self.assertEqual(new["dialogue"][0]["text"], "What can I get you?")
+        self.assertEqual(scenario_plan.load_plan(plan["key"])["dialogue"][0]["text"], "What would you like?")
+
+
+@override_settings(CACHES={"default": _LOCMEM, "shared": {**_LOCMEM, "LOCATION": "paraphrase"}})
+class ParaphraseTests(SimpleTestCase):
+    def setUp(self):
+        paraphrase._backend().clear()
+        self.blocks = [mock.Mock(id=i, role="waiter", text=f"Would you like line number {i}?") for i in range(3)]
+        self.calls = []  # (priority, [i đã gửi])
+        self.omit = set()
+
+        def generate(prompt, **kw):
+            rows = json.loads(prompt.split("Lines:\n", 1)[1])
+            sent = [self.blocks_by_text[r["text"]] for r in rows]
+            self.calls[-1][1].extend(sent)
+            lines = [{"i": r["i"], "variants": [f"v{b}"]} for r, b in zip(rows, sent) if b not in self.omit]
+            return mock.Mock(text=json.dumps({"lines": lines})), None
+
+        @contextmanager
+        def slot(provider, priority):
+            self.calls.append((priority, []))
+            yield
+
+        self.blocks_by_text = {b.text: b.id for b in self.blocks}
+        for target, new in ((gemini_client, {"available": lambda: True, "generate": generate}),
+                            (paraphrase, {"slot": slot, "_schedule_topup": lambda *a: None})):
+            for name, fn in new.items():
+                p = mock.patch.object(target, name, fn)
+                p.start()
+                self.addCleanup(p.stop)
+
+    def test_session_start_is_interactive_and_retries_omitted_lines(self):
+        self.omit = {1}
+        out = paraphrase.variants_for(self.blocks, "A2")
+        self.assertEqual(self.calls, [(Priority.INTERACTIVE, [0, 1, 2]), (Priority.INTERACTIVE, [1])])
+        self.assertEqual(out, {"0": "v0", "2": "v2"})  # vẫn thiếu sau lần hỏi lại -> câu gốc
+
+    def test_fill_stays_batch(self):
+        paraphrase.fill(self.blocks, "A2")
+        self.assertEqual([p for p, _ in self.calls], [Priority.BATCH])
+
+
+
+@override_settings(CACHES={"default": _LOCMEM, "shared": {**_LOCMEM, "LOCATION": "practice-ws"}},
+                   CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class PracticeConsumerLoopLagTests(TransactionTestCase):
+    """Nhiều socket start/submit_practice cùng lúc, Gemini (FakeGemini) chậm + TTS giả: event loop không bị chặn."""
+
+    SESSIONS = 4
+    GEMINI_DELAY_S = 0.3
+    MAX_LAG_MS = 100  # gọi Gemini / TTS chặn loop -> lag >= GEMINI_DELAY_S
+
+    def setUp(self):
+        scn = RoleplayScenario.objects.create(slug="cafe-ws", title="At the cafe")
+        RoleplayBlock.objects.bulk_create([
+            RoleplayBlock(scenario=scn, section=RoleplayBlock.Section.BACKGROUND, order=0,
+                          text="A small cafe in Hanoi."),
+            RoleplayBlock(scenario=scn, section=RoleplayBlock.Section.WARMUP, order=0,
+                          text="What do you like to drink?"),
+        ])
+        fake = FakeGemini(reply=lambda req: json.dumps({"reply": "Tea is great!", "corrected": None}),
+                          delay_s=self.GEMINI_DELAY_S).start()
+        self.addCleanup(fake.stop)
+        env = mock.patch.dict(os.environ, {"GEMINI_API_KEY": "test"})
+        env.start()
+        self.addCleanup(env.stop)
+        gemini_client.configure(api_key="test", endpoint=fake.url, transport="rest")
+        self.addCleanup(setattr, gemini_client, "_configured", False)
+
+    async def _turn(self, i):
+        comm = WebsocketCommunicator(consumer.PracticeConsumer.as_asgi(), "/ws/practice/")
+        connected, _ = await comm.connect()
+        self.assertTrue(connected)
+        await comm.send_json_to({"type": "start_practice", "scenario": "cafe-ws", "role": "student_a"})
+        started = await comm.receive_json_from(timeout=5)
+        await comm.send_json_to({"type": "submit_practice", "session_id": started["session_id"],
+                                 "transcript": f"I like tea {i}"})
+        reply = await comm.receive_json_from(timeout=5)
+        return comm, started, reply
+
+    async def test_concurrent_turns_keep_loop_responsive(self):
+        async def tts(text, lang="en"):
+            await asyncio.sleep(0.05)
+            return f"mp3:{text}"
+
+        loop_monitor.ensure_started().reset()
+        with mock.patch.object(consumer, "agenerate_tts_from_text", tts):
+            results = await asyncio.gather(*[self._turn(i) for i in range(self.SESSIONS)])
+        comm = results[0][0]
+        await comm.send_json_to({"type": "loop_stats"})
+        stats = await comm.receive_json_from(timeout=5)
+        for c, _, _ in results:
+            await c.disconnect()
+
+        for _, started, reply in results:
+            self.assertEqual(started["type"], "practice_started")
+            self.assertEqual(started["ai_greeting"]["text"], "What do you like to drink?")
+            self.assertEqual(reply["type"], "ai_reply")
+            self.assertEqual((reply["ai_text"], reply["ai_audio"]), ("Tea is great!", "mp3:Tea is great!"))
+        self.assertGreater(stats["samples"], 0)
+        self.assertLess(stats["max_ms"], self.MAX_LAG_MS, stats)
@@ -24,11 +24,13 @@ from rest_framework.viewsets import ReadOnlyModelViewSet
 from vocabulary.models import Mistake, LearningInteraction
 from learning.models import LessonSession
 from languages.services.embed_pipeline import embed_blocks
+from languages.tasks import enqueue_embed_job, start_embed_job
 from languages.services.rag import ask_gemini_chat, retrieve_blocks, ask_gemini
-from languages.services.roleplay_flow import ordered_blocks, split_prologue_and_dialogue, practice_blocks
+from languages.services import gemini_client
 from languages.services.ai_speaker import ai_lines_for
 from languages.services.session_mem import create_session, get_session, save_session
-from languages.services.validate_turn import score_user_turn, make_hint
+from languages.services import practice_log, scenario_plan
+from languages.services.validate_turn import score_user_turn
 from rest_framework.filters import SearchFilter, OrderingFilter
 from django_filters.rest_framework import DjangoFilterBackend
 
@@ -1122,8 +1124,35 @@ class RoleplayBlockViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=["post"], url_path="embed", permission_classes=[IsAdminOrSuperAdmin])
     def embed_all(self, request):
-        n = embed_blocks(force=bool(request.data.get("force")))
-        return Response({"embedded": n})
+        # Chạy nền qua Celery (languages.tasks), trả job id ngay; tiến độ: GET embed/jobs/<id>
+        ser = EmbedJobIn(data=request.data)
+        ser.is_valid(raise_exception=True)
+        job = enqueue_embed_job(
+            **ser.validated_data,
+            user=request.user if request.user.is_authenticated else None,
+        )
+        return Response({"job_id": str(job.id), "status": job.status}, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=False, methods=["get"], url_path=r"embed/jobs/(?P<job_id>[0-9a-f-]+)",
+            permission_classes=[IsAdminOrSuperAdmin])
+    def embed_job(self, request, job_id=None):
+        job = get_object_or_404(EmbeddingJob, pk=job_id)
+        return Response({
+            "job_id": str(job.id), "kind": job.kind, "status": job.status, "model": job.model,
+            "total": job.total, "done": job.done, "failed": job.failed,
+            "chunks_total": job.chunks_total, "chunks_done": job.chunks_done,
+            "progress": round(job.done / job.total, 4) if job.total else (1.0 if job.finished_at else 0.0),
+            "error": job.error, "created_at": job.created_at, "finished_at": job.finished_at,
+        })
+
+    @action(detail=False, methods=["post"], url_path=r"embed/jobs/(?P<job_id>[0-9a-f-]+)/resume",
+            permission_classes=[IsAdminOrSuperAdmin])
+    def embed_job_resume(self, request, job_id=None):
+        job = get_object_or_404(EmbeddingJob, pk=job_id)
+        if job.status == EmbeddingJob.Status.RUNNING and job.chunks_done < job.chunks_total:
+            return Response({"detail": "Job is still running."}, status=status.HTTP_409_CONFLICT)
+        start_embed_job.delay(str(job.id))
+        return Response({"job_id": str(job.id), "status": "resumed"}, status=status.HTTP_202_ACCEPTED)
 
     @action(detail=False, methods=["post"], url_path="search_text", permission_classes=[permissions.AllowAny])
     def search_text(self, request):
@@ -1153,6 +1182,11 @@ class RoleplayBlockViewSet(viewsets.ModelViewSet):
           "context": RoleplayBlockReadSerializer(blocks, many=True).data
         })
 
+    @action(detail=False, methods=["get"], url_path="gemini-stats", permission_classes=[permissions.IsAdminUser])
+    def gemini_stats(self, request):
+        """Latency / token Gemini theo loại lời gọi (ask, practice, practice_stream, paraphrase) trong process."""
+        return Response(gemini_client.stats())
+
 
 class RoleplaySessionViewSet(viewsets.ViewSet):
     permission_classes = [permissions.AllowAny]
@@ -1170,41 +1204,20 @@ class RoleplaySessionViewSet(viewsets.ViewSet):
         scn = RoleplayScenario.objects.filter(slug=sc).first() \
               or get_object_or_404(RoleplayScenario, id=sc)
 
-        blocks = ordered_blocks(scn)                           
-        prologue, dialogue = split_prologue_and_dialogue(blocks)  # chỉ dialogue là lượt tương tác
+        # plan biên dịch sẵn (thứ tự block, đáp án, vector, audio) trong cache dùng chung; session chỉ giữ con trỏ
+        plan = scenario_plan.get_plan(scn)
 
-        idx = 0
-        ai_batch = []
-        while idx < len(dialogue) and (dialogue[idx].role != role):
-            ai_batch.append(dialogue[idx])
-            idx += 1
-
-        # Tạo session: idx trỏ VÀO block đầu tiên của người học (nếu có)
-        sid = create_session(str(scn.id), role, [str(b.id) for b in dialogue])
-        sess = get_session(sid)
-        sess["idx"] = idx
-        save_session(sid, sess)
+        # idx trỏ VÀO block đầu tiên của người học (nếu có); trước đó là các lượt AI
+        idx = scenario_plan.next_user_index(plan, 0, role)
+        sid = create_session(str(scn.id), role, plan["key"], idx=idx)
 
         # await_user: kèm expected_text để FE gửi sang /speech/pron/up/
-        await_user = None
-        if idx < len(dialogue):
-            nxt = dialogue[idx]
-            await_user = {
-                "block_id": str(nxt.id),      # luôn là lượt của người học
-                "role": role,
-                "order": nxt.order,
-                "expected_text": nxt.text,    # <-- đáp án chuẩn
-                "expected_hint": make_hint(nxt.text, 80),  # tuỳ chọn
-            }
-
         return Response({
             "session_id": sid,
-            "prologue": [
-                {"role": b.role or "-", "text": b.text, "section": b.section,"audio_key": b.audio_key, "order": b.order}
-                for b in prologue
-            ],
-            "ai_utterances": ai_lines_for(ai_batch, learner_role=role),
-            "await_user": await_user,
+            "prologue": plan["prologue"],
+            "ai_utterances": ai_lines_for(scenario_plan.plan_blocks(plan, 0, idx), learner_role=role,
+                                          level=plan.get("level")),
+            "await_user": scenario_plan.await_payload(plan, idx, role),
         })
 
     @action(detail=False, methods=["post"], url_path="submit")
@@ -1223,23 +1236,25 @@ class RoleplaySessionViewSet(viewsets.ViewSet):
         if not (sid and sess and transcript):
             return Response({"detail":"session_id and transcript required/valid"}, status=400)
 
-        dlg_ids = sess["dialogue_ids"]
-        idx = int(sess.get("idx", 0))
+        plan = scenario_plan.load_plan(sess.get("plan"), sess.get("scenario_id"))
+        if not plan:
+            return Response({"detail": "session_id and transcript required/valid"}, status=400)
+        if plan["key"] != sess.get("plan"):
+            # plan bị evict và scenario đã sửa -> idx của session trỏ vào dialogue cũ: bắt người học bắt đầu lại
+            return Response({"detail": "Scenario has changed, please restart the session.", "code": "plan_changed"},
+                            status=status.HTTP_409_CONFLICT)
+        dlg = plan["dialogue"]
         learner_role = sess["role"]
 
         # nhảy tới lượt user (phòng dữ liệu đổi)
-        while idx < len(dlg_ids):
-            blk = get_object_or_404(RoleplayBlock, id=dlg_ids[idx])
-            if blk.role == learner_role:
-                break
-            idx += 1
-        if idx >= len(dlg_ids):
+        idx = scenario_plan.next_user_index(plan, int(sess.get("idx", 0)), learner_role)
+        if idx >= len(dlg):
             return Response({"status":"finished", "message":"Scenario done.", "next_ai":[]})
 
-        blk = get_object_or_404(RoleplayBlock, id=dlg_ids[idx])
+        blk = scenario_plan.plan_blocks(plan, idx, idx + 1)[0]
 
         # ---> Gate bằng cosine/lexical
-        result = score_user_turn(blk.text, blk.embedding, transcript)
+        result = score_user_turn(blk.text, blk.vec, transcript, answer_vec=blk.answer_vec)
         if not result["passed"]:
             return Response({
                 "passed": False,
@@ -1250,37 +1265,20 @@ class RoleplaySessionViewSet(viewsets.ViewSet):
             })
 
         # tiến hội thoại
-        idx += 1
-        ai_batch = []
-        while idx < len(dlg_ids):
-            nb = get_object_or_404(RoleplayBlock, id=dlg_ids[idx])
-            if nb.role == learner_role:
-                break
-            ai_batch.append(nb)
-            idx += 1
+        start = idx + 1
+        idx = scenario_plan.next_user_index(plan, start, learner_role)
+        ai_batch = scenario_plan.plan_blocks(plan, start, idx)
 
         sess["idx"] = idx
         save_session(sid, sess)
 
-        next_await = None
-        if idx < len(dlg_ids):
-            nb = get_object_or_404(RoleplayBlock, id=dlg_ids[idx])
-            next_await = {
-                "block_id": str(nb.id),
-                "role": learner_role,
-                "order": nb.order,
-                "expected_text": nb.text,
-                "audio_key": nb.audio_key,
-                "expected_hint": make_hint(nb.text, 80),
-            }
-
         return Response({
             "passed": True,
             "score": result,                 # để FE show cos/lex
             "pron": pron,                    # chỉ feedback phát âm
-            "next_ai": ai_lines_for(ai_batch, learner_role=learner_role),
-            "await_user": next_await,
-            "finished": idx >= len(dlg_ids),
+            "next_ai": ai_lines_for(ai_batch, learner_role=learner_role, level=plan.get("level")),
+            "await_user": scenario_plan.await_payload(plan, idx, learner_role),
+            "finished": idx >= len(dlg),
         })
 
     @action(detail=False, methods=["post"], url_path="start-practice")
@@ -1363,8 +1361,8 @@ class RoleplaySessionViewSet(viewsets.ViewSet):
                 scenario=scn,
                 role=role,
                 system_context=sys_ctx,
-                history_log=history
             )
+            practice_log.append_turns(sid, history)
 
         # Lưu các tham số cần thiết vào Cache
         save_session(sid, {
@@ -1405,7 +1403,7 @@ class RoleplaySessionViewSet(viewsets.ViewSet):
                     "scenario_slug": db_sess.scenario.slug, # Phục hồi slug
                     "user_role": db_sess.role,
                     "system_context": db_sess.system_context,
-                    "history": db_sess.history_log,
+                    "history": practice_log.tail(db_sess.id),
                     "created_at": db_sess.created_at.timestamp()
                 }
                 save_session(sid, sess)
@@ -1431,17 +1429,13 @@ class RoleplaySessionViewSet(viewsets.ViewSet):
         correction = ai_data.get("corrected")
         explanation = ai_data.get("explanation")
 
-        # 2. Update History
-        history.append({"role": "user", "parts": [transcript]})
-        history.append({"role": "model", "parts": [ai_reply]})
-        sess["history"] = history
+        # 2. Update History: cache chỉ giữ phần đuôi cho prompt, DB chỉ INSERT 2 lượt mới
+        new_turns = [{"role": "user", "parts": [transcript]}, {"role": "model", "parts": [ai_reply]}]
+        sess["history"] = practice_log.trim(history + new_turns)
         save_session(sid, sess)
 
         if request.user.is_authenticated:
-            PracticeSession.objects.filter(id=sid).update(
-                history_log=history,
-                updated_at=timezone.now()
-            )
+            practice_log.append_turns(sid, new_turns)
 
         # 4. Sinh Audio cho câu trả lời của AI
         ai_audio = generate_tts_from_text(ai_reply, lang="en")
@@ -1465,7 +1459,7 @@ class RoleplaySessionViewSet(viewsets.ViewSet):
         Lấy danh sách các phiên Practice cũ.
         Yêu cầu GenericViewSet để có self.paginate_queryset.
         """
-        qs = PracticeSession.objects.filter(user=request.user).select_related('scenario')
+        qs = PracticeSession.objects.filter(user=request.user).select_related('scenario').defer('history_log')
         
         page = self.paginate_queryset(qs)
         if page is not None:
@@ -1489,7 +1483,7 @@ class RoleplaySessionViewSet(viewsets.ViewSet):
             "scenario_id": str(session.scenario.id),
             "user_role": session.role,
             "system_context": session.system_context,
-            "history": session.history_log,
+            "history": practice_log.tail(session.id),
             "created_at": session.created_at.timestamp()
         }
         save_session(sid, sess_data)
@@ -1506,7 +1500,9 @@ class PracticeSessionViewSet(viewsets.ReadOnlyModelViewSet):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return PracticeSession.objects.filter(user=self.request.user).select_related('scenario').order_by('-updated_at')
+        # history_log (legacy JSON, có thể rất lớn) không còn được đọc -> không kéo về
+        return (PracticeSession.objects.filter(user=self.request.user).select_related('scenario')
+                .defer('history_log').order_by('-updated_at'))
 
     def get_serializer_class(self):
         if self.action == 'retrieve':
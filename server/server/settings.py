@@ -176,6 +176,26 @@ CELERY_BEAT_SCHEDULE = {
     },
 }     
 
+# "default" giữ LocMem như cũ; "shared" = Redis dùng chung giữa các worker
+# (SHARED_CACHE_BACKEND=locmem khi chạy không có Redis)
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "shared": (
+        {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "shared-fallback",
+        }
+        if os.getenv("SHARED_CACHE_BACKEND", "redis") == "locmem" else
+        {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.getenv("SHARED_CACHE_URL", REDIS_URL),
+            "KEY_PREFIX": "be",
+        }
+    ),
+}
+
 ASGI_APPLICATION = "server.asgi.application"
 CHANNEL_LAYERS = {
     "default": {
@@ -310,11 +330,99 @@ SIMPLE_JWT = {
 # RAG config
 RAG_INDEX_DIR = BASE_DIR / "var/rag_index"
 RAG_TOP_K = 5
-RAG_EMBED_BACKEND = os.getenv("RAG_EMBED_BACKEND", "st")  # 'st' | 'ollama'
+RAG_EMBED_BACKEND = os.getenv("RAG_EMBED_BACKEND", "st")  # 'st' | 'ollama' | 'onnx' (extra "onnx")
 RAG_ST_MODEL = os.getenv("RAG_ST_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
 RAG_OLLAMA_URL = os.getenv("RAG_OLLAMA_URL", "http://localhost:11435")
 RAG_OLLAMA_EMBED_MODEL = os.getenv("RAG_OLLAMA_EMBED_MODEL", "nomic-embed-text:latest")
 RAG_SCORE_THRESH = 0.25
+RAG_HARVEST_CHUNK_SIZE = int(os.getenv("RAG_HARVEST_CHUNK_SIZE", "500"))  # LessonSkill rows / DB fetch
+RAG_HARVEST_WORKERS = int(os.getenv("RAG_HARVEST_WORKERS", "0"))         # 0 = mọi core
+RAG_EMBED_BATCH_SIZE = int(os.getenv("RAG_EMBED_BATCH_SIZE", "256"))     # docs / embed() call
+RAG_BM25_SPILL_POSTINGS = int(os.getenv("RAG_BM25_SPILL_POSTINGS", "2000000"))  # BM25 postings in RAM before spilling a run
+RAG_RETRIEVAL_MODE = os.getenv("RAG_RETRIEVAL_MODE", "hybrid")  # 'hybrid' | 'vector' | 'lexical'
+RAG_LEXICAL_FALLBACK = os.getenv("RAG_LEXICAL_FALLBACK", "1") == "1"  # embedder lỗi -> BM25
+RAG_RRF_K = 60
+RAG_CACHE_ENABLED = os.getenv("RAG_CACHE_ENABLED", "1") == "1"
+RAG_CACHE_ALIAS = "shared"
+RAG_CACHE_TTL = 60 * 60 * 6
+RAG_INDEX_CHECK_SECONDS = 30  # chu kỳ kiểm tra generation index trên đĩa
+RAG_QUANTIZE = os.getenv("RAG_QUANTIZE", "none")  # 'none' | 'int8' (rescore float32 cho shortlist)
+RAG_Q8_RESCORE_MULT = 4
+
+# Embedding cho roleplay (languages.services.ollama_client.embed_one/embed_many)
+# 'ollama' | 'onnx' (onnxruntime CPU, trong process; cần extra: poetry install -E onnx -> onnxruntime + tokenizers)
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "ollama")
+ONNX_EMBED_MODEL_DIR = os.getenv("ONNX_EMBED_MODEL_DIR", str(BASE_DIR / "var/onnx/nomic-embed-text"))  # model.onnx + tokenizer.json
+ONNX_EMBED_INTRA_THREADS = int(os.getenv("ONNX_EMBED_INTRA_THREADS", "0"))  # 0 = số core
+ONNX_EMBED_INTER_THREADS = int(os.getenv("ONNX_EMBED_INTER_THREADS", "1"))
+ONNX_EMBED_MAX_BATCH = int(os.getenv("ONNX_EMBED_MAX_BATCH", "32"))
+ONNX_EMBED_MAX_WAIT_MS = float(os.getenv("ONNX_EMBED_MAX_WAIT_MS", "5"))
+ONNX_EMBED_MAX_LEN = int(os.getenv("ONNX_EMBED_MAX_LEN", "256"))
+ONNX_EMBED_POOLING = os.getenv("ONNX_EMBED_POOLING", "mean")  # 'mean' | 'cls'
+ONNX_EMBED_PREFIX = os.getenv("ONNX_EMBED_PREFIX", "")  # vd "search_query: " cho nomic-embed-text
+EMBED_CACHE_ALIAS = "shared"  # L2 (Redis) của languages.services.embed_cache
+EMBED_CACHE_TTL = 60 * 60 * 24 * 30
+EMBED_CACHE_LRU_SIZE = int(os.getenv("EMBED_CACHE_LRU_SIZE", "4096"))  # L1 / process
+
+# Chat history theo ngân sách token + rolling summary (chat.services.history, task chat.update_summary)
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "768"))
+CHAT_HISTORY_MAX_FETCH = 40
+# Ring buffer Redis cho đuôi hội thoại chat (chat.services.ring): đọc history không chạm Postgres
+CHAT_RING = os.getenv("CHAT_RING", "1") == "1"
+CHAT_RING_SIZE = 40
+CHAT_RING_TTL = 60 * 60 * 6
+CHAT_SUMMARY_TRIGGER = 1.0  # phần chưa tóm tắt > budget * N -> tóm tắt
+CHAT_SUMMARY_KEEP = 0.5     # giữ nguyên văn ~ budget * N token cuối
+CHAT_SSE_HEARTBEAT_SECONDS = 10  # chat/stream: ": ping" khi chưa có token mới
+
+# Cache câu trả lời tutor theo ngữ nghĩa câu hỏi (chat.services.response_cache) — opt-in
+CHAT_RESPONSE_CACHE = os.getenv("CHAT_RESPONSE_CACHE", "0") == "1"
+CHAT_RESPONSE_CACHE_ALIAS = "shared"
+CHAT_RESPONSE_CACHE_TTL = int(os.getenv("CHAT_RESPONSE_CACHE_TTL", str(60 * 60 * 24 * 3)))
+CHAT_RESPONSE_CACHE_THRESHOLD = float(os.getenv("CHAT_RESPONSE_CACHE_THRESHOLD", "0.95"))  # cosine câu hỏi
+CHAT_RESPONSE_CACHE_MAX_ENTRIES = 256  # / scope
+
+# LLM gateway (utils.llm_gateway): slot đồng thời / provider trong 1 process, hàng đợi có deadline -> 429
+LLM_GATEWAY_LIMITS = {
+    "ollama": int(os.getenv("LLM_GATEWAY_OLLAMA", "2")),
+    "gemini": int(os.getenv("LLM_GATEWAY_GEMINI", "8")),
+    "gemini-live": int(os.getenv("LLM_GATEWAY_GEMINI_LIVE", "4")),
+}
+# giới hạn chung mọi process qua Redis (vd. 1 Ollama cho cả web + celery); rỗng = chỉ giới hạn trong process
+LLM_GATEWAY_GLOBAL_LIMITS = (
+    {"ollama": int(os.getenv("LLM_GATEWAY_OLLAMA_GLOBAL"))} if os.getenv("LLM_GATEWAY_OLLAMA_GLOBAL") else {}
+)
+LLM_GATEWAY_QUEUE_MAX = int(os.getenv("LLM_GATEWAY_QUEUE_MAX", "32"))
+LLM_GATEWAY_DEADLINES = {0: 10.0, 1: 15.0, 2: 120.0}  # giây chờ tối đa: stream / interactive / batch
+
+# Consumer async (utils.aio, utils.loop_monitor): pool giới hạn cho code blocking / ORM, đo lag event loop
+AIO_BLOCKING_THREADS = int(os.getenv("AIO_BLOCKING_THREADS", "8"))
+AIO_DB_THREADS = int(os.getenv("AIO_DB_THREADS", "4"))  # <= số connection Postgres dành cho 1 worker ASGI
+LOOP_MONITOR_INTERVAL_MS = 50
+LOOP_MONITOR_WARN_MS = 20  # lag > N ms -> log warning
+TTS_MAX_PROCS = int(os.getenv("TTS_MAX_PROCS", "2"))  # piper+ffmpeg chạy đồng thời / event loop
+PRACTICE_STREAM_MIN_SENTENCE_CHARS = 12  # practice pipeline: câu ngắn hơn gộp với câu sau trước khi TTS
+PRACTICE_HISTORY_TAIL = int(os.getenv("PRACTICE_HISTORY_TAIL", "12"))  # số lượt practice cuối đưa vào prompt
+
+# Roleplay: scenario plan biên dịch sẵn (languages.services.scenario_plan), key theo version -> sửa block là key mới
+ROLEPLAY_PLAN_CACHE_ALIAS = "shared"
+ROLEPLAY_PLAN_CACHE_TTL = 60 * 60 * 24
+# Paraphrase lượt AI (ROLEPLAY_PARAPHRASE_OTHER=1): pool biến thể / (block, text, level), prewarm_paraphrases
+PARAPHRASE_CACHE_ALIAS = "shared"
+PARAPHRASE_CACHE_TTL = 60 * 60 * 24 * 30
+PARAPHRASE_POOL_SIZE = int(os.getenv("PARAPHRASE_POOL_SIZE", "3"))
+PARAPHRASE_CONCURRENCY = 4  # số scenario gọi Gemini song song khi prewarm
+
+# Live practice (social.PracticeLiveConsumer): hàng đợi audio mỗi chiều / kết nối
+LIVE_UP_QUEUE = 32            # client -> Gemini; đầy quá LIVE_ENQUEUE_TIMEOUT_MS -> bỏ frame
+LIVE_DOWN_QUEUE = 64          # Gemini -> client; đầy -> ngừng đọc Gemini
+LIVE_ENQUEUE_TIMEOUT_MS = 500
+
+# Gemini (languages.services.gemini_client): model tái sử dụng theo (model, system instruction, config)
+GEMINI_MODEL_CACHE_SIZE = int(os.getenv("GEMINI_MODEL_CACHE_SIZE", "64"))
+# test / dev: GEMINI_API_ENDPOINT=http://127.0.0.1:8765 GEMINI_TRANSPORT=rest (manage.py fake_gemini)
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT", "")
+GEMINI_TRANSPORT = os.getenv("GEMINI_TRANSPORT", "")
 
 MEDIA_URL = "/media/"   
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
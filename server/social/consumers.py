@@ -55,13 +55,22 @@ import asyncio
 import os
 import base64
 import logging
+import time
 from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
 from google import genai
 from languages.models import RoleplayScenario
+from utils.llm_gateway import GatewayBusy, Priority, acquire_async
+from . import live_proto
 
 logger = logging.getLogger(__name__)
 
+# hàng đợi mỗi chiều của 1 kết nối live; đầy -> chiều phát phải chờ (backpressure) thay vì dồn RAM
+LIVE_UP_QUEUE = int(getattr(settings, "LIVE_UP_QUEUE", 32))        # client -> Gemini (frame audio)
+LIVE_DOWN_QUEUE = int(getattr(settings, "LIVE_DOWN_QUEUE", 64))    # Gemini -> client
+LIVE_ENQUEUE_TIMEOUT_S = float(getattr(settings, "LIVE_ENQUEUE_TIMEOUT_MS", 500)) / 1000  # chờ quá -> bỏ frame
+
 class PracticeLiveConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         # 1. Lấy thông tin Scenario từ query string
@@ -69,6 +78,8 @@ class PracticeLiveConsumer(AsyncWebsocketConsumer):
         params = parse_qs(query_string)
         scenario_slug = params.get("scenario", [None])[0]
         self.role = params.get("role", ["student"])[0]
+        # binary=1: audio trả về dạng frame nhị phân (live_proto); mặc định giữ JSON base64 cho client cũ
+        self.binary = params.get("binary", ["0"])[0] in ("1", "true")
 
         if not scenario_slug:
             await self.close(code=4000)
@@ -97,6 +108,15 @@ class PracticeLiveConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
 
+        # mỗi phiên Live giữ 1 slot "gemini-live" suốt kết nối; hết slot -> báo busy thay vì mở thêm phiên
+        try:
+            self.lease = await acquire_async("gemini-live", Priority.STREAM)
+        except GatewayBusy as e:
+            await self.send(text_data=json.dumps({"type": "error", "code": "llm_busy", "msg": str(e.detail),
+                                                  "retry_after": e.retry_after}))
+            await self.close(code=4029)
+            return
+
         self.client = genai.Client(api_key=api_key)
         self.model_id = "gemini-2.5-flash-tts" 
 
@@ -122,8 +142,15 @@ class PracticeLiveConsumer(AsyncWebsocketConsumer):
             # Vào context thủ công
             self.live_session = await self.live_ctx.__aenter__()
 
-            # 6. Chạy background task
+            # 6. Chạy background task: đọc Gemini -> down_q -> client, client -> up_q -> Gemini
+            self._t0 = time.monotonic()
+            self.up_q = asyncio.Queue(maxsize=LIVE_UP_QUEUE)
+            self.down_q = asyncio.Queue(maxsize=LIVE_DOWN_QUEUE)
+            self.up_stats, self.down_stats = live_proto.LinkStats(), live_proto.LinkStats()
+            self._seq_out = 0
             self.receive_task = asyncio.create_task(self.proxy_gemini_to_client())
+            self.pump_tasks = [asyncio.create_task(self.pump_to_gemini()),
+                               asyncio.create_task(self.pump_to_client())]
             
             # SỬA: send_json -> send(json.dumps)
             await self.send(text_data=json.dumps({"type": "status", "msg": "connected"}))
@@ -139,12 +166,12 @@ class PracticeLiveConsumer(AsyncWebsocketConsumer):
             await self.close()
 
     async def disconnect(self, close_code):
-        if hasattr(self, 'receive_task'):
-            self.receive_task.cancel()
-            try:
-                await self.receive_task
-            except asyncio.CancelledError:
-                pass
+        tasks = ([self.receive_task] if hasattr(self, 'receive_task') else []) + getattr(self, 'pump_tasks', [])
+        for t in tasks:
+            t.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            logger.info("Live session closed (%s): %s", close_code, json.dumps(self.stats()))
 
         if hasattr(self, 'live_ctx'):
             # Thoát context thủ công, cẩn thận bắt lỗi nếu kết nối đã chết
@@ -153,42 +180,96 @@ class PracticeLiveConsumer(AsyncWebsocketConsumer):
             except Exception as e:
                 logger.warning(f"Error closing Gemini context: {e}")
 
+        if hasattr(self, 'lease'):
+            self.lease.release()
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - getattr(self, "_t0", time.monotonic())
+        return {
+            "elapsed_s": round(elapsed, 1),
+            "up": {**self.up_stats.as_dict(elapsed), "queued": self.up_q.qsize()},
+            "down": {**self.down_stats.as_dict(elapsed), "queued": self.down_q.qsize()},
+        }
+
+    async def _enqueue_up(self, audio, end_of_turn=False):
+        item = (audio, end_of_turn, time.monotonic())
+        if end_of_turn:
+            await self.up_q.put(item)  # commit / END_OF_TURN không được mất (mất là Gemini không bao giờ trả lời)
+        else:
+            try:
+                await asyncio.wait_for(self.up_q.put(item), LIVE_ENQUEUE_TIMEOUT_S)
+            except asyncio.TimeoutError:
+                self.up_stats.dropped += 1  # Gemini không kịp nhận: bỏ frame audio thay vì để client dồn vô hạn
+                return
+        self.up_stats.enqueued(self.up_q.qsize())
+
     async def receive(self, text_data=None, bytes_data=None):
+        if not hasattr(self, 'live_session'):
+            return
         try:
-            if text_data:
+            if bytes_data:
+                kind, flags, _seq, payload = live_proto.unpack(bytes_data)
+                if kind == live_proto.KIND_AUDIO:
+                    await self._enqueue_up(bytes(payload), bool(flags & live_proto.FLAG_END_OF_TURN))
+            elif text_data:
                 data = json.loads(text_data)
-                
-                if hasattr(self, 'live_session'):
-                    if "audio_data" in data:
-                        await self.live_session.send(
-                            input={"data": data["audio_data"], "mime_type": "audio/pcm"}, 
-                            end_of_turn=False
-                        )
-                    elif "commit" in data:
-                        await self.live_session.send(input="", end_of_turn=True)
+
+                if "audio_data" in data:  # client cũ: base64 trong JSON
+                    await self._enqueue_up(base64.b64decode(data["audio_data"]))
+                elif "commit" in data:
+                    await self._enqueue_up(None, True)
+                elif data.get("type") == "stats":
+                    await self.send(text_data=json.dumps({"type": "stats", **self.stats()}))
 
         except Exception as e:
             logger.error(f"Error in receive: {e}")
 
+    async def pump_to_gemini(self):
+        while True:
+            audio, end_of_turn, t = await self.up_q.get()
+            try:
+                if audio:
+                    await self.live_session.send(input={"data": audio, "mime_type": "audio/pcm"},
+                                                 end_of_turn=end_of_turn)
+                else:
+                    await self.live_session.send(input="", end_of_turn=True)
+                self.up_stats.sent(len(audio or b""), t)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Gemini send error: {e}")
+
+    async def pump_to_client(self):
+        while True:
+            kind, data, t = await self.down_q.get()
+            if kind == "audio":
+                if self.binary:
+                    await self.send(bytes_data=live_proto.pack(data, self._seq_out))
+                else:
+                    await self.send(text_data=json.dumps({
+                        "type": "audio",
+                        "data": base64.b64encode(data).decode("utf-8")
+                    }))
+                self._seq_out += 1
+                self.down_stats.sent(len(data), t)
+            else:
+                await self.send(text_data=json.dumps({
+                    "type": "text",
+                    "content": data
+                }))
+
     async def proxy_gemini_to_client(self):
         try:
             async for response in self.live_session.receive():
+                # down_q đầy (client đọc chậm) -> dừng đọc Gemini tới khi có chỗ
                 if response.data:
-                    b64_audio = base64.b64encode(response.data).decode("utf-8")
-                    # SỬA: send_json -> send
-                    await self.send(text_data=json.dumps({
-                        "type": "audio",
-                        "data": b64_audio
-                    }))
-                
+                    await self.down_q.put(("audio", response.data, time.monotonic()))
+                    self.down_stats.enqueued(self.down_q.qsize())
+
                 if response.text:
-                    # SỬA: send_json -> send
-                    await self.send(text_data=json.dumps({
-                        "type": "text",
-                        "content": response.text
-                    }))
+                    await self.down_q.put(("text", response.text, time.monotonic()))
         except asyncio.CancelledError:
             pass
         except Exception as e:
             logger.error(f"Gemini proxy error: {e}")
-            # await self.send(text_data=json.dumps({"type": "error", "msg": str(e)}))
\ No newline at end of file
+            # await self.send(text_data=json.dumps({"type": "error", "msg": str(e)}))
@@ -0,0 +1,61 @@
+"""
+Frame nhị phân cho PracticeLiveConsumer: audio đi thẳng bytes PCM, không base64/JSON.
+
+    header 4 byte (big-endian): kind u8 | flags u8 | seq u16, phần còn lại là payload
+        kind  KIND_AUDIO = 1
+        flags FLAG_END_OF_TURN = 1   (client -> server: đây là chunk cuối của lượt nói, tương đương {"commit": true})
+        seq   tăng dần mỗi chiều, quay vòng 65535 -> client phát hiện mất / đảo frame
+
+Control (status, error, text, stats, commit) vẫn là JSON text frame.
+"""
+import struct
+import time
+from typing import Dict, Tuple
+
+HEADER = struct.Struct("!BBH")
+KIND_AUDIO = 1
+FLAG_END_OF_TURN = 1
+
+
+def pack(payload: bytes, seq: int, kind: int = KIND_AUDIO, flags: int = 0) -> bytes:
+    return HEADER.pack(kind, flags, seq & 0xFFFF) + payload
+
+
+def unpack(frame: bytes) -> Tuple[int, int, int, memoryview]:
+    if len(frame) < HEADER.size:
+        raise ValueError("frame shorter than header")
+    kind, flags, seq = HEADER.unpack_from(frame)
+    return kind, flags, seq, memoryview(frame)[HEADER.size:]
+
+
+class LinkStats:
+    """Thống kê 1 chiều của 1 kết nối: frame/byte, lag trong hàng đợi, frame bị bỏ, độ sâu hàng đợi cao nhất."""
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.queue_peak = 0
+        self.lag_max_ms = 0.0
+        self._lag_sum_ms = 0.0
+
+    def enqueued(self, depth: int) -> None:
+        self.queue_peak = max(self.queue_peak, depth)
+
+    def sent(self, nbytes: int, enqueued_at: float) -> None:
+        lag = (time.monotonic() - enqueued_at) * 1000
+        self.frames += 1
+        self.bytes += nbytes
+        self._lag_sum_ms += lag
+        self.lag_max_ms = max(self.lag_max_ms, lag)
+
+    def as_dict(self, elapsed_s: float) -> Dict:
+        return {
+            "frames": self.frames,
+            "bytes": self.bytes,
+            "kbps": round(self.bytes * 8 / 1000 / elapsed_s, 1) if elapsed_s > 0 else 0.0,
+            "dropped": self.dropped,
+            "queue_peak": self.queue_peak,
+            "lag_avg_ms": round(self._lag_sum_ms / self.frames, 2) if self.frames else 0.0,
+            "lag_max_ms": round(self.lag_max_ms, 2),
+        }
@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import os
 import re
@@ -48,12 +49,8 @@ def _sanitize_for_piper(text: str) -> str:
     text = re.sub(r'\s+', ' ', text).strip()
     return text
 
-def _tts_piper_to_mp3_b64(text: str, lang: str) -> str:
-    """
-    Core Logic của Piper. 
-    Gọi tiến trình con (subprocess) chạy Piper để tạo âm thanh WAV, 
-    sau đó chuyển sang MP3 base64.
-    """
+def _piper_cmd(lang: str):
+    """-> (bin_path, model_path, config_path, env) cho 1 lần chạy Piper; thiếu binary/voice -> RuntimeError."""
     bin_path, voice_dir, voices = _piper_conf()
 
     if not shutil.which(bin_path):
@@ -88,6 +85,17 @@ def _tts_piper_to_mp3_b64(text: str, lang: str) -> str:
         "PYTHONIOENCODING": "utf-8",
     })
 
+    return bin_path, model_path, config_path, env
+
+
+def _tts_piper_to_mp3_b64(text: str, lang: str) -> str:
+    """
+    Core Logic của Piper. 
+    Gọi tiến trình con (subprocess) chạy Piper để tạo âm thanh WAV, 
+    sau đó chuyển sang MP3 base64.
+    """
+    bin_path, model_path, config_path, env = _piper_cmd(lang)
+
     clean = _sanitize_for_piper(text)
 
     # 1) thử stdout
@@ -533,6 +541,10 @@ def tts_synthesize(text: str, lang: Optional[str] = None) -> Tuple[str, str]:
             raise
 
     # ---- 2) Fallback gTTS (khi Piper không chạy được) ----
+    return _tts_gtts_b64(text, lang_norm)
+
+
+def _tts_gtts_b64(text: str, lang_norm: str) -> Tuple[str, str]:
     lang_fallback = lang_norm or "en"
     try:
         tts = gTTS(text=text, lang=lang_fallback)
@@ -554,6 +566,83 @@ def tts_synthesize(text: str, lang: Optional[str] = None) -> Tuple[str, str]:
         _safe_remove(tmp_path)
 
 
+# ---------------- TTS async (consumer / view ASGI) ----------------
+# Piper + ffmpeg chạy bằng asyncio subprocess: event loop không bị chặn, huỷ task -> kill tiến trình.
+TTS_MAX_PROCS = int(getattr(settings, "TTS_MAX_PROCS", max(1, (os.cpu_count() or 2) // 2)))
+_tts_sems: Dict[int, asyncio.Semaphore] = {}
+
+
+def _tts_sem() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    sem = _tts_sems.get(id(loop))
+    if sem is None:
+        sem = _tts_sems[id(loop)] = asyncio.Semaphore(TTS_MAX_PROCS)
+    return sem
+
+
+async def _aexec(cmd, data: bytes, env=None) -> bytes:
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE, env=env,
+    )
+    try:
+        out, err = await proc.communicate(data)
+    except asyncio.CancelledError:
+        if proc.returncode is None:
+            proc.kill()
+        raise
+    if proc.returncode != 0:
+        raise RuntimeError(f"{os.path.basename(cmd[0])} rc={proc.returncode} stderr={err.decode(errors='ignore')[:300]}")
+    return out
+
+
+def _ffmpeg_mp3_cmd(src: str):
+    return ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", src, "-f", "mp3", "pipe:1"]
+
+
+async def _atts_piper_to_mp3_b64(text: str, lang: str) -> str:
+    bin_path, model_path, config_path, env = _piper_cmd(lang)
+    piper = [bin_path, "--model", model_path, "--config", config_path, "--output_file"]
+    data = _sanitize_for_piper(text).encode("utf-8", "ignore")
+    async with _tts_sem():  # Piper ăn CPU: giới hạn số tiến trình song song
+        # 1) thử stdout
+        try:
+            wav_bytes = await _aexec(piper + ["-"], data, env=env)
+            if not wav_bytes:
+                raise RuntimeError("piper_no_audio_stdout")
+        except Exception as e1:
+            # 2) bản Piper không ghi WAV ra stdout được -> ghi file tạm (như bản sync), ffmpeg đọc thẳng file
+            logger.debug("[TTS] Piper stdout failed (%r), retry with temp file", e1)
+            tmp_wav = tempfile.NamedTemporaryFile(suffix=".wav", delete=False).name
+            try:
+                await _aexec(piper + [tmp_wav], data, env=env)
+                if not os.path.exists(tmp_wav) or os.path.getsize(tmp_wav) == 0:
+                    raise RuntimeError("piper_no_audio_file")
+                mp3 = await _aexec(_ffmpeg_mp3_cmd(tmp_wav), b"")
+            finally:
+                _safe_remove(tmp_wav)
+        else:
+            mp3 = await _aexec(_ffmpeg_mp3_cmd("pipe:0"), wav_bytes)
+    return base64.b64encode(mp3).decode("utf-8")
+
+
+async def atts_synthesize(text: str, lang: Optional[str] = None) -> Tuple[str, str]:
+    """Bản async của tts_synthesize: Piper qua asyncio subprocess, gTTS (HTTP sync) qua thread pool giới hạn."""
+    from utils.aio import run_blocking
+    lang_norm = (lang or "en").lower().strip()
+    try:
+        b64 = await _atts_piper_to_mp3_b64(text, lang_norm)
+        logger.info("[TTS] Piper OK (lang=%s)", lang_norm)
+        return b64, "audio/mpeg"
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.warning("[TTS] Piper FAILED (lang=%s): %r", lang_norm, e)
+        if getattr(settings, "PIPER_STRICT", False):
+            raise
+    return await run_blocking(_tts_gtts_b64, text, lang_norm)
+
+
 def stt_transcribe(audio_base64: str, lang: Optional[str] = None) -> str:
     text, _debug = stt_transcribe_with_debug(audio_base64, lang)
     return text
@@ -1,11 +1,16 @@
+import asyncio
 import base64
 import hashlib
+import logging
 import os
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
 
-from speech.services import tts_synthesize
+from speech.services import tts_synthesize, atts_synthesize
+from utils.aio import run_blocking
+
+log = logging.getLogger(__name__)
 
 
 def generate_block_tts(block):
@@ -39,6 +44,11 @@ def generate_block_tts(block):
     return rel_path
 
 
+def _dynamic_path(text: str, lang: str) -> str:
+    h = hashlib.sha1(f"dynamic|{lang}|{text}".encode("utf-8")).hexdigest()[:16]
+    return f"tts/dynamic/{lang}/{h}.mp3"
+
+
 def generate_tts_from_text(text: str, lang: str = "en", voice: str = None):
     """
     Sinh file audio tạm từ text raw (phục vụ AI dynamic response).
@@ -51,8 +61,7 @@ def generate_tts_from_text(text: str, lang: str = "en", voice: str = None):
         raw = base64.b64decode(audio_b64)
         
         # 2) Lưu file (dùng hash text làm tên file để cache nếu câu lặp lại)
-        h = hashlib.sha1(f"dynamic|{lang}|{text}".encode("utf-8")).hexdigest()[:16]
-        rel_path = f"tts/dynamic/{lang}/{h}.mp3"
+        rel_path = _dynamic_path(text, lang)
         
         if not default_storage.exists(rel_path):
             default_storage.save(rel_path, ContentFile(raw))
@@ -61,3 +70,25 @@ def generate_tts_from_text(text: str, lang: str = "en", voice: str = None):
     except Exception as e:
         print(f"[TTS Dynamic Error] {e}")
         return ""
+
+
+async def agenerate_tts_from_text(text: str, lang: str = "en", voice: str = None):
+    """
+    Bản async cho consumer: câu đã có file (cùng hash) -> trả ngay, không synth lại.
+    Storage (có thể là S3) chạy ở thread pool; huỷ task -> dừng luôn tiến trình Piper.
+    """
+    if not text: return ""
+    rel_path = _dynamic_path(text, lang)
+    try:
+        if await run_blocking(default_storage.exists, rel_path):
+            return rel_path
+        audio_b64, mimetype = await atts_synthesize(text, lang)
+        raw = base64.b64decode(audio_b64)
+        if not await run_blocking(default_storage.exists, rel_path):
+            await run_blocking(default_storage.save, rel_path, ContentFile(raw))
+        return rel_path
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        log.warning("[TTS Dynamic Error] %s", e)
+        return ""
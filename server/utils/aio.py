@@ -0,0 +1,60 @@
+"""
+Chạy code blocking từ consumer/view async mà không chặn event loop.
+
+- run_blocking: CPU / subprocess / SDK sync -> pool giới hạn AIO_BLOCKING_THREADS
+- run_db:       code có ORM -> pool riêng AIO_DB_THREADS (mỗi thread 1 connection, không vượt CONN_MAX
+                của Postgres), dọn connection cũ trước/sau như database_sync_to_async của channels
+- submit_db:    như run_db nhưng từ code sync -> Future, để chạy song song với việc khác trong cùng request
+- ClosingStream: nội dung async cho StreamingHttpResponse + callback khi response đóng (trả slot LLM, ...)
+"""
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+BLOCKING_POOL = ThreadPoolExecutor(max_workers=int(getattr(settings, "AIO_BLOCKING_THREADS", 8)),
+                                   thread_name_prefix="aio-blocking")
+DB_POOL = ThreadPoolExecutor(max_workers=int(getattr(settings, "AIO_DB_THREADS", 4)),
+                             thread_name_prefix="aio-db")
+
+
+async def run_blocking(fn, *args, **kwargs):
+    return await sync_to_async(fn, thread_sensitive=False, executor=BLOCKING_POOL)(*args, **kwargs)
+
+
+def _with_db(fn):
+    @functools.wraps(fn)
+    def inner(*args, **kwargs):
+        close_old_connections()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return inner
+
+
+async def run_db(fn, *args, **kwargs):
+    return await sync_to_async(_with_db(fn), thread_sensitive=False, executor=DB_POOL)(*args, **kwargs)
+
+
+def submit_db(fn, *args, **kwargs):
+    return DB_POOL.submit(_with_db(fn), *args, **kwargs)
+
+
+class ClosingStream:
+    """
+    Bọc async generator cho StreamingHttpResponse: Django gọi close() khi response đóng, kể cả khi client ngắt
+    trước lúc generator chạy (finally của generator chưa bắt đầu không bao giờ chạy). on_close phải idempotent
+    (vd. Lease.release) vì generator thường cũng tự gọi nó trong finally.
+    """
+
+    def __init__(self, agen, on_close):
+        self._agen, self._on_close = agen, on_close
+
+    def __aiter__(self):
+        return self._agen.__aiter__()
+
+    def close(self):
+        self._on_close()
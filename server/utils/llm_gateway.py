@@ -0,0 +1,343 @@
+"""
+Gateway dùng chung cho mọi lời gọi LLM (Ollama, Gemini): lập lịch theo ưu tiên + giới hạn đồng thời + backpressure.
+
+    Priority.STREAM       chat stream / practice đang chờ trả lời      (cao nhất)
+    Priority.INTERACTIVE  request blocking của người dùng
+    Priority.BATCH        paraphrase, tóm tắt hội thoại, job nền       (không bao giờ chiếm slot cuối)
+
+Mỗi provider có N slot trong process (LLM_GATEWAY_LIMITS). Hết slot -> xếp hàng theo (priority, FIFO);
+hàng đợi đầy hoặc chờ quá deadline -> GatewayBusy (HTTP 429 + Retry-After). Khi đặt
+LLM_GATEWAY_GLOBAL_LIMITS, slot còn phải giành thêm 1 lease trên Redis (sorted set) -> giới hạn chung
+cho mọi worker/process dùng cùng 1 Ollama.
+
+Dùng:
+    with slot("gemini", Priority.BATCH): ...              # code sync (view DRF, Celery)
+    async with aslot("ollama", Priority.STREAM): ...       # code async (view ASGI, consumer)
+    lease = await acquire_async("ollama", Priority.STREAM) # giữ slot qua nhiều await, nhớ lease.release()
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from enum import IntEnum
+from typing import Dict, Optional
+
+from django.conf import settings
+from rest_framework.exceptions import Throttled
+
+from utils.aio import BLOCKING_POOL, run_blocking
+
+log = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    STREAM = 0
+    INTERACTIVE = 1
+    BATCH = 2
+
+
+LIMITS: Dict[str, int] = {"ollama": 2, "gemini": 8, "gemini-live": 4,
+                          **getattr(settings, "LLM_GATEWAY_LIMITS", {})}
+GLOBAL_LIMITS: Dict[str, int] = dict(getattr(settings, "LLM_GATEWAY_GLOBAL_LIMITS", {}) or {})
+QUEUE_MAX = int(getattr(settings, "LLM_GATEWAY_QUEUE_MAX", 32))  # / provider
+DEADLINES = {  # giây chờ tối đa trong hàng đợi
+    Priority.STREAM: 10.0,
+    Priority.INTERACTIVE: 15.0,
+    Priority.BATCH: 120.0,
+    **{Priority(int(k)): float(v) for k, v in (getattr(settings, "LLM_GATEWAY_DEADLINES", {}) or {}).items()},
+}
+LEASE_TTL = float(getattr(settings, "LLM_GATEWAY_LEASE_TTL", 300))  # lease Redis của process chết tự hết hạn
+GLOBAL_POLL_S = 0.05
+
+
+class GatewayBusy(Throttled):
+    default_detail = "LLM đang quá tải, vui lòng thử lại sau."
+    default_code = "llm_busy"
+
+    def __init__(self, provider: str, retry_after: float = 2.0, reason: str = "queue_full"):
+        self.provider, self.reason, self.retry_after = provider, reason, retry_after
+        super().__init__(wait=retry_after)
+
+
+# ---------------- Redis lease (tuỳ chọn) ----------------
+class _GlobalSlots:
+    """Semaphore phân tán bằng ZSET: score = thời điểm lấy; lease quá LEASE_TTL coi như chết và bị dọn."""
+
+    def __init__(self):
+        self._client = None
+
+    def _redis(self):
+        if self._client is None:
+            import redis
+            self._client = redis.Redis.from_url(getattr(settings, "REDIS_URL", "redis://localhost:6379/0"))
+        return self._client
+
+    def try_acquire(self, provider: str) -> Optional[str]:
+        limit = GLOBAL_LIMITS.get(provider)
+        if not limit:
+            return ""
+        key, token, now = f"llmgw:{provider}", uuid.uuid4().hex, time.time()
+        try:
+            p = self._redis().pipeline()
+            p.zremrangebyscore(key, "-inf", now - LEASE_TTL)
+            p.zadd(key, {token: now})
+            p.zrank(key, token)
+            p.expire(key, int(LEASE_TTL) + 60)
+            _, _, rank, _ = p.execute()
+        except Exception as e:  # Redis lỗi -> chỉ còn giới hạn trong process
+            log.warning("LLM gateway: Redis lease failed (%s), using local limits only", e)
+            return ""
+        if rank is not None and rank < limit:
+            return token
+        self.release(provider, token)
+        return None
+
+    async def atry_acquire(self, provider: str) -> Optional[str]:
+        """Như try_acquire nhưng pipeline Redis chạy trong BLOCKING_POOL, không chặn event loop."""
+        if not GLOBAL_LIMITS.get(provider):
+            return ""
+        return await run_blocking(self.try_acquire, provider)
+
+    def release(self, provider: str, token: str) -> None:
+        if not token:
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:  # gọi từ event loop (finally của view/stream, ClosingStream.close) -> zrem ở thread khác
+            BLOCKING_POOL.submit(self._release, provider, token)
+            return
+        self._release(provider, token)
+
+    def _release(self, provider: str, token: str) -> None:
+        try:
+            self._redis().zrem(f"llmgw:{provider}", token)
+        except Exception as e:
+            log.warning("LLM gateway: Redis release failed: %s", e)
+
+
+# ---------------- scheduler trong process ----------------
+class _Waiter:
+    __slots__ = ("priority", "seq", "deadline", "event", "loop", "future", "granted")
+
+    def __init__(self, priority, seq, deadline, loop=None):
+        self.priority, self.seq, self.deadline = priority, seq, deadline
+        self.loop = loop
+        self.future = loop.create_future() if loop else None
+        self.event = None if loop else threading.Event()
+        self.granted = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def wake(self):
+        self.granted = True
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(lambda f=self.future: f.done() or f.set_result(True))
+        else:
+            self.event.set()
+
+
+class _Provider:
+    def __init__(self, name: str, limit: int):
+        self.name, self.limit = name, max(1, limit)
+        self.batch_limit = max(1, self.limit - 1)  # chừa 1 slot cho request tương tác
+        self.active = 0
+        self.active_batch = 0
+        self.queue: list = []
+        self.stats = {"granted": 0, "rejected": 0, "timeouts": 0, "wait_ms": 0.0}
+
+    def _can_run(self, priority) -> bool:
+        if self.active >= self.limit:
+            return False
+        return priority != Priority.BATCH or self.active_batch < self.batch_limit
+
+    def _take(self, priority):
+        self.active += 1
+        if priority == Priority.BATCH:
+            self.active_batch += 1
+        self.stats["granted"] += 1
+
+
+class Lease:
+    def __init__(self, gw: "LLMGateway", provider: str, priority: Priority, token: str, waited_ms: float):
+        self._gw, self.provider, self.priority, self.token = gw, provider, priority, token
+        self.waited_ms = waited_ms
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._gw._release(self)
+
+
+class LLMGateway:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._providers: Dict[str, _Provider] = {}
+        self._global = _GlobalSlots()
+
+    def _p(self, name: str) -> _Provider:
+        p = self._providers.get(name)
+        if p is None:
+            p = self._providers.setdefault(name, _Provider(name, LIMITS.get(name, 4)))
+        return p
+
+    # ---- grant / release (gọi khi giữ self._lock) ----
+    def _enter(self, provider: str, priority: Priority, loop=None):
+        """-> None nếu được slot ngay, ngược lại waiter đang xếp hàng. Hàng đầy -> GatewayBusy."""
+        p = self._p(provider)
+        with self._lock:
+            if len(p.queue) >= QUEUE_MAX:
+                p.stats["rejected"] += 1
+                raise GatewayBusy(provider, retry_after=self._retry_after(p))
+            w = _Waiter(priority, next(self._seq), time.monotonic() + DEADLINES[priority], loop)
+            heapq.heappush(p.queue, w)
+            self._dispatch(p)  # cùng 1 đường cấp slot cho người mới đến và người đang chờ -> đúng thứ tự ưu tiên
+            return None if w.granted else w
+
+    def _dispatch(self, p: _Provider) -> None:
+        now = time.monotonic()
+        skipped = []
+        while p.queue and p.active < p.limit:
+            w = heapq.heappop(p.queue)
+            if w.deadline < now:
+                continue  # waiter tự dọn khi hết hạn
+            if not p._can_run(w.priority):
+                skipped.append(w)  # batch bị chặn bởi batch_limit, nhường request tương tác phía sau
+                continue
+            p._take(w.priority)
+            w.wake()
+        for w in skipped:
+            heapq.heappush(p.queue, w)
+
+    def _abandon(self, provider: str, w: _Waiter) -> bool:
+        """Waiter hết deadline/bị huỷ. -> True nếu thực ra đã được cấp slot (người gọi phải trả lại)."""
+        p = self._p(provider)
+        with self._lock:
+            if w.granted:
+                return True
+            try:
+                p.queue.remove(w)
+                heapq.heapify(p.queue)
+            except ValueError:
+                pass
+            p.stats["timeouts"] += 1
+            return False
+
+    def _release_local(self, provider: str, priority: Priority) -> None:
+        p = self._p(provider)
+        with self._lock:
+            p.active -= 1
+            if priority == Priority.BATCH:
+                p.active_batch -= 1
+            self._dispatch(p)
+
+    def _release(self, lease: Lease) -> None:
+        self._global.release(lease.provider, lease.token)
+        self._release_local(lease.provider, lease.priority)
+
+    def _retry_after(self, p: _Provider) -> float:
+        return round(min(30.0, 1.0 + len(p.queue) / max(1, p.limit)), 1)
+
+    def _lease(self, provider, priority, t0) -> Lease:
+        waited = (time.monotonic() - t0) * 1000
+        p = self._p(provider)
+        with self._lock:
+            p.stats["wait_ms"] += waited
+        return Lease(self, provider, priority, "", waited)
+
+    # ---- sync ----
+    def acquire(self, provider: str, priority: Priority = Priority.INTERACTIVE) -> Lease:
+        t0 = time.monotonic()
+        w = self._enter(provider, priority)
+        if w is not None and not w.event.wait(max(0.0, w.deadline - time.monotonic())):
+            if not self._abandon(provider, w):
+                raise GatewayBusy(provider, retry_after=self._retry_after(self._p(provider)), reason="deadline")
+        lease = self._lease(provider, priority, t0)
+        deadline = t0 + DEADLINES[priority]
+        while True:
+            token = self._global.try_acquire(provider)
+            if token is not None:
+                lease.token = token
+                return lease
+            if time.monotonic() >= deadline:
+                lease.release()
+                raise GatewayBusy(provider, reason="global_limit")
+            time.sleep(GLOBAL_POLL_S)
+
+    # ---- async ----
+    async def acquire_async(self, provider: str, priority: Priority = Priority.INTERACTIVE) -> Lease:
+        t0 = time.monotonic()
+        w = self._enter(provider, priority, loop=asyncio.get_running_loop())
+        if w is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(w.future), max(0.0, w.deadline - time.monotonic()))
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if self._abandon(provider, w):  # đã được cấp đúng lúc hết hạn / bị huỷ -> trả slot
+                    self._release_local(provider, priority)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                raise GatewayBusy(provider, retry_after=self._retry_after(self._p(provider)), reason="deadline")
+        lease = self._lease(provider, priority, t0)
+        deadline = t0 + DEADLINES[priority]
+        try:
+            while True:
+                token = await self._global.atry_acquire(provider)
+                if token is not None:
+                    lease.token = token
+                    return lease
+                if time.monotonic() >= deadline:
+                    raise GatewayBusy(provider, reason="global_limit")
+                await asyncio.sleep(GLOBAL_POLL_S)
+        except BaseException:
+            lease.release()
+            raise
+
+    def stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {
+                name: {"limit": p.limit, "active": p.active, "active_batch": p.active_batch,
+                       "queued": len(p.queue), **p.stats,
+                       "global_limit": GLOBAL_LIMITS.get(name)}
+                for name, p in self._providers.items()
+            }
+
+
+_GATEWAY = LLMGateway()
+
+
+def get_gateway() -> LLMGateway:
+    return _GATEWAY
+
+
+@contextmanager
+def slot(provider: str, priority: Priority = Priority.INTERACTIVE):
+    lease = _GATEWAY.acquire(provider, priority)
+    try:
+        yield lease
+    finally:
+        lease.release()
+
+
+@asynccontextmanager
+async def aslot(provider: str, priority: Priority = Priority.INTERACTIVE, lease: Optional[Lease] = None):
+    """lease có sẵn (view đã giành slot trước khi trả response) -> dùng lại, không giành thêm."""
+    if lease is not None:
+        yield lease
+        return
+    own = await _GATEWAY.acquire_async(provider, priority)
+    try:
+        yield own
+    finally:
+        own.release()
+
+
+async def acquire_async(provider: str, priority: Priority = Priority.INTERACTIVE) -> Lease:
+    return await _GATEWAY.acquire_async(provider, priority)
@@ -0,0 +1,82 @@
+"""
+Đo độ trễ event loop: 1 task ngủ INTERVAL rồi đo thời gian thức dậy muộn hơn dự kiến.
+Handler nào chặn loop (ORM sync, SDK sync, subprocess.run...) đều hiện ra thành lag ở đây.
+
+    ensure_started()      # gọi trong connect() của consumer; 1 monitor / event loop
+    stats()               # {"samples", "max_ms", "p50_ms", "p99_ms", "over_warn"}
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+INTERVAL_S = float(getattr(settings, "LOOP_MONITOR_INTERVAL_MS", 50)) / 1000
+WARN_MS = float(getattr(settings, "LOOP_MONITOR_WARN_MS", 20))
+WINDOW = 2048  # số mẫu giữ lại để tính percentile
+
+
+class LoopLagMonitor:
+    def __init__(self, interval_s: float = INTERVAL_S, warn_ms: float = WARN_MS):
+        self.interval_s, self.warn_ms = interval_s, warn_ms
+        self.samples: deque = deque(maxlen=WINDOW)
+        self.max_ms = 0.0
+        self.over_warn = 0
+        self.task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        while True:
+            t0 = time.perf_counter()
+            await asyncio.sleep(self.interval_s)
+            lag = max(0.0, (time.perf_counter() - t0 - self.interval_s) * 1000)
+            self.samples.append(lag)
+            self.max_ms = max(self.max_ms, lag)
+            if lag > self.warn_ms:
+                self.over_warn += 1
+                log.warning("Event loop blocked ~%.1f ms", lag)
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+
+    def reset(self) -> None:
+        self.samples.clear()
+        self.max_ms, self.over_warn = 0.0, 0
+
+    def stats(self) -> Dict:
+        xs = sorted(self.samples)
+
+        def pct(p):
+            return round(xs[min(len(xs) - 1, int(len(xs) * p))], 2) if xs else 0.0
+
+        return {"samples": len(xs), "max_ms": round(self.max_ms, 2), "p50_ms": pct(0.5), "p99_ms": pct(0.99),
+                "over_warn": self.over_warn, "warn_ms": self.warn_ms}
+
+
+_MONITORS: Dict[int, LoopLagMonitor] = {}
+
+
+def get_monitor() -> LoopLagMonitor:
+    loop = asyncio.get_running_loop()
+    m = _MONITORS.get(id(loop))
+    if m is None:
+        m = _MONITORS[id(loop)] = LoopLagMonitor()
+    return m
+
+
+def ensure_started() -> LoopLagMonitor:
+    m = get_monitor()
+    m.start()
+    return m
+
+
+def stats() -> Dict:
+    return get_monitor().stats()